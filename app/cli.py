@@ -0,0 +1,114 @@
+#
+# Maintenance commands, run from the project root:
+#   python -m app.cli --help
+#
+import argparse
+import shutil
+
+from app.db.gene_annotations_collection import import_gene_annotations
+from app.db.setup import get_db
+from app.jobs import run_worker
+from app.db.species_collection import find_species_id_from_taxid
+from app.db.species_exports import ExportDataset, get_species_export
+from app.db.sample_annotations_collection import (
+    pack_species_samples,
+    recompute_species_stats,
+)
+from app.utils.annotation_files import ANNOTATION_FILE_FORMATS, AnnotationFileFormat
+from app.utils.columnar import ColumnarFormat
+
+
+def recompute_stats(args: argparse.Namespace) -> None:
+    db = get_db()
+    species_id = find_species_id_from_taxid(args.taxid, db)
+    annotation_type = args.annotation_type.upper() if args.annotation_type else None
+    summary = recompute_species_stats(species_id, db, annotation_type)
+    print(summary.json())
+
+
+def pack_samples(args: argparse.Namespace) -> None:
+    db = get_db()
+    species_id = find_species_id_from_taxid(args.taxid, db)
+    n_packed = pack_species_samples(species_id, db)
+    print(f"Packed the samples of {n_packed} sample annotations of species {args.taxid}")
+
+
+def import_annotations(args: argparse.Namespace) -> None:
+    db = get_db()
+    species_id = find_species_id_from_taxid(args.taxid, db)
+    parse, default_type = ANNOTATION_FILE_FORMATS[AnnotationFileFormat(args.format)]
+    with open(args.path, encoding="utf-8-sig", newline="") as annotation_file:
+        summary = import_gene_annotations(
+            species_id,
+            (args.annotation_type or default_type).upper(),
+            parse(annotation_file),
+            db
+        )
+    print(summary.json())
+
+
+def export(args: argparse.Namespace) -> None:
+    db = get_db()
+    species_id = find_species_id_from_taxid(args.taxid, db)
+    path = get_species_export(species_id, ExportDataset(args.dataset), ColumnarFormat(args.format), db)
+    if args.output is not None:
+        path = shutil.copyfile(path, args.output)
+    print(path)
+
+
+def worker(args: argparse.Namespace) -> None:
+    run_worker(get_db(), once=args.once)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    subparsers = parser.add_subparsers(required=True)
+
+    recompute = subparsers.add_parser(
+        "recompute-stats",
+        help="Re-derive avg_tpm and SPM of every sample annotation of a species"
+    )
+    recompute.add_argument("taxid", type=int)
+    recompute.add_argument("--annotation-type", default=None)
+    recompute.set_defaults(func=recompute_stats)
+
+    pack = subparsers.add_parser(
+        "pack-samples",
+        help="Convert the sample annotations of a species to packed samples storage"
+    )
+    pack.add_argument("taxid", type=int)
+    pack.set_defaults(func=pack_samples)
+
+    annotations = subparsers.add_parser(
+        "import-annotations",
+        help="Load the gene annotations of a species from a Mercator4 mapping or a GO GAF file"
+    )
+    annotations.add_argument("taxid", type=int)
+    annotations.add_argument("path")
+    annotations.add_argument("--format", choices=[f.value for f in AnnotationFileFormat], required=True)
+    annotations.add_argument("--annotation-type", default=None, help="Defaults to MERCATOR or GO")
+    annotations.set_defaults(func=import_annotations)
+
+    exports = subparsers.add_parser(
+        "export",
+        help="Write a species dataset as a Parquet or Arrow IPC file, cached until its data changes"
+    )
+    exports.add_argument("taxid", type=int)
+    exports.add_argument("dataset", choices=[d.value for d in ExportDataset])
+    exports.add_argument("--format", choices=[f.value for f in ColumnarFormat], default=ColumnarFormat.PARQUET.value)
+    exports.add_argument("--output", default=None, help="Copy the file there, instead of printing its cache path")
+    exports.set_defaults(func=export)
+
+    work = subparsers.add_parser(
+        "worker",
+        help="Run queued jobs, eg batch uploads sent with run_as_job=true"
+    )
+    work.add_argument("--once", action="store_true", help="Exit once no job is ready to run")
+    work.set_defaults(func=worker)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock
+import numpy as np
+from bson import ObjectId
+from pymongo.database import Database
+from scipy import sparse, stats
+
+from app.db.data_versions_collection import (
+    GENE_ANNOTATIONS_DATA_KEY,
+    add_data_version_listener,
+    find_data_version,
+    species_genes_data_key,
+)
+from app.db.gene_index import get_gene_index
+from app.db.setup import get_collection
+from app.models.gene_annotation import (
+    EnrichedAnnotation,
+    GeneAnnotationDoc,
+    GeneSetEnrichment,
+    GeneSetEnrichmentIn,
+)
+from app.utils.stats import benjamini_hochberg
+from config import settings
+
+#
+# Per (species, annotation type) sparse incidence matrix of genes x annotations
+#   Rows are the genes of the species with at least one annotation of the type
+#   (the background of enrichment tests), columns the annotations of the type
+#   with at least one gene of the species. Built from the gene_ids of GA docs,
+#   dropped on GA or gene writes made by this process and checked against both
+#   data versions at most every ANNOTATION_INCIDENCE_TTL seconds. At most
+#   ANNOTATION_INCIDENCE_MAX_ENTRIES matrices are kept, least recently used first out.
+#
+
+
+@dataclass
+class AnnotationIncidence:
+    versions: tuple[str, str]
+    #   gene annotations and species genes data versions
+    gene_ids: list[ObjectId]
+    annotation_labels: list[str]
+    matrix: sparse.csr_matrix
+    #   genes x annotations, 1 where the gene has the annotation
+    n_annotated: np.ndarray
+    #   genes of each annotation
+    checked_at: float = field(default_factory=time.monotonic)
+    gene_rows: dict[ObjectId, int] = field(init=False)
+
+    def __post_init__(self):
+        self.gene_rows = {gene_id: row for row, gene_id in enumerate(self.gene_ids)}
+
+
+_incidences: OrderedDict[tuple[str, ObjectId, str], AnnotationIncidence] = OrderedDict()
+_lock = Lock()
+
+
+def __drop_incidences(db_name: str, key: str | None) -> None:
+    with _lock:
+        for cache_key in [cache_key for cache_key in _incidences if cache_key[0] == db_name]:
+            if key is None or key == GENE_ANNOTATIONS_DATA_KEY or key == species_genes_data_key(cache_key[1]):
+                _ = _incidences.pop(cache_key, None)
+
+
+add_data_version_listener(__drop_incidences)
+
+
+def __build(species_id: ObjectId, annotation_type: str, versions: tuple[str, str], db: Database) -> AnnotationIncidence:
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    species_gene_ids = list(get_gene_index(species_id, db).label_of)
+    species_gene_set = set(species_gene_ids)
+    gene_rows: dict[ObjectId, int] = {}
+    col_of_ga: dict[ObjectId, int] = {}
+    annotation_labels: list[str] = []
+    rows: list[int] = []
+    cols: list[int] = []
+    # Only the GAs of the species are read, along the gene_ids index
+    for start in range(0, len(species_gene_ids), settings.BULK_WRITE_CHUNK_SIZE):
+        for ga_dict in GA_COLL.find(
+            {"type": annotation_type, "gene_ids": {"$in": species_gene_ids[start:start + settings.BULK_WRITE_CHUNK_SIZE]}},
+            {"label": 1, "gene_ids": 1}
+        ):
+            if ga_dict["_id"] in col_of_ga:
+                continue  # read with an earlier chunk of genes already
+            col = col_of_ga[ga_dict["_id"]] = len(annotation_labels)
+            annotation_labels.append(ga_dict["label"])
+            for gene_id in ga_dict["gene_ids"]:
+                if gene_id in species_gene_set:
+                    rows.append(gene_rows.setdefault(gene_id, len(gene_rows)))
+                    cols.append(col)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(gene_rows), len(annotation_labels))
+    )
+    # Duplicate gene ids within a GA count once
+    matrix.data[:] = 1
+    return AnnotationIncidence(
+        versions=versions,
+        gene_ids=list(gene_rows),
+        annotation_labels=annotation_labels,
+        matrix=matrix,
+        n_annotated=np.asarray(matrix.sum(axis=0)).ravel(),
+    )
+
+
+def get_annotation_incidence(species_id: ObjectId, annotation_type: str, db: Database) -> AnnotationIncidence:
+    key = (db.name, species_id, annotation_type)
+    incidence = _incidences.get(key)
+    if incidence is not None and time.monotonic() - incidence.checked_at < settings.ANNOTATION_INCIDENCE_TTL:
+        return incidence
+    # Versions are read first, so that a matrix is never newer than its versions
+    versions = (
+        find_data_version(GENE_ANNOTATIONS_DATA_KEY, db),
+        find_data_version(species_genes_data_key(species_id), db),
+    )
+    if incidence is None or incidence.versions != versions:
+        incidence = __build(species_id, annotation_type, versions, db)
+    incidence.checked_at = time.monotonic()
+    with _lock:
+        _incidences[key] = incidence
+        _incidences.move_to_end(key)
+        while len(_incidences) > settings.ANNOTATION_INCIDENCE_MAX_ENTRIES:
+            _ = _incidences.popitem(last=False)
+    return incidence
+
+
+#
+# Over-representation of the annotations of a type among a set of genes
+#   For each annotation: of the n_background annotated genes, n_annotated have it;
+#   the one sided hypergeometric test asks how likely n_overlap or more of the
+#   n_genes of the set have it by chance. All annotations are tested at once
+#   from the column sums of the rows of the set.
+#
+def find_gene_set_enrichment(
+    species_id: ObjectId,
+    enrichment_in: GeneSetEnrichmentIn,
+    db: Database
+) -> GeneSetEnrichment:
+    gene_index = get_gene_index(species_id, db)
+    incidence = get_annotation_incidence(species_id, enrichment_in.annotation_type, db)
+    unresolved: list[str] = []
+    set_rows: set[int] = set()
+    for gene_label in dict.fromkeys(enrichment_in.gene_labels):
+        gene_id = gene_index.gene_id_of(gene_label)
+        if gene_id is None:
+            unresolved.append(gene_label)
+        elif gene_id in incidence.gene_rows:
+            set_rows.add(incidence.gene_rows[gene_id])
+    rows = np.fromiter(sorted(set_rows), dtype=np.intp, count=len(set_rows))
+    set_matrix = incidence.matrix[rows]
+    n_overlap = np.asarray(set_matrix.sum(axis=0)).ravel()
+    n_genes, n_background = len(rows), len(incidence.gene_ids)
+    p_values = stats.hypergeom.sf(n_overlap - 1, n_background, incidence.n_annotated, n_genes)
+    fdrs = benjamini_hochberg(p_values)
+    cols = [
+        col for col in np.argsort(p_values, kind="stable").tolist()
+        if n_overlap[col] > 0 and fdrs[col] <= enrichment_in.max_fdr
+    ][:enrichment_in.limit]
+    set_matrix = set_matrix.tocsc()
+    return GeneSetEnrichment(
+        annotation_type=enrichment_in.annotation_type,
+        n_genes=n_genes,
+        n_background=n_background,
+        n_annotations=len(incidence.annotation_labels),
+        unresolved_gene_labels=unresolved,
+        annotations=[
+            EnrichedAnnotation(
+                label=incidence.annotation_labels[col],
+                n_annotated=incidence.n_annotated[col],
+                n_overlap=n_overlap[col],
+                fold_enrichment=round(
+                    (n_overlap[col] / n_genes) / (incidence.n_annotated[col] / n_background), settings.N_DECIMALS
+                ),
+                p_value=p_values[col],
+                fdr=fdrs[col],
+                gene_labels=[
+                    gene_index.label_of[incidence.gene_ids[rows[row]]]
+                    for row in set_matrix.indices[set_matrix.indptr[col]:set_matrix.indptr[col + 1]].tolist()
+                ]
+            )
+            for col in cols
+        ]
+    )
@@ -0,0 +1,186 @@
+from typing import Callable
+from bson import ObjectId
+from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne
+from pymongo.database import Database
+
+from app.db.expression_cache import coexpression_matrix_path, get_coexpression_matrix, get_species_expression
+from app.db.setup import get_async_collection, get_collection
+from app.models.coexpression_network import (
+    CoexpressionNeighboursDoc,
+    CoexpressionNetwork,
+    CoexpressionNetworkBuildSummary,
+    CoexpressionNetworkEdge,
+    CoexpressionNetworkNode,
+)
+from app.models.gene import GeneDoc
+from app.models.sample_annotation import CoexpressedGene, CoexpressionMethod, GeneCoexpression
+from app.utils.coexpression import iter_top_k
+from config import settings
+
+#
+# Precomputed co-expression networks, one per species
+#   Every gene with expression data gets one CoexpressionNeighboursDoc holding
+#   its top k co-expressed genes, computed from the species data version `ver`.
+#   A network is rebuilt only once its species data changed, or to get another
+#   method or a larger k.
+#
+
+
+def is_network_current(
+    species_id: ObjectId,
+    method: CoexpressionMethod,
+    k: int,
+    version: str,
+    db: Database
+) -> bool:
+    NET_COLL = get_collection(CoexpressionNeighboursDoc, db)
+    if NET_COLL.find_one({"spe_id": species_id}, {"_id": 1}) is None:
+        return False
+    stale = NET_COLL.find_one(
+        {"spe_id": species_id, "$or": [
+            {"ver": {"$ne": version}},
+            {"method": {"$ne": method.value}},
+            {"k": {"$lt": k}},
+        ]},
+        {"_id": 1}
+    )
+    return stale is None
+
+
+def build_coexpression_network(
+    species_id: ObjectId,
+    method: CoexpressionMethod,
+    k: int,
+    db: Database,
+    progress: Callable[[int, int], None] | None = None,
+    force: bool = False
+) -> CoexpressionNetworkBuildSummary:
+    NET_COLL = get_collection(CoexpressionNeighboursDoc, db)
+    expression = get_species_expression(species_id, db)
+    summary = CoexpressionNetworkBuildSummary(method=method, k=k, data_version=expression.version)
+    if not force and is_network_current(species_id, method, k, expression.version, db):
+        summary.skipped = True
+        return summary
+    matrix = get_coexpression_matrix(expression, method)
+    n_genes, n_samples = matrix.shape
+    for start, rows, scores in iter_top_k(
+        coexpression_matrix_path(expression, method),
+        n_genes,
+        k,
+        settings.COEXPRESSION_BLOCK_ROWS,
+        settings.COEXPRESSION_WORKERS
+    ):
+        _ = NET_COLL.bulk_write([
+            ReplaceOne(
+                {"spe_id": species_id, "g_id": expression.gene_ids[start + i]},
+                {
+                    "spe_id": species_id,
+                    "g_id": expression.gene_ids[start + i],
+                    "method": method.value,
+                    "k": k,
+                    "ver": expression.version,
+                    "n_s": n_samples,
+                    "nbr_ids": [expression.gene_ids[row] for row in gene_rows],
+                    "nbr_scores": [round(score, settings.N_DECIMALS) for score in gene_scores],
+                },
+                upsert=True
+            )
+            for i, (gene_rows, gene_scores) in enumerate(zip(rows.tolist(), scores.tolist()))
+        ], ordered=False)
+        summary.n_genes += len(rows)
+        if progress is not None:
+            progress(summary.n_genes, n_genes)
+    # Genes that lost their expression data since the previous build
+    _ = NET_COLL.delete_many({"spe_id": species_id, "ver": {"$ne": expression.version}})
+    return summary
+
+
+def __network_not_found(gene_label: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={
+            "gene_label": gene_label,
+            "description": f"no co-expression network for gene {gene_label}",
+            "recommendations": [
+                "Build the co-expression network of the species via its POST endpoint",
+                "Upload sample annotations for this gene first",
+            ],
+        }
+    )
+
+
+async def __find_gene_labels(gene_ids: list[ObjectId], db: AsyncIOMotorDatabase) -> dict[ObjectId, str]:
+    GENES_COLL = get_async_collection(GeneDoc, db)
+    return {
+        gene_dict["_id"]: gene_dict["label"]
+        async for gene_dict in GENES_COLL.find({"_id": {"$in": gene_ids}}, {"label": 1})
+    }
+
+
+async def find_gene_neighbours(
+    species_id: ObjectId,
+    gene_id: ObjectId,
+    gene_label: str,
+    top: int,
+    db: AsyncIOMotorDatabase
+) -> GeneCoexpression:
+    NET_COLL = get_async_collection(CoexpressionNeighboursDoc, db)
+    net_dict = await NET_COLL.find_one({"spe_id": species_id, "g_id": gene_id})
+    if net_dict is None:
+        raise __network_not_found(gene_label)
+    nbr_ids = net_dict["nbr_ids"][:top]
+    labels = await __find_gene_labels(nbr_ids, db)
+    return GeneCoexpression(
+        gene_id=gene_id,
+        gene_label=gene_label.upper(),
+        method=net_dict["method"],
+        n_samples=net_dict["n_s"],
+        genes=[
+            CoexpressedGene(gene_id=nbr_id, gene_label=labels.get(nbr_id), score=score)
+            for nbr_id, score in zip(nbr_ids, net_dict["nbr_scores"])
+        ]
+    )
+
+
+#
+# Subgraph around a gene, up to `hops` edges away from it
+#   edges go from each gene within hops - 1 to its top neighbours, one query per hop
+#
+async def find_network_subgraph(
+    species_id: ObjectId,
+    gene_id: ObjectId,
+    gene_label: str,
+    hops: int,
+    top: int,
+    db: AsyncIOMotorDatabase
+) -> CoexpressionNetwork:
+    NET_COLL = get_async_collection(CoexpressionNeighboursDoc, db)
+    center = await NET_COLL.find_one({"spe_id": species_id, "g_id": gene_id})
+    if center is None:
+        raise __network_not_found(gene_label)
+    hops_of_gene: dict[ObjectId, int] = {gene_id: 0}
+    edges: list[CoexpressionNetworkEdge] = []
+    frontier = [center]
+    for hop in range(1, hops + 1):
+        next_ids = []
+        for net_dict in frontier:
+            for nbr_id, score in zip(net_dict["nbr_ids"][:top], net_dict["nbr_scores"][:top]):
+                edges.append(CoexpressionNetworkEdge(source=net_dict["g_id"], target=nbr_id, score=score))
+                if nbr_id not in hops_of_gene:
+                    hops_of_gene[nbr_id] = hop
+                    next_ids.append(nbr_id)
+        if hop == hops or len(next_ids) == 0:
+            break
+        frontier = await NET_COLL.find({"spe_id": species_id, "g_id": {"$in": next_ids}}).to_list(None)
+    labels = await __find_gene_labels(list(hops_of_gene), db)
+    return CoexpressionNetwork(
+        method=center["method"],
+        data_version=center["ver"],
+        nodes=[
+            CoexpressionNetworkNode(gene_id=node_id, gene_label=labels.get(node_id), hops=node_hops)
+            for node_id, node_hops in hops_of_gene.items()
+        ],
+        edges=edges
+    )
@@ -0,0 +1,64 @@
+import time
+from bson import json_util
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+
+from app.db.data_versions_collection import add_data_version_listener, find_data_version_async
+from app.db.setup import get_async_collection
+from app.models.count import CountDoc
+from config import settings
+
+#
+# Counts behind page_total, per filter (eg genes of one species)
+#   Each count is stored with the version of the data it was taken at, under
+#   the data version key its filter depends on. Write paths bump that key, so
+#   a count is taken once per version, then read from the counts collection.
+#   Counts are also kept in memory and rechecked against the data version
+#   at most every COUNTS_CACHE_TTL seconds, so most reads cost no round trip.
+#
+
+_cache: dict[tuple[str, str], dict[str, tuple[str, int, float]]] = {}
+#   (db name, data key) -> count key -> (data version, count, checked at)
+
+
+def __drop_cached(db_name: str, data_key: str | None) -> None:
+    for cache_key in [cache_key for cache_key in list(_cache) if cache_key[0] == db_name]:
+        if data_key is None or cache_key[1] == data_key:
+            _ = _cache.pop(cache_key, None)
+
+
+add_data_version_listener(__drop_cached)
+
+
+def count_key(coll: AsyncIOMotorCollection, query: dict) -> str:
+    return f"{coll.name}:{json_util.dumps(query, sort_keys=True)}"
+
+
+async def find_count(
+    coll: AsyncIOMotorCollection,
+    query: dict,
+    data_key: str,
+    db: AsyncIOMotorDatabase
+) -> int:
+    # data_key: the data version key bumped by every write that may change this count
+    key = count_key(coll, query)
+    cached = _cache.get((db.name, data_key), {}).get(key)
+    if cached is not None and time.monotonic() - cached[2] < settings.COUNTS_CACHE_TTL:
+        return cached[1]
+    version = await find_data_version_async(data_key, db)
+    if cached is not None and cached[0] == version:
+        n = cached[1]
+    else:
+        COUNTS_COLL = get_async_collection(CountDoc, db)
+        count_dict = await COUNTS_COLL.find_one({"_id": key, "ver": version})
+        if count_dict is not None:
+            n = count_dict["n"]
+        else:
+            n = await coll.count_documents(query)
+            # Taken at `version` or later: a write in between bumps the version again
+            _ = await COUNTS_COLL.replace_one(
+                {"_id": key},
+                {"ver": version, "n": n},
+                upsert=True
+            )
+    _cache.setdefault((db.name, data_key), {})[key] = (version, n, time.monotonic())
+    return n
@@ -0,0 +1,97 @@
+from datetime import datetime
+from typing import Callable, Iterable
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+
+from app.db.setup import get_async_collection, get_collection
+from app.models.data_version import DataVersionDoc
+
+NO_VERSION = "0"
+#   version of data that was never written to
+
+SPECIES_DATA_KEY = "species"
+#   the species collection itself
+GENE_ANNOTATIONS_DATA_KEY = "gene_annotations"
+USERS_DATA_KEY = "users"
+
+_listeners: list[Callable[[str, str | None], None]] = []
+
+
+def add_data_version_listener(listener: Callable[[str, str | None], None]) -> None:
+    # listener(db_name, key) is called after every bump made by this process,
+    #   so that in-process caches can drop stale entries without waiting for a recheck
+    #   key is None when all data of the db is to be forgotten
+    _listeners.append(listener)
+
+
+def forget_data_versions(db_name: str) -> None:
+    # Drops what in-process caches hold for a db, eg after it was dropped
+    for listener in _listeners:
+        listener(db_name, None)
+
+
+def species_data_key(species_id: ObjectId) -> str:
+    return f"species:{species_id}"
+
+
+def species_genes_data_key(species_id: ObjectId) -> str:
+    # Gene labels and aliases of a species, bumped by gene writes only
+    return f"genes:{species_id}"
+
+
+def sample_annotation_label_data_key(annotation_type: str, label: str) -> str:
+    # SA docs of one annotation label across species, next to their per species key
+    #   bumped only when such docs are added or removed, not on sample appends
+    return f"sa_label:{annotation_type}:{label}"
+
+
+def bump_sample_annotation_labels(labels: Iterable[tuple[str, str]], db: Database) -> None:
+    # labels: (annotation type, annotation label) of the SA docs added or removed
+    for annotation_type, label in set(labels):
+        _ = bump_data_version(sample_annotation_label_data_key(annotation_type, label), db)
+
+
+def find_data_version(key: str, db: Database) -> str:
+    DV_COLL = get_collection(DataVersionDoc, db)
+    dv_dict = DV_COLL.find_one({"key": key}, {"_id": 0, "ver": 1})
+    if dv_dict is None:
+        return NO_VERSION
+    return str(dv_dict["ver"])
+
+
+def find_data_versions(keys: list[str], db: Database) -> dict[str, str]:
+    # Versions of several keys with one query
+    DV_COLL = get_collection(DataVersionDoc, db)
+    versions = {key: NO_VERSION for key in keys}
+    for dv_dict in DV_COLL.find({"key": {"$in": keys}}, {"_id": 0, "key": 1, "ver": 1}):
+        versions[dv_dict["key"]] = str(dv_dict["ver"])
+    return versions
+
+
+async def find_data_version_async(key: str, db: AsyncIOMotorDatabase) -> str:
+    DV_COLL = get_async_collection(DataVersionDoc, db)
+    dv_dict = await DV_COLL.find_one({"key": key}, {"_id": 0, "ver": 1})
+    if dv_dict is None:
+        return NO_VERSION
+    return str(dv_dict["ver"])
+
+
+def bump_data_version(key: str, db: Database) -> str:
+    DV_COLL = get_collection(DataVersionDoc, db)
+    ver = ObjectId()
+    _ = DV_COLL.update_one(
+        {"key": key},
+        {"$set": {"ver": ver, "updated_at": datetime.now()}},
+        upsert=True
+    )
+    for listener in _listeners:
+        listener(db.name, key)
+    return str(ver)
+
+
+def delete_data_version(key: str, db: Database) -> None:
+    DV_COLL = get_collection(DataVersionDoc, db)
+    _ = DV_COLL.delete_one({"key": key})
+    for listener in _listeners:
+        listener(db.name, key)
@@ -0,0 +1,403 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from threading import Lock
+import numpy as np
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo.database import Database
+
+from app.db.data_versions_collection import (
+    add_data_version_listener,
+    find_data_version,
+    species_data_key,
+)
+from app.db.sample_dictionaries_collection import find_sample_labels, sample_labels_of
+from app.db.setup import get_collection
+from app.models.gene import GeneDoc
+from app.models.sample_annotation import (
+    CoexpressedGene,
+    CoexpressionMethod,
+    ExpressionHeatmap,
+    ExpressionHeatmapIn,
+    GeneCoexpression,
+    GeneExpression,
+    PackedSamples,
+    Sample,
+    SampleAnnotationDoc,
+    SampleAnnotationRank,
+)
+from app.utils.stats import cluster_order, compute_spm, rank_rows, standardize_rows
+from config import settings
+
+#
+# Per species expression matrices, materialised as .npy files and memory mapped
+#   so that all worker processes share one page cache copy of them
+# Files are keyed by the species data version, under
+#   EXPRESSION_CACHE_DIR/<db name>/<species id>/<data version>/
+#     meta.json           row (gene) and column (sample, annotation label) headers
+#     tpm.npy             genes x samples TPM, float32, NaN where a gene has no value
+#     avg_tpm.<i>.npy     genes x annotation labels avg_tpm of the i-th annotation type
+#     coexpression.<method>.npy   genes x samples, see get_coexpression_matrix
+# The data version is rechecked at most every EXPRESSION_CACHE_TTL seconds,
+#   so lookups in between cost no DB round trip
+# Directories of older versions are removed EXPRESSION_CACHE_GRACE seconds after
+#   a newer version is first seen (see __remove_superseded)
+#
+
+
+@dataclass
+class SpeciesExpression:
+    version: str
+    path: str
+    gene_ids: list[ObjectId]
+    gene_labels: list[str | None]
+    sample_labels: list[str]
+    annotation_labels: dict[str, list[str]]
+    tpm: np.ndarray
+    avg_tpm: dict[str, np.ndarray]
+    checked_at: float = field(default_factory=time.monotonic)
+    coexpression: dict[CoexpressionMethod, np.ndarray] = field(default_factory=dict)
+    gene_rows: dict[str, int] = field(init=False)
+
+    def __post_init__(self):
+        self.gene_rows = {
+            label: row for row, label in enumerate(self.gene_labels) if label is not None
+        }
+
+
+SUPERSEDED_MARKER = ".superseded"
+#   file of a version directory, dated when a newer version was first seen
+
+_cache: dict[tuple[str, str], SpeciesExpression] = {}
+_build_locks: dict[tuple[str, str], Lock] = defaultdict(Lock)
+
+
+def __drop_cached(db_name: str, key: str | None) -> None:
+    for cache_key in [cache_key for cache_key in list(_cache) if cache_key[0] == db_name]:
+        if key is None or cache_key[1] == key:
+            _ = _cache.pop(cache_key, None)
+
+
+add_data_version_listener(__drop_cached)
+
+
+def __species_dir(species_id: ObjectId, db: Database) -> str:
+    return os.path.join(settings.EXPRESSION_CACHE_DIR, db.name, str(species_id))
+
+
+def __build(species_id: ObjectId, path: str, db: Database) -> None:
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    GENES_COLL = get_collection(GeneDoc, db)
+    # First pass, over labels only: shape and headers of the matrices
+    gene_index: dict[ObjectId, int] = {}
+    sample_index: dict[str, int] = {}
+    label_index: dict[str, dict[str, int]] = defaultdict(dict)
+    for sa_dict in SA_COLL.find(
+        {"spe_id": species_id},
+        {"spe_id": 1, "g_id": 1, "type": 1, "label": 1, "samples.label": 1, "s_idx": 1}
+    ):
+        _ = gene_index.setdefault(sa_dict["g_id"], len(gene_index))
+        type_labels = label_index[sa_dict["type"]]
+        _ = type_labels.setdefault(sa_dict["label"], len(type_labels))
+        for sample_label in sample_labels_of(sa_dict, db):
+            _ = sample_index.setdefault(sample_label, len(sample_index))
+    gene_labels: dict[ObjectId, str] = {
+        gene_dict["_id"]: gene_dict["label"]
+        for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"label": 1})
+    }
+    annotation_types = list(label_index)
+    # Second pass: fill the matrices, written straight to disk
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_path)
+    tpm = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "tpm.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(gene_index), len(sample_index))
+    )
+    tpm[:] = np.nan
+    avg_tpm = []
+    for i, annotation_type in enumerate(annotation_types):
+        avg_tpm.append(np.lib.format.open_memmap(
+            os.path.join(tmp_path, f"avg_tpm.{i}.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(gene_index), len(label_index[annotation_type]))
+        ))
+        avg_tpm[i][:] = np.nan
+    type_index = {annotation_type: i for i, annotation_type in enumerate(annotation_types)}
+    # Packed samples are placed by array ops, mapping dictionary indices to columns
+    dict_labels = find_sample_labels(species_id, db)
+    col_of_idx = np.array([sample_index.get(label, -1) for label in dict_labels], dtype=np.intp)
+    for sa_dict in SA_COLL.find({"spe_id": species_id}):
+        if sa_dict["g_id"] not in gene_index or sa_dict["type"] not in type_index:
+            continue  # written after the first pass, belongs to a newer data version
+        row = gene_index[sa_dict["g_id"]]
+        labels = label_index[sa_dict["type"]]
+        if sa_dict["label"] in labels:
+            avg_tpm[type_index[sa_dict["type"]]][row, labels[sa_dict["label"]]] = sa_dict.get("avg_tpm", 0)
+        if PackedSamples.is_packed(sa_dict):
+            indices = PackedSamples.indices(sa_dict)
+            known = indices < len(col_of_idx)
+            cols = col_of_idx[indices[known]]
+            tpm[row, cols[cols >= 0]] = PackedSamples.tpms(sa_dict)[known][cols >= 0]
+        else:
+            samples = [sample for sample in sa_dict.get("samples", []) if sample["label"] in sample_index]
+            tpm[row, [sample_index[sample["label"]] for sample in samples]] = [
+                sample["tpm"] for sample in samples
+            ]
+    tpm.flush()
+    for matrix in avg_tpm:
+        matrix.flush()
+    del tpm, avg_tpm
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "gene_ids": [str(gene_id) for gene_id in gene_index],
+            "gene_labels": [gene_labels.get(gene_id) for gene_id in gene_index],
+            "sample_labels": list(sample_index),
+            "annotation_types": annotation_types,
+            "annotation_labels": [list(label_index[annotation_type]) for annotation_type in annotation_types],
+        }, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another worker got there first with the same data version
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def __remove_superseded(path: str) -> None:
+    # Directories of older versions may still be used by workers that cached them
+    #   (co-expression matrices are built into them on first use, network builds
+    #   read them for minutes), so they are first marked superseded and only
+    #   removed EXPRESSION_CACHE_GRACE seconds later
+    species_dir = os.path.dirname(path)
+    now = time.time()
+    for entry in os.listdir(species_dir):
+        if entry == os.path.basename(path) or ".tmp-" in entry:
+            continue
+        marker = os.path.join(species_dir, entry, SUPERSEDED_MARKER)
+        try:
+            if now - os.path.getmtime(marker) > settings.EXPRESSION_CACHE_GRACE:
+                shutil.rmtree(os.path.join(species_dir, entry), ignore_errors=True)
+        except FileNotFoundError:
+            try:
+                open(marker, "a").close()
+            except FileNotFoundError:
+                pass  # removed by another worker meanwhile
+
+
+def __load(path: str, version: str) -> SpeciesExpression:
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return SpeciesExpression(
+        version=version,
+        path=path,
+        gene_ids=[ObjectId(gene_id) for gene_id in meta["gene_ids"]],
+        gene_labels=meta["gene_labels"],
+        sample_labels=meta["sample_labels"],
+        annotation_labels=dict(zip(meta["annotation_types"], meta["annotation_labels"])),
+        tpm=np.load(os.path.join(path, "tpm.npy"), mmap_mode="r"),
+        avg_tpm={
+            annotation_type: np.load(os.path.join(path, f"avg_tpm.{i}.npy"), mmap_mode="r")
+            for i, annotation_type in enumerate(meta["annotation_types"])
+        },
+    )
+
+
+def get_species_expression(species_id: ObjectId, db: Database) -> SpeciesExpression:
+    key = (db.name, species_data_key(species_id))
+    cached = _cache.get(key)
+    if cached is not None and time.monotonic() - cached.checked_at < settings.EXPRESSION_CACHE_TTL:
+        return cached
+    version = find_data_version(key[1], db)
+    if cached is not None and cached.version == version:
+        cached.checked_at = time.monotonic()
+        return cached
+    with _build_locks[key]:
+        path = os.path.join(__species_dir(species_id, db), version)
+        if not os.path.isdir(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            __build(species_id, path, db)
+        __remove_superseded(path)
+        expression = __load(path, version)
+        _cache[key] = expression
+    return expression
+
+
+#
+# Co-expression matrices, built on first use next to the expression matrices
+#   of the same data version: the rows of tpm (pearson) or of their ranks
+#   (spearman), standardized so that the correlations of one gene with all
+#   genes of the species are one matrix-vector product
+# Samples a gene has no value for count as 0 TPM
+#
+COEXPRESSION_BUILD_ROWS = 4096
+#   genes standardized at once while building a co-expression matrix
+
+
+def __build_coexpression(expression: SpeciesExpression, method: CoexpressionMethod, file_path: str) -> None:
+    tmp_path = f"{file_path}.tmp-{uuid.uuid4().hex}"
+    matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=expression.tpm.shape)
+    for start in range(0, expression.tpm.shape[0], COEXPRESSION_BUILD_ROWS):
+        values = np.nan_to_num(expression.tpm[start:start + COEXPRESSION_BUILD_ROWS].astype(np.float64), nan=0.0)
+        if method == CoexpressionMethod.SPEARMAN:
+            values = rank_rows(values)
+        matrix[start:start + COEXPRESSION_BUILD_ROWS] = standardize_rows(values)
+    matrix.flush()
+    del matrix
+    os.replace(tmp_path, file_path)
+
+
+def coexpression_matrix_path(expression: SpeciesExpression, method: CoexpressionMethod) -> str:
+    return os.path.join(expression.path, f"coexpression.{method.value}.npy")
+
+
+def get_coexpression_matrix(expression: SpeciesExpression, method: CoexpressionMethod) -> np.ndarray:
+    matrix = expression.coexpression.get(method)
+    if matrix is not None:
+        return matrix
+    file_path = coexpression_matrix_path(expression, method)
+    with _build_locks[(expression.path, method.value)]:
+        if not os.path.isfile(file_path):
+            __build_coexpression(expression, method, file_path)
+        matrix = np.load(file_path, mmap_mode="r")
+        expression.coexpression[method] = matrix
+    return matrix
+
+
+def __gene_row(expression: SpeciesExpression, gene_label: str) -> int:
+    row = expression.gene_rows.get(gene_label.upper())
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "gene_label": gene_label,
+                "description": f"no expression data for gene {gene_label}",
+                "recommendations": [
+                    "Ensure gene label is the main gene identifier label and not their alias",
+                    "Upload sample annotations for this gene first",
+                ],
+            }
+        )
+    return row
+
+
+def find_gene_expression(species_id: ObjectId, gene_label: str, db: Database) -> GeneExpression:
+    expression = get_species_expression(species_id, db)
+    row = __gene_row(expression, gene_label)
+    tpm = expression.tpm[row]
+    present = np.flatnonzero(~np.isnan(tpm))
+    return GeneExpression(
+        gene_id=expression.gene_ids[row],
+        gene_label=gene_label.upper(),
+        samples=[
+            Sample(sample_label=expression.sample_labels[col], tpm_value=round(value, settings.N_DECIMALS))
+            for col, value in zip(present.tolist(), tpm[present].tolist())
+        ],
+        annotations={
+            annotation_type: {
+                label: round(value, settings.N_DECIMALS)
+                for label, value in zip(expression.annotation_labels[annotation_type], matrix[row].tolist())
+                if not np.isnan(value)
+            }
+            for annotation_type, matrix in expression.avg_tpm.items()
+        }
+    )
+
+
+def find_gene_coexpression(
+    species_id: ObjectId,
+    gene_label: str,
+    method: CoexpressionMethod,
+    top: int,
+    db: Database
+) -> GeneCoexpression:
+    expression = get_species_expression(species_id, db)
+    row = __gene_row(expression, gene_label)
+    matrix = get_coexpression_matrix(expression, method)
+    profile = np.array(matrix[row])
+    if not profile.any():
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={
+                "gene_label": gene_label,
+                "description": f"gene {gene_label} has the same expression in all samples, it correlates with no gene",
+                "recommendations": [],
+            }
+        )
+    scores = np.clip(matrix @ profile, -1, 1)
+    scores[row] = -np.inf
+    top = min(top, len(scores) - 1)
+    # Partial selection of the top scores, only these are sorted
+    rows = np.argpartition(-scores, top - 1)[:top] if top > 0 else np.array([], dtype=np.intp)
+    rows = rows[np.argsort(-scores[rows], kind="stable")]
+    return GeneCoexpression(
+        gene_id=expression.gene_ids[row],
+        gene_label=gene_label.upper(),
+        method=method,
+        n_samples=matrix.shape[1],
+        genes=[
+            CoexpressedGene(
+                gene_id=expression.gene_ids[other_row],
+                gene_label=expression.gene_labels[other_row],
+                score=round(score, settings.N_DECIMALS)
+            )
+            for other_row, score in zip(rows.tolist(), scores[rows].tolist())
+        ]
+    )
+
+
+#
+# Genes x annotation labels heatmap of a type, sliced from the avg_tpm matrix
+#   of the type: one fancy indexing of the memory mapped file whatever the
+#   number of genes. SPM rows are recomputed from the avg_tpm rows, as stored.
+# values is a numpy array, encoded as nested lists (NaN as null) or sent as is
+#   by binary_matrix_response
+#
+def find_expression_heatmap(
+    species_id: ObjectId,
+    heatmap_in: ExpressionHeatmapIn,
+    db: Database
+) -> ExpressionHeatmap:
+    expression = get_species_expression(species_id, db)
+    avg_tpm = expression.avg_tpm.get(heatmap_in.annotation_type)
+    if avg_tpm is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "annotation_type": heatmap_in.annotation_type,
+                "description": f"no sample annotations of type {heatmap_in.annotation_type} in this species",
+                "recommendations": [
+                    "Check the annotation type, eg with the expression of one gene of the species",
+                ],
+            }
+        )
+    rows: list[int] = []
+    missing: list[str] = []
+    for gene_label in dict.fromkeys(label.upper() for label in heatmap_in.gene_labels):
+        row = expression.gene_rows.get(gene_label)
+        if row is None:
+            missing.append(gene_label)
+        else:
+            rows.append(row)
+    values = np.asarray(avg_tpm[rows], dtype=np.float64)
+    if heatmap_in.value == SampleAnnotationRank.SPM:
+        values = np.where(np.isnan(values), np.nan, compute_spm(values, settings.N_DECIMALS))
+    values = np.round(values, settings.N_DECIMALS)
+    if heatmap_in.cluster:
+        # avg_tpm spans orders of magnitude, profiles are compared on a log scale
+        order = cluster_order(values if heatmap_in.value == SampleAnnotationRank.SPM else np.log1p(values))
+        rows, values = [rows[i] for i in order.tolist()], values[order]
+    return ExpressionHeatmap.construct_from_db({
+        "annotation_type": heatmap_in.annotation_type,
+        "value": heatmap_in.value,
+        "gene_labels": [expression.gene_labels[row] for row in rows],
+        "annotation_labels": expression.annotation_labels[heatmap_in.annotation_type],
+        "values": values,
+        "missing_gene_labels": missing,
+    })
@@ -1,17 +1,24 @@
 import math
+from collections import defaultdict
+from itertools import islice
+from typing import AsyncIterator, Iterable, Iterator
 from fastapi import HTTPException, status
-from pymongo import ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
 from pymongo.database import Database
 from pymongo.errors import BulkWriteError
-from app.db.genes_collection import find_gene_id_from_label
+from app.db.genes_collection import add_annotations_to_genes, remove_annotation_from_genes
 
-from app.db.setup import get_collection
+from app.db.counts_collection import find_count
+from app.db.data_versions_collection import GENE_ANNOTATIONS_DATA_KEY, bump_data_version
+from app.db.gene_index import genes_not_found, get_gene_index, resolve_gene_labels
+from app.db.pagination import find_page, iter_by_ids, iter_sorted, page_size_of
+from app.db.setup import get_async_collection, get_collection
 from app.db.species_collection import find_species_id_from_taxid
-from app.models.gene import (
-    GeneDoc,
-)
 from app.models.gene_annotation import (
     GeneAnnotationDoc,
+    GeneAnnotationImportSummary,
     GeneAnnotationIn,
     GeneAnnotationOut,
     GeneAnnotationPage,
@@ -20,38 +27,65 @@ from app.models.gene_annotation import (
     GeneInput,
 )
 from app.models.shared import PyObjectId
+from app.utils.annotation_files import AnnotationRow
 from config import settings
 
 
-def find_all_gas(
+async def find_all_gas(
     page_num: int,
-    db: Database,
+    db: AsyncIOMotorDatabase,
     type: str | None = None,
     label: str | None = None,
+    cursor: str | None = None,
+    page_size: int | None = None
 ) -> GeneAnnotationPage:
-    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    GA_COLL = get_async_collection(GeneAnnotationDoc, db)
     # TODO: may not make sense to filter by labels, that would be a singular GET
     query_filters = {
         key: value
         for key, value in {"type": type, "label": label}.items()
         if value is not None
     }
-    ga_docs = [
-        GeneAnnotationOut(**gene_dict)
-        for gene_dict in GA_COLL.find(query_filters)
-        .skip((page_num - 1) * settings.PAGE_SIZE)
-        .limit(settings.PAGE_SIZE)
-    ]
-    return GeneAnnotationPage(
-        page_total=math.ceil(GA_COLL.estimated_document_count() / settings.PAGE_SIZE),
+    # Sorted along the unique (type, label) index
+    ga_dicts, next_cursor = await find_page(
+        GA_COLL, query_filters, ["type", "label"], page_num, cursor, page_size
+    )
+    return GeneAnnotationPage.construct(
+        page_total=math.ceil(
+            await find_count(GA_COLL, query_filters, GENE_ANNOTATIONS_DATA_KEY, db) / page_size_of(page_size)
+        ),
         curr_page=page_num,
-        payload=ga_docs
+        payload=[GeneAnnotationOut.construct_from_db(ga_dict) for ga_dict in ga_dicts],
+        next_cursor=next_cursor
     )
 
 
-def find_one_ga(type: str, label: str, db: Database) -> GeneAnnotationOut:
+async def iter_gas(
+    db: AsyncIOMotorDatabase,
+    type: str | None = None,
+    label: str | None = None
+) -> AsyncIterator[GeneAnnotationOut]:
+    # All matching GAs in page order, for streamed responses
+    GA_COLL = get_async_collection(GeneAnnotationDoc, db)
+    query_filters = {
+        key: value
+        for key, value in {"type": type, "label": label}.items()
+        if value is not None
+    }
+    async for ga_dict in iter_sorted(GA_COLL, query_filters, ["type", "label"]):
+        yield GeneAnnotationOut.construct_from_db(ga_dict)
+
+
+def iter_gas_by_ids(ga_ids: list[PyObjectId], db: Database) -> Iterator[GeneAnnotationOut]:
+    # Read back in the order of the batch rows
     GA_COLL = get_collection(GeneAnnotationDoc, db)
-    ga_dict = GA_COLL.find_one({"type": type, "label": label})
+    for ga_dict in iter_by_ids(GA_COLL, ga_ids):
+        yield GeneAnnotationOut.construct_from_db(ga_dict)
+
+
+async def find_one_ga(type: str, label: str, db: AsyncIOMotorDatabase) -> GeneAnnotationOut:
+    GA_COLL = get_async_collection(GeneAnnotationDoc, db)
+    ga_dict = await GA_COLL.find_one({"type": type, "label": label})
     if ga_dict is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -60,7 +94,7 @@ def find_one_ga(type: str, label: str, db: Database) -> GeneAnnotationOut:
                 "recommendations": []
             }
         )
-    return GeneAnnotationOut(**ga_dict)
+    return GeneAnnotationOut.construct_from_db(ga_dict)
 
 
 def check_if_ga_exists(type: str, label: str, db: Database) -> bool:
@@ -75,9 +109,143 @@ def insert_one_ga(ga_proc: GeneAnnotationProcessed, db: Database) -> GeneAnnotat
     GA_COLL = get_collection(GeneAnnotationDoc, db)
     to_insert = ga_proc.dict(exclude_none=True)
     _ = GA_COLL.insert_one(to_insert)
+    _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
     return GeneAnnotationOut(**to_insert)
 
 
+#
+# Batches of GAs are handled as sets, whatever their size:
+#   one $in query per annotation type for the existing (type, label) keys,
+#   one bulk write of the GA docs, one find for their ids
+#   and one bulk_write of the reverse links on genes (see add_annotations_to_genes)
+#
+def __ga_keys_filter(gas: Iterable[GeneAnnotationIn | GeneAnnotationProcessed]) -> dict:
+    labels_of_type: dict[str, set[str]] = defaultdict(set)
+    for ga in gas:
+        labels_of_type[ga.type].add(ga.label)
+    return {"$or": [
+        {"type": type, "label": {"$in": list(labels)}}
+        for type, labels in labels_of_type.items()
+    ]}
+
+
+def find_existing_ga_keys(
+    gas: list[GeneAnnotationIn | GeneAnnotationProcessed],
+    db: Database
+) -> set[tuple[str, str]]:
+    if len(gas) == 0:
+        return set()
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    return {
+        (ga_dict["type"], ga_dict["label"])
+        for ga_dict in GA_COLL.find(__ga_keys_filter(gas), {"_id": 0, "type": 1, "label": 1})
+    }
+
+
+# The GA docs of a batch, in the order of the batch and once per (type, label)
+def __find_gas_of_procs(ga_procs: list[GeneAnnotationProcessed], db: Database) -> list[dict]:
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    ga_dict_of_key = {
+        (ga_dict["type"], ga_dict["label"]): ga_dict
+        for ga_dict in GA_COLL.find(__ga_keys_filter(ga_procs))
+    }
+    return [
+        ga_dict_of_key[key]
+        for key in dict.fromkeys((ga_proc.type, ga_proc.label) for ga_proc in ga_procs)
+        if key in ga_dict_of_key
+    ]
+
+
+def __link_genes_to_gas(ga_procs: list[GeneAnnotationProcessed], ga_dicts: list[dict], db: Database) -> None:
+    ga_id_of_key = {(ga_dict["type"], ga_dict["label"]): ga_dict["_id"] for ga_dict in ga_dicts}
+    ga_ids_of_gene: dict[PyObjectId, set[PyObjectId]] = defaultdict(set)
+    for ga_proc in ga_procs:
+        ga_id = ga_id_of_key.get((ga_proc.type, ga_proc.label))
+        if ga_id is None:
+            continue
+        for gene_id in ga_proc.gene_ids:
+            ga_ids_of_gene[gene_id].add(ga_id)
+    add_annotations_to_genes(
+        {gene_id: list(ga_ids) for gene_id, ga_ids in ga_ids_of_gene.items()},
+        db
+    )
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def __duplicate_key_indexes(e: BulkWriteError) -> set[int]:
+    # Indexes of the writes refused on an existing (type, label) key,
+    #   any other write error is raised again
+    if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+        raise e
+    return {error["index"] for error in e.details["writeErrors"]}
+
+
+def __bulk_upsert(GA_COLL: Collection, requests: list[ReplaceOne | UpdateOne]) -> None:
+    # Upserts racing with an insert of the same key by another writer fail on the
+    #   unique index, they are retried once and then match the inserted doc
+    try:
+        _ = GA_COLL.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        failed_indexes = __duplicate_key_indexes(e)
+        _ = GA_COLL.bulk_write([requests[i] for i in sorted(failed_indexes)], ordered=False)
+
+
+def __last_of_each_key(ga_procs: list[GeneAnnotationProcessed]) -> list[GeneAnnotationProcessed]:
+    # Batches repeating a (type, label) keep its last GA, as successive replacements would
+    return list({(ga_proc.type, ga_proc.label): ga_proc for ga_proc in ga_procs}.values())
+
+
+# Only GAs whose (type, label) is new are inserted, the first one of the batch wins
+#   relink_existing: the genes of the GAs of the batch that exist already are
+#   linked to them too, for jobs retried after GAs were inserted but not linked
+#   returns the ids of the GAs inserted, see iter_gas_by_ids
+def insert_many_gas_in(
+    ga_input: list[GeneAnnotationIn],
+    skip_duplicates: bool,
+    db: Database,
+    relink_existing: bool = False
+) -> list[PyObjectId]:
+    existing_keys = find_existing_ga_keys(ga_input, db)
+    if skip_duplicates is False and len(existing_keys) > 0:
+        raise __gas_already_exist(existing_keys)
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    if relink_existing and len(existing_keys) > 0:
+        ga_ids_of_gene: dict[PyObjectId, list[PyObjectId]] = defaultdict(list)
+        for ga_dict in GA_COLL.find(
+            __ga_keys_filter(ga_in for ga_in in ga_input if (ga_in.type, ga_in.label) in existing_keys),
+            {"gene_ids": 1}
+        ):
+            for gene_id in ga_dict.get("gene_ids", []):
+                ga_ids_of_gene[gene_id].append(ga_dict["_id"])
+        add_annotations_to_genes(ga_ids_of_gene, db)
+    new_ga_of_key: dict[tuple[str, str], GeneAnnotationIn] = {}
+    for ga_in in ga_input:
+        key = (ga_in.type, ga_in.label)
+        if key not in existing_keys:
+            _ = new_ga_of_key.setdefault(key, ga_in)
+    if len(new_ga_of_key) == 0:
+        return []
+    ga_procs = convert_many_ga_in_to_ga_procs(list(new_ga_of_key.values()), db)
+    to_insert = [ga_proc.dict(exclude_none=True) for ga_proc in ga_procs]
+    failed_indexes = set()
+    try:
+        _ = GA_COLL.insert_many(to_insert, ordered=False)
+    except BulkWriteError as e:
+        # Keys inserted concurrently since the existence check are skipped
+        failed_indexes = __duplicate_key_indexes(e)
+    finally:
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    inserted = [ga_dict for i, ga_dict in enumerate(to_insert) if i not in failed_indexes]
+    __link_genes_to_gas(
+        [ga_proc for i, ga_proc in enumerate(ga_procs) if i not in failed_indexes],
+        inserted,
+        db
+    )
+    return [ga_dict["_id"] for ga_dict in inserted]
+
+
 # FIXME DEPRECATED
 def insert_many_gas(ga_procs: list[GeneAnnotationProcessed], db: Database) -> list[GeneAnnotationOut]:
     GA_COLL = get_collection(GeneAnnotationDoc, db)
@@ -102,47 +270,57 @@ def insert_many_gas(ga_procs: list[GeneAnnotationProcessed], db: Database) -> li
             "_id": {"$in": new_ids}
         })
         return [GeneAnnotationOut(**doc) for doc in pointer]
+    finally:
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
 
 
+# Existing GA docs are replaced, gene reverse links are kept and completed
+#   only genes of the GA kept for each key are linked to it
 def insert_or_replace_many_gas(ga_proc_list: list[GeneAnnotationProcessed], db: Database) -> list[GeneAnnotationOut]:
+    if len(ga_proc_list) == 0:
+        return []
+    ga_proc_list = __last_of_each_key(ga_proc_list)
     GA_COLL = get_collection(GeneAnnotationDoc, db)
-    final_docs = []
-    for ga_proc in ga_proc_list:
-        # gene_doc = GeneProcessed(
-        #     species_id=species_id,
-        #     **gene_in.dict_for_db()
-        # )
-        # # BUG: annotations array will be reset! If don't want to reset, use patch instead
-        to_write = ga_proc.dict_for_db()
-        result = GA_COLL.replace_one(
-            {"type": ga_proc.type, "label": ga_proc.label},
-            to_write,
-            upsert=True
-        )
-        to_write["_id"] = result.upserted_id
-        final_docs.append(to_write)
-        # BUG: _id is not updated in the dict
-    return final_docs
+    try:
+        __bulk_upsert(GA_COLL, [
+            ReplaceOne(
+                {"type": ga_proc.type, "label": ga_proc.label},
+                ga_proc.dict_for_db(),
+                upsert=True
+            )
+            for ga_proc in ga_proc_list
+        ])
+    finally:
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    ga_dicts = __find_gas_of_procs(ga_proc_list, db)
+    __link_genes_to_gas(ga_proc_list, ga_dicts, db)
+    return [GeneAnnotationOut.construct_from_db(ga_dict) for ga_dict in ga_dicts]
 
 
-def insert_one_new_ga_or_append_gene_ids(
-    ga_proc: GeneAnnotationProcessed,
-    db: Database
-) -> GeneAnnotationOut:
+# New GA docs are inserted, existing ones get the new gene ids appended
+#   (their details are kept)
+def insert_or_append_many_gas(ga_procs: list[GeneAnnotationProcessed], db: Database) -> list[GeneAnnotationOut]:
+    if len(ga_procs) == 0:
+        return []
     GA_COLL = get_collection(GeneAnnotationDoc, db)
-    ga_dict = GA_COLL.find_one({"type": ga_proc.type, "label": ga_proc.label})
-    if ga_dict is None:
-        return insert_one_ga(ga_proc, db)
-    updated = GA_COLL.find_one_and_update(
-        {"type": ga_proc.type, "label": ga_proc.label},
-        {
-            "$addToSet": {"gene_ids": {"$each": ga_proc.gene_ids}},
-            # "$setOnInsert": ga_proc.dict_for_db()
-        },
-        # upsert=True,
-        return_document=ReturnDocument.AFTER
-    )
-    return GeneAnnotationOut(**updated)
+    try:
+        __bulk_upsert(GA_COLL, [
+            UpdateOne(
+                {"type": ga_proc.type, "label": ga_proc.label},
+                {
+                    "$addToSet": {"gene_ids": {"$each": ga_proc.gene_ids}},
+                    # Empty $setOnInsert is rejected by MongoDB
+                    **({"$setOnInsert": {"details": ga_proc.details}} if ga_proc.details is not None else {}),
+                },
+                upsert=True
+            )
+            for ga_proc in ga_procs
+        ])
+    finally:
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    ga_dicts = __find_gas_of_procs(ga_procs, db)
+    __link_genes_to_gas(ga_procs, ga_dicts, db)
+    return [GeneAnnotationOut.construct_from_db(ga_dict) for ga_dict in ga_dicts]
 
 
 def delete_one_ga(ga_type: str, label: str, db: Database):
@@ -159,6 +337,9 @@ def delete_one_ga(ga_type: str, label: str, db: Database):
                 "recommendations": [],
             }
         )
+    # Reverse links are removed from the genes the GA references
+    remove_annotation_from_genes(deleted["_id"], deleted.get("gene_ids", []), db)
+    _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
     return GeneAnnotationOut(**deleted)
 
 
@@ -169,31 +350,30 @@ def update_one_ga(ga_type: str, label: str, updates: GeneAnnotationUpdate, db: D
         {"$set": updates.dict_for_update()},
         return_document=ReturnDocument.AFTER
     )
+    _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
     return GeneAnnotationOut(**updated)
 
 
+def __gas_already_exist(existing_keys: set[tuple[str, str]]) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail={
+            "existing_gene_annotations": [
+                {"type": type, "label": label} for type, label in sorted(existing_keys)
+            ],
+            "description": "Some gene annotations already exists.",
+            "recommendations": [
+                "Use the update endpoint to update this record",
+                "Or use the delete enpoint to delete this record before posting a new one"
+            ]
+        }
+    )
+
+
 def enforce_no_existing_gas(gas_in: list[GeneAnnotationIn], db: Database) -> None:
-    GA_COLL = get_collection(GeneAnnotationDoc, db)
-    existing = []
-    for ga_in in gas_in:
-        ga_dict = GA_COLL.find_one(
-            {"type": ga_in.type, "label": ga_in.label},
-            {"_id": 0, "type": 1, "label": 1}
-        )
-        if ga_dict is not None:
-            existing.append(ga_dict)
-    if len(existing) > 0:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={
-                "existing_gene_annotations": existing,
-                "description": "Some gene annotations already exists.",
-                "recommendations": [
-                    "Use the update endpoint to update this record",
-                    "Or use the delete enpoint to delete this record before posting a new one"
-                ]
-            }
-        )
+    existing_keys = find_existing_ga_keys(gas_in, db)
+    if len(existing_keys) > 0:
+        raise __gas_already_exist(existing_keys)
 
 
 def enforce_no_existing_ga(ga_in: GeneAnnotationIn, db: Database) -> None:
@@ -212,32 +392,121 @@ def enforce_no_existing_ga(ga_in: GeneAnnotationIn, db: Database) -> None:
         )
 
 
-def gene_labels_to_ids(genes: list[GeneInput], db: Database) -> list[PyObjectId]:
-    GENE_COLL = get_collection(GeneDoc, db)
-    # TODO if gene not found, to return an array of error instead of raising only one at a time
-    query = []
+def __resolve_genes(genes: list[GeneInput], db: Database) -> dict[tuple[int, str], PyObjectId]:
+    #
+    # Labels are resolved per species through the in-memory gene index,
+    # every label not found is reported at once in a single 404
+    #
+    labels_of_taxid: dict[int, list[str]] = defaultdict(list)
     for gene in genes:
-        # These find methods will raise 404 if species or gene not found
-        spe_id = find_species_id_from_taxid(gene.taxid, db)
-        _ = find_gene_id_from_label(spe_id, gene.gene_label, db)
-        query.append({
-            "spe_id": spe_id,
-            "label": gene.gene_label
-        })
-    if query == []:  # avoid pymongo.errors.OperationFailure
-        return query
-    cursor = GENE_COLL.find(
-        {"$or": query},
-        {"_id": 1}
-    )
-    return [doc["_id"] for doc in cursor]
+        labels_of_taxid[gene.taxid].append(gene.gene_label)
+    gene_ids: dict[tuple[int, str], PyObjectId] = {}
+    missing = []
+    for taxid, gene_labels in labels_of_taxid.items():
+        # Raises 404 if species not found
+        spe_id = find_species_id_from_taxid(taxid, db)
+        resolved, unresolved = resolve_gene_labels(spe_id, gene_labels, db)
+        gene_ids.update({(taxid, gene_label): gene_id for gene_label, gene_id in resolved.items()})
+        missing.extend({"taxid": taxid, "gene_label": gene_label} for gene_label in unresolved)
+    if len(missing) > 0:
+        raise genes_not_found(missing)
+    return gene_ids
 
 
-def convert_ga_in_to_ga_proc(ga_in: GeneAnnotationIn, db: Database) -> GeneAnnotationProcessed:
-    gene_ids = gene_labels_to_ids(ga_in.genes, db)
+def __ga_proc_of(ga_in: GeneAnnotationIn, gene_ids: dict[tuple[int, str], PyObjectId]) -> GeneAnnotationProcessed:
     return GeneAnnotationProcessed(
         type=ga_in.type,
         label=ga_in.label,
         details=ga_in.details,
-        gene_ids=gene_ids
+        gene_ids=list(dict.fromkeys(gene_ids[(gene.taxid, gene.gene_label)] for gene in ga_in.genes))
     )
+
+
+def gene_labels_to_ids(genes: list[GeneInput], db: Database) -> list[PyObjectId]:
+    gene_ids = __resolve_genes(genes, db)
+    return list(dict.fromkeys(gene_ids[(gene.taxid, gene.gene_label)] for gene in genes))
+
+
+def convert_ga_in_to_ga_proc(ga_in: GeneAnnotationIn, db: Database) -> GeneAnnotationProcessed:
+    return __ga_proc_of(ga_in, __resolve_genes(ga_in.genes, db))
+
+
+def convert_many_ga_in_to_ga_procs(ga_input: list[GeneAnnotationIn], db: Database) -> list[GeneAnnotationProcessed]:
+    # Genes of the whole batch are resolved at once, so that all missing labels are reported together
+    gene_ids = __resolve_genes([gene for ga_in in ga_input for gene in ga_in.genes], db)
+    return [__ga_proc_of(ga_in, gene_ids) for ga_in in ga_input]
+
+
+#
+# Species wide load of an annotation file, GA_IMPORT_CHUNK_ROWS rows at a time
+#   Rows of a chunk are grouped by annotation label, then
+#   - GA docs are upserted with the gene ids of their rows appended
+#   - genes get the reverse links to their GA docs
+#   each with one bulk_write, so that memory is bounded by the chunk
+#   (and the gene index of the species) whatever the size of the file.
+# Details of a GA are only set when it is created by the import.
+#
+def import_gene_annotations(
+    species_id: PyObjectId,
+    annotation_type: str,
+    rows: Iterable[AnnotationRow],
+    db: Database
+) -> GeneAnnotationImportSummary:
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    gene_index = get_gene_index(species_id, db)
+    summary = GeneAnnotationImportSummary(annotation_type=annotation_type)
+    labels_written: set[str] = set()
+    rows = iter(rows)
+    try:
+        while True:
+            chunk = list(islice(rows, settings.GA_IMPORT_CHUNK_ROWS))
+            if not chunk:
+                break
+            summary.n_rows += len(chunk)
+            gene_ids_of_label: dict[str, set[PyObjectId]] = defaultdict(set)
+            details_of_label: dict[str, dict] = {}
+            for row in chunk:
+                gene_id = next(
+                    (gene_id for gene_id in map(gene_index.gene_id_of, row.gene_labels) if gene_id is not None),
+                    None
+                )
+                if gene_id is None:
+                    summary.n_unresolved_rows += 1
+                    if len(summary.unresolved_gene_labels) < settings.GA_IMPORT_MAX_REPORTED \
+                            and row.gene_labels[0] not in summary.unresolved_gene_labels:
+                        summary.unresolved_gene_labels.append(row.gene_labels[0])
+                    continue
+                summary.n_gene_links += 1
+                gene_ids_of_label[row.label].add(gene_id)
+                _ = details_of_label.setdefault(row.label, row.details)
+            if len(gene_ids_of_label) == 0:
+                continue
+            _ = GA_COLL.bulk_write([
+                UpdateOne(
+                    {"type": annotation_type, "label": label},
+                    {
+                        "$addToSet": {"gene_ids": {"$each": list(gene_ids)}},
+                        "$setOnInsert": {"details": details_of_label[label]},
+                    },
+                    upsert=True
+                )
+                for label, gene_ids in gene_ids_of_label.items()
+            ], ordered=False)
+            labels_written.update(gene_ids_of_label)
+            ga_id_of_label = {
+                ga_dict["label"]: ga_dict["_id"]
+                for ga_dict in GA_COLL.find(
+                    {"type": annotation_type, "label": {"$in": list(gene_ids_of_label)}},
+                    {"label": 1}
+                )
+            }
+            ga_ids_of_gene: dict[PyObjectId, list[PyObjectId]] = defaultdict(list)
+            for label, gene_ids in gene_ids_of_label.items():
+                for gene_id in gene_ids:
+                    ga_ids_of_gene[gene_id].append(ga_id_of_label[label])
+            add_annotations_to_genes(ga_ids_of_gene, db)
+    finally:
+        if len(labels_written) > 0:
+            _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    summary.n_annotations = len(labels_written)
+    return summary
@@ -0,0 +1,288 @@
+import heapq
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Iterable, Iterator
+from bson import ObjectId
+from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+
+from app.db.data_versions_collection import (
+    add_data_version_listener,
+    find_data_version,
+    find_data_version_async,
+    find_data_versions,
+    species_genes_data_key,
+)
+from app.db.setup import get_async_collection, get_collection
+from app.db.species_registry import get_species_registry
+from app.models.gene import GeneCompletion, GeneDoc
+from config import settings
+
+#
+# Per species in-memory index of gene labels and aliases -> gene ObjectId
+#   Built from the genes collection on first use, dropped on gene writes made
+#   by this process and checked against the species' genes data version at most
+#   every GENE_INDEX_TTL seconds, or right away when a label is not found.
+#   At most GENE_INDEX_MAX_SPECIES indexes are kept, least recently used first out.
+# Labels and all aliases of a species are also kept as one sorted array, for
+#   prefix searches by binary search (see complete_gene_labels). These are kept
+#   for every species searched, outside of the LRU: kingdom wide searches go
+#   through all of them at each keystroke.
+#
+
+
+@dataclass
+class GeneIndex:
+    version: str
+    by_label: dict[str, ObjectId]
+    by_alias: dict[str, ObjectId]
+    #   upper cased aliases shared by a single gene only
+    checked_at: float = field(default_factory=time.monotonic)
+    label_of: dict[ObjectId, str] = field(init=False)
+
+    def __post_init__(self):
+        self.label_of = {gene_id: label for label, gene_id in self.by_label.items()}
+
+    def gene_id_of(self, gene_label: str) -> ObjectId | None:
+        gene_label = gene_label.upper()
+        gene_id = self.by_label.get(gene_label)
+        if gene_id is None:
+            gene_id = self.by_alias.get(gene_label)
+        return gene_id
+
+
+@dataclass
+class GenePrefixes:
+    version: str
+    keys: list[str]
+    #   upper cased labels and aliases, sorted
+    gene_ids: list[ObjectId]
+    #   gene of each key, at the same position
+    label_of: dict[ObjectId, str]
+    checked_at: float = field(default_factory=time.monotonic)
+
+    def iter_prefixed(self, prefix: str) -> Iterator[tuple[str, ObjectId]]:
+        # (label or alias, gene id) of the keys starting with prefix, in key order
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                return
+            yield self.keys[i], self.gene_ids[i]
+
+
+_indexes: OrderedDict[tuple[str, ObjectId], GeneIndex] = OrderedDict()
+_prefixes: dict[tuple[str, ObjectId], GenePrefixes] = {}
+_lock = Lock()
+
+
+def __drop_index(db_name: str, key: str | None) -> None:
+    with _lock:
+        for cache in (_indexes, _prefixes):
+            for index_key in [index_key for index_key in cache if index_key[0] == db_name]:
+                if key is None or species_genes_data_key(index_key[1]) == key:
+                    _ = cache.pop(index_key, None)
+
+
+add_data_version_listener(__drop_index)
+
+
+def __index_of(version: str, gene_dicts: Iterable[dict]) -> GeneIndex:
+    by_label: dict[str, ObjectId] = {}
+    genes_of_alias: dict[str, set[ObjectId]] = defaultdict(set)
+    for gene_dict in gene_dicts:
+        by_label[gene_dict["label"]] = gene_dict["_id"]
+        for alias in gene_dict.get("alias", []):
+            genes_of_alias[alias.upper()].add(gene_dict["_id"])
+    return GeneIndex(
+        version=version,
+        by_label=by_label,
+        by_alias={
+            alias: next(iter(gene_ids))
+            for alias, gene_ids in genes_of_alias.items()
+            if len(gene_ids) == 1 and alias not in by_label
+        }
+    )
+
+
+def __prefixes_of(version: str, gene_dicts: Iterable[dict]) -> GenePrefixes:
+    entries: list[tuple[str, ObjectId]] = []
+    label_of: dict[ObjectId, str] = {}
+    for gene_dict in gene_dicts:
+        label_of[gene_dict["_id"]] = gene_dict["label"]
+        entries.append((gene_dict["label"], gene_dict["_id"]))
+        entries.extend((alias, gene_dict["_id"]) for alias in {alias.upper() for alias in gene_dict.get("alias", [])})
+    entries.sort()
+    return GenePrefixes(
+        version=version,
+        keys=[key for key, _ in entries],
+        gene_ids=[gene_id for _, gene_id in entries],
+        label_of=label_of
+    )
+
+
+def __is_fresh(index: GeneIndex | GenePrefixes | None) -> bool:
+    return index is not None and time.monotonic() - index.checked_at < settings.GENE_INDEX_TTL
+
+
+def __keep(key: tuple[str, ObjectId], index: GeneIndex) -> None:
+    index.checked_at = time.monotonic()
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > settings.GENE_INDEX_MAX_SPECIES:
+            _ = _indexes.popitem(last=False)
+
+
+def get_gene_index(species_id: ObjectId, db: Database, recheck: bool = False) -> GeneIndex:
+    # recheck: skip the TTL, eg when a label is missing from the index
+    key = (db.name, species_id)
+    index = _indexes.get(key)
+    if not recheck and __is_fresh(index):
+        return index
+    # The version is read first, so that an index is never newer than its version
+    version = find_data_version(species_genes_data_key(species_id), db)
+    if index is None or index.version != version:
+        GENES_COLL = get_collection(GeneDoc, db)
+        index = __index_of(version, GENES_COLL.find({"spe_id": species_id}, {"label": 1, "alias": 1}))
+    __keep(key, index)
+    return index
+
+
+async def get_gene_index_async(species_id: ObjectId, db: AsyncIOMotorDatabase, recheck: bool = False) -> GeneIndex:
+    key = (db.name, species_id)
+    index = _indexes.get(key)
+    if not recheck and __is_fresh(index):
+        return index
+    version = await find_data_version_async(species_genes_data_key(species_id), db)
+    if index is None or index.version != version:
+        GENES_COLL = get_async_collection(GeneDoc, db)
+        index = __index_of(version, [
+            gene_dict async for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"label": 1, "alias": 1})
+        ])
+    __keep(key, index)
+    return index
+
+
+def get_gene_prefixes(species_ids: list[ObjectId], db: Database) -> dict[ObjectId, GenePrefixes]:
+    # Versions of the arrays due a check are read with one query, and only
+    #   the arrays of species whose genes changed are rebuilt
+    prefixes = {species_id: _prefixes.get((db.name, species_id)) for species_id in dict.fromkeys(species_ids)}
+    to_check = [species_id for species_id, species_prefixes in prefixes.items() if not __is_fresh(species_prefixes)]
+    if len(to_check) == 0:
+        return prefixes
+    versions = find_data_versions([species_genes_data_key(species_id) for species_id in to_check], db)
+    GENES_COLL = get_collection(GeneDoc, db)
+    for species_id in to_check:
+        version = versions[species_genes_data_key(species_id)]
+        species_prefixes = prefixes[species_id]
+        if species_prefixes is None or species_prefixes.version != version:
+            species_prefixes = __prefixes_of(
+                version,
+                GENES_COLL.find({"spe_id": species_id}, {"label": 1, "alias": 1})
+            )
+        species_prefixes.checked_at = time.monotonic()
+        prefixes[species_id] = species_prefixes
+        with _lock:
+            _prefixes[(db.name, species_id)] = species_prefixes
+    return prefixes
+
+
+def warm_gene_indexes(db: Database) -> int:
+    # Builds the indexes of the first GENE_INDEX_MAX_SPECIES species, eg at startup
+    species_list = get_species_registry(db).species[:settings.GENE_INDEX_MAX_SPECIES]
+    for species in species_list:
+        _ = get_gene_index(species.id, db)
+    return len(species_list)
+
+
+#
+# Autocomplete over the labels and aliases of the genes of some species
+#   The prefix array of each species yields its keys starting with the prefix
+#   in order, the species are merged by key and the first `limit` genes kept,
+#   each once
+#
+def complete_gene_labels(
+    species_ids: list[ObjectId],
+    prefix: str,
+    limit: int,
+    db: Database
+) -> list[GeneCompletion]:
+    prefix = prefix.upper()
+    registry = get_species_registry(db)
+    prefixes = get_gene_prefixes(species_ids, db)
+    prefixed = heapq.merge(*(
+        ((key, species_id, gene_id) for key, gene_id in species_prefixes.iter_prefixed(prefix))
+        for species_id, species_prefixes in prefixes.items()
+    ), key=lambda entry: entry[0])
+    seen: set[ObjectId] = set()
+    completions: list[GeneCompletion] = []
+    for key, species_id, gene_id in prefixed:
+        if gene_id in seen:
+            continue
+        seen.add(gene_id)
+        completions.append(GeneCompletion(
+            taxid=registry.by_id[species_id].tax,
+            gene_id=gene_id,
+            gene_label=prefixes[species_id].label_of[gene_id],
+            matched=key
+        ))
+        if len(completions) == limit:
+            break
+    return completions
+
+
+def genes_not_found(missing: list[dict]) -> HTTPException:
+    # missing: [{"taxid": ..., "gene_label": ...}]
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={
+            "missing_genes": missing,
+            "description": f"{len(missing)} gene label(s) not found",
+            "recommendations": [
+                "Ensure gene labels are the main gene identifier labels, or aliases shared by no other gene",
+                "If genes have not been inserted into database, "
+                "insert genes into the DB via the post_many_genes_by_species POST request endpoint",
+            ],
+        }
+    )
+
+
+def __resolve(index: GeneIndex, gene_labels: Iterable[str]) -> tuple[dict[str, ObjectId], list[str]]:
+    resolved: dict[str, ObjectId] = {}
+    unresolved: list[str] = []
+    for gene_label in gene_labels:
+        gene_id = index.gene_id_of(gene_label)
+        if gene_id is None:
+            unresolved.append(gene_label)
+        else:
+            resolved[gene_label] = gene_id
+    return resolved, unresolved
+
+
+def resolve_gene_labels(
+    species_id: ObjectId,
+    gene_labels: list[str],
+    db: Database
+) -> tuple[dict[str, ObjectId], list[str]]:
+    # Returns the gene ids of the labels found, and the labels not found
+    resolved, unresolved = __resolve(get_gene_index(species_id, db), dict.fromkeys(gene_labels))
+    if len(unresolved) > 0:
+        # May have been inserted by another process since the last check
+        resolved_now, unresolved = __resolve(get_gene_index(species_id, db, recheck=True), unresolved)
+        resolved.update(resolved_now)
+    return resolved, unresolved
+
+
+async def resolve_gene_labels_async(
+    species_id: ObjectId,
+    gene_labels: list[str],
+    db: AsyncIOMotorDatabase
+) -> tuple[dict[str, ObjectId], list[str]]:
+    resolved, unresolved = __resolve(await get_gene_index_async(species_id, db), dict.fromkeys(gene_labels))
+    if len(unresolved) > 0:
+        resolved_now, unresolved = __resolve(await get_gene_index_async(species_id, db, recheck=True), unresolved)
+        resolved.update(resolved_now)
+    return resolved, unresolved
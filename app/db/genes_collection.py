@@ -1,10 +1,22 @@
 import math
+from typing import AsyncIterator, Iterator
 from fastapi import HTTPException, status
-from pymongo import ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
 from pymongo.database import Database
 from pymongo.errors import BulkWriteError
 
-from app.db.setup import get_collection
+from app.db.counts_collection import find_count
+from app.db.data_versions_collection import (
+    GENE_ANNOTATIONS_DATA_KEY,
+    bump_data_version,
+    bump_sample_annotation_labels,
+    species_data_key,
+    species_genes_data_key,
+)
+from app.db.gene_index import resolve_gene_labels, resolve_gene_labels_async
+from app.db.pagination import find_page, iter_by_ids, iter_sorted, page_size_of
+from app.db.setup import get_async_collection, get_collection
 from app.db.species_collection import find_species_id_from_taxid
 from app.models.gene import (
     GeneDoc,
@@ -13,42 +25,72 @@ from app.models.gene import (
     GenePage,
     GeneProcessed,
 )
+from app.models.coexpression_network import CoexpressionNeighboursDoc
+from app.models.gene_annotation import GeneAnnotationDoc
+from app.models.sample_annotation import SampleAnnotationDoc
 from app.models.shared import PyObjectId
-from config import settings
 
 
-def find_all_genes_by_species(
-    species_id: PyObjectId, page_num: int, db: Database
+async def find_all_genes_by_species(
+    species_id: PyObjectId,
+    page_num: int,
+    db: AsyncIOMotorDatabase,
+    cursor: str | None = None,
+    page_size: int | None = None
 ) -> GenePage:
-    GENES_COLL = get_collection(GeneDoc, db)
-    gene_docs = [
-        GeneOut(**gene_dict)
-        for gene_dict in GENES_COLL.find({"spe_id": species_id})
-        .skip((page_num - 1) * settings.PAGE_SIZE)
-        .limit(settings.PAGE_SIZE)
-    ]
-    return GenePage(
-        page_total=math.ceil(GENES_COLL.estimated_document_count() / settings.PAGE_SIZE),
+    GENES_COLL = get_async_collection(GeneDoc, db)
+    # Sorted by label, along the unique (spe_id, label) index
+    gene_dicts, next_cursor = await find_page(
+        GENES_COLL, {"spe_id": species_id}, ["label"], page_num, cursor, page_size
+    )
+    return GenePage.construct(
+        page_total=math.ceil(
+            await find_count(GENES_COLL, {"spe_id": species_id}, species_genes_data_key(species_id), db)
+            / page_size_of(page_size)
+        ),
         curr_page=page_num,
-        payload=gene_docs
+        payload=[GeneOut.construct_from_db(gene_dict) for gene_dict in gene_dicts],
+        next_cursor=next_cursor
     )
 
 
+def __bump_genes_data_version(species_id: PyObjectId, db: Database) -> None:
+    # Gene writes change the species data and the gene labels of the species
+    _ = bump_data_version(species_data_key(species_id), db)
+    _ = bump_data_version(species_genes_data_key(species_id), db)
+
+
 def insert_one_gene(gene_processed: GeneProcessed, db: Database):
     GENES_COLL = get_collection(GeneDoc, db)
     to_insert = gene_processed.dict_for_db()
     _ = GENES_COLL.insert_one(to_insert)
+    __bump_genes_data_version(gene_processed.spe_id, db)
     return GeneOut(**to_insert)
 
 
+async def iter_genes_by_species(species_id: PyObjectId, db: AsyncIOMotorDatabase) -> AsyncIterator[GeneOut]:
+    # All genes of the species in page order, for streamed responses
+    GENES_COLL = get_async_collection(GeneDoc, db)
+    async for gene_dict in iter_sorted(GENES_COLL, {"spe_id": species_id}, ["label"]):
+        yield GeneOut.construct_from_db(gene_dict)
+
+
+def iter_genes_by_ids(gene_ids: list[PyObjectId], db: Database) -> Iterator[GeneOut]:
+    # Read back in the order of the batch rows
+    GENES_COLL = get_collection(GeneDoc, db)
+    for gene_dict in iter_by_ids(GENES_COLL, gene_ids):
+        yield GeneOut.construct_from_db(gene_dict)
+
+
 def insert_many_genes(
     genes_processed: list[GeneProcessed],
     db: Database
-) -> list[GeneOut]:
+) -> list[PyObjectId]:
     #
     # Species Mongo ID should already be updated in genes_in list
     # before passing to this function.
     # This is validated by the GeneProcessed Pydantic model.
+    # Returns the ids of the newly inserted genes, see iter_genes_by_ids
     #
     GENES_COLL = get_collection(GeneDoc, db)
     to_insert = [gene.dict(exclude_none=True) for gene in genes_processed]
@@ -57,21 +99,34 @@ def insert_many_genes(
             to_insert,
             ordered=False
         )
-        pointer = GENES_COLL.find({
-            "_id": {"$in": result.inserted_ids}
-        })
-        return [GeneOut(**doc) for doc in pointer]
+        return result.inserted_ids
     except BulkWriteError as e:
         print(f"Only {e.details['nInserted']} / {len(to_insert)} genes are newly inserted into the genes collection")
         print(f"writeErrors: {e.details['writeErrors']}")
         # Return only newly inserted documents
-        existing_ids = [doc['op']['_id'] for doc in e.details['writeErrors']]
-        to_insert_ids = [doc['_id'] for doc in to_insert]
-        new_ids = list(set(to_insert_ids) - set(existing_ids))
-        pointer = GENES_COLL.find({
-            "_id": {"$in": new_ids}
-        })
-        return [GeneOut(**doc) for doc in pointer]
+        existing_ids = {doc['op']['_id'] for doc in e.details['writeErrors']}
+        return [doc['_id'] for doc in to_insert if doc['_id'] not in existing_ids]
+    finally:
+        for species_id in {gene.spe_id for gene in genes_processed}:
+            __bump_genes_data_version(species_id, db)
+
+
+def insert_many_genes_in(
+    species_id: PyObjectId,
+    genes_in: list[GeneIn],
+    skip_duplicates: bool,
+    db: Database
+) -> list[PyObjectId]:
+    if skip_duplicates is False:
+        enforce_no_existing_genes(species_id, genes_in, db)
+    genes_processed: list[GeneProcessed] = [
+        GeneProcessed(
+            **gene_in.dict(by_alias=True, exclude_none=True),
+            species_id=species_id
+        )
+        for gene_in in genes_in
+    ]
+    return insert_many_genes(genes_processed, db)
 
 
 def insert_or_replace_many_genes(
@@ -95,16 +150,14 @@ def insert_or_replace_many_genes(
         )
         final_docs.append(to_write)
         # BUG: _id is not updated in the dict
+    __bump_genes_data_version(species_id, db)
     return final_docs
 
 
 def delete_one_gene(taxid: int, gene_label: str, db: Database) -> GeneOut:
     GENES_COLL = get_collection(GeneDoc, db)
     species_id = find_species_id_from_taxid(taxid, db)
-    deleted = GENES_COLL.find_one_and_delete(
-        {"spe_id": species_id, "label": gene_label},
-        {"_id": 0}
-    )
+    deleted = GENES_COLL.find_one_and_delete({"spe_id": species_id, "label": gene_label})
     if deleted is None:
         raise HTTPException(
             status_code=404,
@@ -114,6 +167,26 @@ def delete_one_gene(taxid: int, gene_label: str, db: Database) -> GeneOut:
                 "recommendations": [],
             }
         )
+    # Associated resources: references from gene annotations and SA docs of the gene
+    ga_result = get_collection(GeneAnnotationDoc, db).update_many(
+        {"gene_ids": deleted["_id"]},
+        {"$pull": {"gene_ids": deleted["_id"]}}
+    )
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    sa_labels = [
+        (sa_dict["type"], sa_dict["label"])
+        for sa_dict in SA_COLL.find({"spe_id": species_id, "g_id": deleted["_id"]}, {"type": 1, "label": 1})
+    ]
+    sa_result = SA_COLL.delete_many({"spe_id": species_id, "g_id": deleted["_id"]})
+    # Neighbours of other genes still listing it go with the next network build
+    _ = get_collection(CoexpressionNeighboursDoc, db).delete_one(
+        {"spe_id": species_id, "g_id": deleted["_id"]}
+    )
+    __bump_genes_data_version(species_id, db)
+    if ga_result.modified_count > 0:
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    if sa_result.deleted_count > 0:
+        bump_sample_annotation_labels(sa_labels, db)
     return GeneOut(**deleted)
 
 
@@ -124,6 +197,7 @@ def update_one_gene(species_id: PyObjectId, gene_label: str, updates: GeneIn, db
         {"$set": updates.dict(exclude_unset=True)},
         return_document=ReturnDocument.AFTER
     )
+    __bump_genes_data_version(species_id, db)
     return GeneOut(**updated)
 
 
@@ -136,6 +210,25 @@ def add_annotations_to_gene(gene_id: PyObjectId, ga_ids: list[PyObjectId], db: D
     return updated
 
 
+# Reverse links of many GAs in one bulk_write
+#   ga_ids_of_gene: the ids of the GA docs to reference from each gene
+def add_annotations_to_genes(ga_ids_of_gene: dict[PyObjectId, list[PyObjectId]], db: Database) -> None:
+    if len(ga_ids_of_gene) == 0:
+        return
+    GENES_COLL = get_collection(GeneDoc, db)
+    _ = GENES_COLL.bulk_write([
+        UpdateOne({"_id": gene_id}, {"$addToSet": {"anots": {"$each": ga_ids}}})
+        for gene_id, ga_ids in ga_ids_of_gene.items()
+    ], ordered=False)
+
+
+def remove_annotation_from_genes(ga_id: PyObjectId, gene_ids: list[PyObjectId], db: Database) -> None:
+    if len(gene_ids) == 0:
+        return
+    GENES_COLL = get_collection(GeneDoc, db)
+    _ = GENES_COLL.update_many({"_id": {"$in": gene_ids}}, {"$pull": {"anots": ga_id}})
+
+
 def enforce_no_existing_genes(species_id: PyObjectId, genes_in: list[GeneIn], db: Database) -> None:
     # Uniqueness is enforced within the scope of the species only
     GENES_COLL = get_collection(GeneDoc, db)
@@ -152,10 +245,12 @@ def enforce_no_existing_genes(species_id: PyObjectId, genes_in: list[GeneIn], db
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail={
-                "description": "Some gene labels (identifiers) already exist in the DB. Under each species, gene labels must be unique",
+                "description": "Some gene labels (identifiers) already exist in the DB. "
+                               "Under each species, gene labels must be unique",
                 "gene_labels": list(overlaps),
                 "recommendations": [
-                    "To ignore existing gene labels and insert only new gene labels, add `skip_duplicates=True` to the query parameters.",
+                    "To ignore existing gene labels and insert only new gene labels, "
+                    "add `skip_duplicates=True` to the query parameters.",
                     "To replace existing gene labels, delete the current gene document before inserting the new one.",
                     "Check that you are inserting genes into the correct species",
                     "If gene has isoforms, consider suffixing the label"
@@ -164,42 +259,50 @@ def enforce_no_existing_genes(species_id: PyObjectId, genes_in: list[GeneIn], db
         )
 
 
-def find_gene_id_from_label(species_id: PyObjectId, gene_label: str, db: Database) -> PyObjectId:
-    GENE_COLL = get_collection(GeneDoc, db)
-    gene_dict = GENE_COLL.find_one(
-        {"spe_id": species_id, "label": gene_label},
-        {"_id": 1}
+def __gene_not_found(gene_label: str) -> HTTPException:
+    return HTTPException(
+        status_code=404,
+        detail={
+            "gene_label": gene_label,
+            "description": f"gene of identifier label {gene_label} not found",
+            "recommendations": [
+                "Ensure gene label is the main gene identifier label, or an alias shared by no other gene",
+                "If gene has not been inserted into database, "
+                "insert genes into the DB via the post_many_genes_by_species POST request endpoint",
+            ],
+        }
     )
-    if gene_dict is None:
-        raise HTTPException(
-            status_code=404,
-            detail={
-                "gene_label": gene_label,
-                "description": f"gene of identifier label {gene_label} not found",
-                "recommendations": [
-                    "Ensure gene label is the main gene identifier label and not their alias",
-                    "If gene has not been inserted into database, insert genes into the DB via the post_many_genes_by_species POST request endpoint",
-                ],
-            }
-        )
-    return PyObjectId(gene_dict["_id"])
 
 
-def find_one_gene_by_label(species_id: PyObjectId, gene_label: str, db: Database) -> GeneOut:
-    GENE_COLL = get_collection(GeneDoc, db)
-    gene_dict = GENE_COLL.find_one(
+def find_gene_id_from_label(species_id: PyObjectId, gene_label: str, db: Database) -> PyObjectId:
+    # Resolved through the in-memory gene index of the species, label first then alias
+    resolved, _ = resolve_gene_labels(species_id, [gene_label], db)
+    if gene_label not in resolved:
+        raise __gene_not_found(gene_label)
+    return PyObjectId(resolved[gene_label])
+
+
+async def find_gene_id_from_label_async(
+    species_id: PyObjectId,
+    gene_label: str,
+    db: AsyncIOMotorDatabase
+) -> PyObjectId:
+    # Same lookup as find_gene_id_from_label, label first then alias
+    resolved, _ = await resolve_gene_labels_async(species_id, [gene_label], db)
+    if gene_label not in resolved:
+        raise __gene_not_found(gene_label)
+    return PyObjectId(resolved[gene_label])
+
+
+async def find_one_gene_by_label(
+    species_id: PyObjectId,
+    gene_label: str,
+    db: AsyncIOMotorDatabase
+) -> GeneOut:
+    GENE_COLL = get_async_collection(GeneDoc, db)
+    gene_dict = await GENE_COLL.find_one(
         {"spe_id": species_id, "label": gene_label}
     )
     if gene_dict is None:
-        raise HTTPException(
-            status_code=404,
-            detail={
-                "gene_label": gene_label,
-                "description": f"gene of identifier label {gene_label} not found",
-                "recommendations": [
-                    "Ensure gene label is the main gene identifier label and not their alias",
-                    "If gene has not been inserted into database, insert genes into the DB via the post_many_genes_by_species POST request endpoint",
-                ],
-            }
-        )
-    return GeneOut(**gene_dict)
+        raise __gene_not_found(gene_label)
+    return GeneOut.construct_from_db(gene_dict)
@@ -0,0 +1,212 @@
+from datetime import datetime, timedelta
+from typing import Any
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import DocumentTooLarge, DuplicateKeyError
+
+from app.db.setup import get_collection
+from app.models.job import JobDoc, JobLockDoc, JobOut, JobStatus
+from config import settings
+
+JOB_OUT_PROJECTION = {"params": 0, "run_after": 0, "worker": 0, "lease_until": 0}
+
+
+def __lease_until() -> datetime:
+    return datetime.now() + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+
+
+def enqueue_job(
+    kind: str,
+    params: dict[str, Any],
+    lock_keys: list[str],
+    db: Database,
+    max_attempts: int | None = None
+) -> JobOut:
+    JOBS_COLL = get_collection(JobDoc, db)
+    job = JobDoc(
+        kind=kind,
+        params=params,
+        lock_keys=sorted(set(lock_keys)),
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+    )
+    to_insert = job.dict_for_db()
+    to_insert["status"] = job.status.value
+    try:
+        result = JOBS_COLL.insert_one(to_insert)
+    except DocumentTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail={
+                "description": "Payload is too large to be queued as a single job",
+                "recommendations": ["Split the payload into several smaller batches"],
+            }
+        )
+    return JobOut(**JOBS_COLL.find_one({"_id": result.inserted_id}, JOB_OUT_PROJECTION))
+
+
+def find_one_job(job_id: str, db: Database) -> JobOut:
+    JOBS_COLL = get_collection(JobDoc, db)
+    job_dict = None
+    if ObjectId.is_valid(job_id):
+        job_dict = JOBS_COLL.find_one({"_id": ObjectId(job_id)}, JOB_OUT_PROJECTION)
+    if job_dict is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={
+                "job_id": job_id,
+                "description": f"job {job_id} not found",
+                "recommendations": [
+                    "Use the job id returned when the job was queued",
+                ],
+            }
+        )
+    return JobOut(**job_dict)
+
+
+#
+# Lock keys serialize jobs touching the same data, eg one species:
+#   a job is claimed only once it holds all of its keys.
+# Locks are leased like jobs, so that the keys of a dead worker free up on their own
+#
+def __release_locks(job_id: ObjectId, lock_keys: list[str], db: Database) -> None:
+    LOCKS_COLL = get_collection(JobLockDoc, db)
+    if lock_keys:
+        _ = LOCKS_COLL.delete_many({"_id": {"$in": lock_keys}, "job_id": job_id})
+
+
+def __acquire_locks(job_id: ObjectId, lock_keys: list[str], db: Database) -> bool:
+    LOCKS_COLL = get_collection(JobLockDoc, db)
+    acquired = []
+    for key in lock_keys:
+        # Keys are sorted, so that concurrent claims cannot hold each other's keys
+        try:
+            _ = LOCKS_COLL.insert_one({"_id": key, "job_id": job_id, "lease_until": __lease_until()})
+        except DuplicateKeyError:
+            taken = LOCKS_COLL.find_one_and_update(
+                {"_id": key, "lease_until": {"$lt": datetime.now()}},
+                {"$set": {"job_id": job_id, "lease_until": __lease_until()}}
+            )
+            if taken is None:
+                __release_locks(job_id, acquired, db)
+                return False
+        acquired.append(key)
+    return True
+
+
+def claim_next_job(worker: str, db: Database) -> JobDoc | None:
+    JOBS_COLL = get_collection(JobDoc, db)
+    candidates = JOBS_COLL.find(
+        {"status": JobStatus.QUEUED.value, "run_after": {"$lte": datetime.now()}},
+        {"lock_keys": 1}
+    ).sort("created_at", ASCENDING).limit(settings.JOB_CLAIM_SCAN)
+    for job_dict in list(candidates):
+        if not __acquire_locks(job_dict["_id"], job_dict["lock_keys"], db):
+            continue
+        claimed = JOBS_COLL.find_one_and_update(
+            {"_id": job_dict["_id"], "status": JobStatus.QUEUED.value},
+            {
+                "$set": {
+                    "status": JobStatus.RUNNING.value,
+                    "worker": worker,
+                    "started_at": datetime.now(),
+                    "lease_until": __lease_until(),
+                },
+                "$inc": {"attempts": 1},
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if claimed is None:  # claimed by another worker in the meantime
+            __release_locks(job_dict["_id"], job_dict["lock_keys"], db)
+            continue
+        return JobDoc(**claimed)
+    return None
+
+
+#
+# Writes of a running job are matched on its current owner: the worker and
+#   attempt that claimed it. Once its lease expired and the job was reaped (and
+#   maybe claimed again), the writes of the former owner match nothing, and
+#   the locks, now held under the same job id by the new owner, are left alone.
+#
+def __owned_by(job: JobDoc) -> dict:
+    return {
+        "_id": job.id,
+        "status": JobStatus.RUNNING.value,
+        "worker": job.worker,
+        "attempts": job.attempts,
+    }
+
+
+def renew_job_lease(job: JobDoc, db: Database) -> bool:
+    # Returns False once the job is no longer owned by the caller
+    JOBS_COLL = get_collection(JobDoc, db)
+    LOCKS_COLL = get_collection(JobLockDoc, db)
+    lease_until = __lease_until()
+    result = JOBS_COLL.update_one(__owned_by(job), {"$set": {"lease_until": lease_until}})
+    if result.matched_count == 0:
+        return False
+    _ = LOCKS_COLL.update_many({"job_id": job.id}, {"$set": {"lease_until": lease_until}})
+    return True
+
+
+def update_job_progress(job: JobDoc, done: int, total: int, db: Database) -> bool:
+    JOBS_COLL = get_collection(JobDoc, db)
+    result = JOBS_COLL.update_one(
+        __owned_by(job),
+        {"$set": {"progress": {"done": done, "total": total}}}
+    )
+    return result.matched_count > 0
+
+
+def finish_job(job: JobDoc, result: Any, db: Database) -> bool:
+    JOBS_COLL = get_collection(JobDoc, db)
+    update = JOBS_COLL.update_one(
+        __owned_by(job),
+        {"$set": {
+            "status": JobStatus.SUCCEEDED.value,
+            "result": result,
+            "error": None,
+            "finished_at": datetime.now(),
+            "lease_until": None,
+        }}
+    )
+    if update.matched_count == 0:
+        return False
+    __release_locks(job.id, job.lock_keys, db)
+    return True
+
+
+# Retryable failures are queued again after JOB_RETRY_DELAY seconds per attempt made
+#   lease_expired: only if the lease of the job expired, as checked by the reaper
+def fail_job(job: JobDoc, error: Any, retryable: bool, db: Database, lease_expired: bool = False) -> bool:
+    JOBS_COLL = get_collection(JobDoc, db)
+    if retryable and job.attempts < job.max_attempts:
+        updates = {
+            "status": JobStatus.QUEUED.value,
+            "run_after": datetime.now() + timedelta(seconds=settings.JOB_RETRY_DELAY * job.attempts),
+        }
+    else:
+        updates = {"status": JobStatus.FAILED.value, "finished_at": datetime.now()}
+    owned_by = __owned_by(job)
+    if lease_expired:
+        owned_by["lease_until"] = {"$lt": datetime.now()}
+    update = JOBS_COLL.update_one(owned_by, {"$set": dict(updates, error=error, lease_until=None)})
+    if update.matched_count == 0:
+        return False
+    __release_locks(job.id, job.lock_keys, db)
+    return True
+
+
+# Running jobs whose lease expired count as a failed attempt of a dead worker
+def reap_expired_jobs(db: Database) -> int:
+    JOBS_COLL = get_collection(JobDoc, db)
+    expired = list(JOBS_COLL.find({
+        "status": JobStatus.RUNNING.value,
+        "lease_until": {"$lt": datetime.now()},
+    }))
+    return sum(
+        fail_job(JobDoc(**job_dict), "worker lease expired", True, db, lease_expired=True)
+        for job_dict in expired
+    )
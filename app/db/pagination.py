@@ -0,0 +1,109 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Any, AsyncIterator, Iterator
+from bson import ObjectId, json_util
+from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+from config import settings
+
+#
+# Keyset pagination
+#   Pages are sorted by indexed keys, unique together (eg `_id`, or `type` + `label`).
+#   The `next_cursor` of a page holds the sort key values of its last document,
+#   so the next page starts right after it through the index instead of skipping
+#   over all the previous pages.
+# `page_num` keeps working, its pages also come with a `next_cursor`
+#
+
+
+def page_size_of(page_size: int | None) -> int:
+    if page_size is None:
+        return settings.PAGE_SIZE
+    return max(1, min(page_size, settings.MAX_PAGE_SIZE))
+
+
+def encode_cursor(doc: dict, sort_keys: list[str]) -> str:
+    values = json_util.dumps([doc[key] for key in sort_keys])
+    return base64.urlsafe_b64encode(values.encode()).decode()
+
+
+CURSOR_VALUE_TYPES = (str, int, float, bool, ObjectId, datetime, type(None))
+#   sort key values a cursor may hold: never operator dicts or arrays,
+#   which would turn the equality clauses of keyset_filter into queries
+
+
+def decode_cursor(cursor: str, sort_keys: list[str]) -> list[Any]:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(sort_keys)
+        or not all(isinstance(value, CURSOR_VALUE_TYPES) for value in values)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "cursor": cursor,
+                "description": "cursor is invalid",
+                "recommendations": [
+                    "Pass the `next_cursor` of the previous page as is",
+                    "Cursors of one endpoint cannot be used on another one",
+                ],
+            }
+        )
+    return values
+
+
+def keyset_filter(sort_keys: list[str], values: list[Any]) -> dict:
+    # Documents sorted after `values`: (k0 > v0) or (k0 == v0 and k1 > v1) or ...
+    return {"$or": [
+        dict(zip(sort_keys[:i], values[:i]), **{sort_keys[i]: {"$gt": values[i]}})
+        for i in range(len(sort_keys))
+    ]}
+
+
+async def find_page(
+    coll: AsyncIOMotorCollection,
+    query: dict,
+    sort_keys: list[str],
+    page_num: int,
+    cursor: str | None = None,
+    page_size: int | None = None
+) -> tuple[list[dict], str | None]:
+    # Returns the documents of the page and the cursor to the next one, if any
+    size = page_size_of(page_size)
+    skip = 0
+    if cursor is not None:
+        query = {"$and": [query, keyset_filter(sort_keys, decode_cursor(cursor, sort_keys))]}
+    else:
+        skip = max(page_num - 1, 0) * size
+    docs = await coll.find(query) \
+        .sort([(key, ASCENDING) for key in sort_keys]) \
+        .skip(skip) \
+        .limit(size) \
+        .to_list(size)
+    next_cursor = encode_cursor(docs[-1], sort_keys) if len(docs) == size else None
+    return docs, next_cursor
+
+
+async def iter_sorted(coll: AsyncIOMotorCollection, query: dict, sort_keys: list[str]) -> AsyncIterator[dict]:
+    # Every document of the query, in page order, straight from the cursor (eg for streamed exports)
+    async for doc in coll.find(query).sort([(key, ASCENDING) for key in sort_keys]):
+        yield doc
+
+
+def iter_by_ids(coll: Collection, ids: list[ObjectId]) -> Iterator[dict]:
+    # Documents of ids in the order of ids (eg the rows of a batch request), read
+    #   BULK_WRITE_CHUNK_SIZE ids at a time so that a large batch is never held all at once
+    for start in range(0, len(ids), settings.BULK_WRITE_CHUNK_SIZE):
+        chunk = ids[start:start + settings.BULK_WRITE_CHUNK_SIZE]
+        doc_of_id = {doc["_id"]: doc for doc in coll.find({"_id": {"$in": chunk}})}
+        for doc_id in chunk:
+            if doc_id in doc_of_id:
+                yield doc_of_id[doc_id]
@@ -0,0 +1,73 @@
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any
+
+from app.db.data_versions_collection import USERS_DATA_KEY, add_data_version_listener
+from app.models.metrics import CacheMetrics
+from config import settings
+
+#
+# In-process cache of authenticated principals, by api_key and by JWT hash
+#   An authenticated request then normally costs no DB round trip for auth.
+#   Entries live for PRINCIPAL_CACHE_TTL seconds at most (and never past the
+#   expiry of their token), at most PRINCIPAL_CACHE_MAX_ENTRIES are kept, least
+#   recently used first out. User writes made by this process drop the entries
+#   of the db right away, those made by others are picked up after the TTL.
+#   Only successful lookups are cached.
+#
+
+_entries: OrderedDict[tuple[str, str, str], tuple[Any, float]] = OrderedDict()
+#   (db name, kind, key) -> (principal, expires at)
+_lock = Lock()
+_hits = 0
+_misses = 0
+
+
+def __drop_principals(db_name: str, key: str | None) -> None:
+    if key is None or key == USERS_DATA_KEY:
+        with _lock:
+            for entry_key in [entry_key for entry_key in _entries if entry_key[0] == db_name]:
+                _ = _entries.pop(entry_key, None)
+
+
+add_data_version_listener(__drop_principals)
+
+
+def token_key(token: str) -> str:
+    # Tokens are kept in memory as their hash only
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def get_principal(db_name: str, kind: str, key: str) -> Any | None:
+    global _hits, _misses
+    with _lock:
+        entry = _entries.get((db_name, kind, key))
+        if entry is None or entry[1] <= time.monotonic():
+            _misses += 1
+            return None
+        _entries.move_to_end((db_name, kind, key))
+        _hits += 1
+        return entry[0]
+
+
+def set_principal(db_name: str, kind: str, key: str, principal: Any, expires_in: float | None = None) -> None:
+    # expires_in: seconds left before the credentials expire, eg of a JWT
+    ttl = settings.PRINCIPAL_CACHE_TTL if expires_in is None else min(settings.PRINCIPAL_CACHE_TTL, expires_in)
+    with _lock:
+        _entries[(db_name, kind, key)] = (principal, time.monotonic() + ttl)
+        _entries.move_to_end((db_name, kind, key))
+        while len(_entries) > settings.PRINCIPAL_CACHE_MAX_ENTRIES:
+            _ = _entries.popitem(last=False)
+
+
+def principal_cache_metrics() -> CacheMetrics:
+    with _lock:
+        n_lookups = _hits + _misses
+        return CacheMetrics(
+            hits=_hits,
+            misses=_misses,
+            size=len(_entries),
+            hit_rate=round(_hits / n_lookups, settings.N_DECIMALS) if n_lookups > 0 else None
+        )
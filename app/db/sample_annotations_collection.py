@@ -1,63 +1,179 @@
+import asyncio
+import heapq
 import math
 from os import pidfd_open
-from bson import ObjectId
+from bson import Binary, ObjectId
 from collections import defaultdict
+from itertools import islice
+from typing import AsyncIterator, Callable, Iterator
+import numpy as np
 from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, ReturnDocument, UpdateOne
 from pymongo.database import Database
 from pymongo.errors import BulkWriteError
 
 from config import settings
-from app.db.setup import get_collection
+from app.db.counts_collection import find_count
+from app.db.data_versions_collection import (
+    bump_data_version,
+    bump_sample_annotation_labels,
+    sample_annotation_label_data_key,
+    species_data_key,
+)
+from app.db.sample_dictionaries_collection import (
+    assign_sample_indices,
+    sample_labels_of,
+    unpack_sa_dict,
+    unpack_sa_dict_async,
+)
+from app.db.gene_index import genes_not_found, get_gene_index, resolve_gene_labels
+from app.db.pagination import find_page, iter_by_ids, iter_sorted, page_size_of
+from app.db.setup import get_async_collection, get_collection
+from app.db.species_collection import find_species_id_from_taxid
+from app.db.species_registry import get_species_registry_async
 from app.models.sample_annotation import (
+    PackedSamples,
     Sample,
     SampleAnnotationDoc,
     SampleAnnotationInput,
     SampleAnnotationOut,
     SampleAnnotationPage,
+    SampleAnnotationRank,
     SampleAnnotationUnit,
+    SpmRecomputeSummary,
+    TpmMatrixIngestSummary,
 )
+from app.utils.stats import compute_spm, group_column_sums
+from app.utils.tpm_matrix import iter_tpm_matrix_chunks
 
 
-def find_sample_annotations_by_gene(
+async def find_sample_annotations_by_gene(
     species_id: ObjectId,
     gene_id: ObjectId,
     page_num: int,
-    db: Database
+    db: AsyncIOMotorDatabase,
+    cursor: str | None = None,
+    page_size: int | None = None
 ) -> SampleAnnotationPage:
-    SA_COLL = get_collection(SampleAnnotationDoc, db)
-    sa_docs = [
-        SampleAnnotationOut(**sa_dict)
-        for sa_dict in SA_COLL.find({"spe_id": species_id, "g_id": gene_id})
-        .skip((page_num - 1) * settings.PAGE_SIZE)
-        .limit(settings.PAGE_SIZE)
-    ]
-    return SampleAnnotationPage(
-        page_total=math.ceil(SA_COLL.estimated_document_count() / settings.PAGE_SIZE),
+    SA_COLL = get_async_collection(SampleAnnotationDoc, db)
+    # Sorted along the unique (spe_id, g_id, type, label) index
+    query = {"spe_id": species_id, "g_id": gene_id}
+    sa_dicts, next_cursor = await find_page(SA_COLL, query, ["type", "label"], page_num, cursor, page_size)
+    return SampleAnnotationPage.construct(
+        page_total=math.ceil(
+            await find_count(SA_COLL, query, species_data_key(species_id), db) / page_size_of(page_size)
+        ),
         curr_page=page_num,
-        payload=sa_docs
+        payload=[
+            SampleAnnotationOut.construct_from_db(await unpack_sa_dict_async(sa_dict, db))
+            for sa_dict in sa_dicts
+        ],
+        next_cursor=next_cursor
     )
 
 
-def find_sample_annotations_by_label(
+async def find_sample_annotations_by_label(
     annotation_type: str,
     annotation_label: str,
     page_num: int,
-    db: Database
+    db: AsyncIOMotorDatabase,
+    cursor: str | None = None,
+    page_size: int | None = None
 ) -> SampleAnnotationPage:
-    SA_COLL = get_collection(SampleAnnotationDoc, db)
-    sa_docs = [
-        SampleAnnotationOut(**sa_dict)
-        for sa_dict in SA_COLL.find({"type": annotation_type, "label": annotation_label})
-        .skip((page_num - 1) * settings.PAGE_SIZE)
-        .limit(settings.PAGE_SIZE)
-    ]
-    return SampleAnnotationPage(
-        page_total=math.ceil(SA_COLL.estimated_document_count() / settings.PAGE_SIZE),
+    SA_COLL = get_async_collection(SampleAnnotationDoc, db)
+    # Sorted along the (type, label, _id) index
+    query = {"type": annotation_type, "label": annotation_label}
+    sa_dicts, next_cursor = await find_page(SA_COLL, query, ["_id"], page_num, cursor, page_size)
+    return SampleAnnotationPage.construct(
+        page_total=math.ceil(
+            await find_count(
+                SA_COLL, query, sample_annotation_label_data_key(annotation_type, annotation_label), db
+            ) / page_size_of(page_size)
+        ),
         curr_page=page_num,
-        payload=sa_docs
+        payload=[
+            SampleAnnotationOut.construct_from_db(await unpack_sa_dict_async(sa_dict, db))
+            for sa_dict in sa_dicts
+        ],
+        next_cursor=next_cursor
     )
 
 
+async def iter_sample_annotations_by_gene(
+    species_id: ObjectId,
+    gene_id: ObjectId,
+    db: AsyncIOMotorDatabase
+) -> AsyncIterator[SampleAnnotationOut]:
+    # All SA docs of the gene in page order, for streamed responses
+    SA_COLL = get_async_collection(SampleAnnotationDoc, db)
+    async for sa_dict in iter_sorted(SA_COLL, {"spe_id": species_id, "g_id": gene_id}, ["type", "label"]):
+        yield SampleAnnotationOut.construct_from_db(await unpack_sa_dict_async(sa_dict, db))
+
+
+async def iter_sample_annotations_by_label(
+    annotation_type: str,
+    annotation_label: str,
+    db: AsyncIOMotorDatabase
+) -> AsyncIterator[SampleAnnotationOut]:
+    SA_COLL = get_async_collection(SampleAnnotationDoc, db)
+    async for sa_dict in iter_sorted(SA_COLL, {"type": annotation_type, "label": annotation_label}, ["_id"]):
+        yield SampleAnnotationOut.construct_from_db(await unpack_sa_dict_async(sa_dict, db))
+
+
+#
+# Top n SA docs of an annotation label, eg the genes most specific to ROOT
+#   The ranks of each species are read along the (type, label, spe_id, rank, _id)
+#   index, n at most and from the index only, then merged keeping the n first.
+#   Only the n winners are read in full, so no query sorts or reads more than
+#   n docs per species, whatever the number of SA docs with the label.
+# Ties are broken by _id, as for pages.
+#
+async def find_top_sample_annotations(
+    annotation_type: str,
+    annotation_label: str,
+    rank_by: SampleAnnotationRank,
+    n: int,
+    db: AsyncIOMotorDatabase,
+    species_ids: list[ObjectId] | None = None
+) -> list[SampleAnnotationOut]:
+    SA_COLL = get_async_collection(SampleAnnotationDoc, db)
+    if species_ids is None:
+        species_ids = [species.id for species in (await get_species_registry_async(db)).species]
+    rank_key = rank_by.value
+    ranks_of_species = await asyncio.gather(*(
+        SA_COLL.find(
+            {"type": annotation_type, "label": annotation_label, "spe_id": species_id},
+            {"_id": 1, rank_key: 1}
+        ).sort([(rank_key, DESCENDING), ("_id", ASCENDING)]).limit(n).to_list(n)
+        for species_id in dict.fromkeys(species_ids)
+    ))
+    top_ids = [
+        rank_dict["_id"]
+        for rank_dict in islice(
+            heapq.merge(*ranks_of_species, key=lambda rank_dict: (-rank_dict[rank_key], rank_dict["_id"])),
+            n
+        )
+    ]
+    sa_dict_of_id = {
+        sa_dict["_id"]: sa_dict
+        async for sa_dict in SA_COLL.find({"_id": {"$in": top_ids}})
+    }
+    return [
+        SampleAnnotationOut.construct_from_db(await unpack_sa_dict_async(sa_dict_of_id[sa_id], db))
+        for sa_id in top_ids
+        if sa_id in sa_dict_of_id
+    ]
+
+
+def iter_sas_by_ids(sa_ids: list[ObjectId], db: Database) -> Iterator[SampleAnnotationOut]:
+    # Read back once all writes are done, so with their updated SPM,
+    #   in the order of the batch rows rather than of ids, older for SA docs appended to
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    for sa_dict in iter_by_ids(SA_COLL, sa_ids):
+        yield SampleAnnotationOut.construct_from_db(unpack_sa_dict(sa_dict, db))
+
+
 def __group_samples_by_annotation_labels(
     samples: list[SampleAnnotationUnit]
 ) -> dict[str, list[Sample]]:
@@ -97,12 +213,14 @@ def enforce_no_existing_samples_for_gene(
     # When this function is called,
     #   it is assumed to be scoped to one gene, of one species only
     SA_COLL = get_collection(SampleAnnotationDoc, db)
-    annotations = SA_COLL.aggregate([
-        {"$match": {"spe_id": species_id, "g_id": gene_id}},
-        {"$unwind": "$samples"},
-        {"$project": {"_id": 0, "label": "$samples.label"}},
-    ])
-    existing_samples = {res["label"] for res in annotations}
+    existing_samples = {
+        label
+        for sa_dict in SA_COLL.find(
+            {"spe_id": species_id, "g_id": gene_id},
+            {"_id": 0, "spe_id": 1, "samples.label": 1, "s_idx": 1}
+        )
+        for label in sample_labels_of(sa_dict, db)
+    }
     incoming_samples = {row.sample_label for row in sa_input.samples}
     if existing_samples & incoming_samples != set():
         raise HTTPException(
@@ -111,7 +229,8 @@ def enforce_no_existing_samples_for_gene(
                 "description": "Some sample labels (accessions) already exist in the DB. Sample labels must be unique",
                 "sample_labels": list(existing_samples & incoming_samples),
                 "recommendations": [
-                    "To ignore existing sample labels and append only new sample labels, add `skip_duplicate_samples=True` to the query parameters.",
+                    "To ignore existing sample labels and append only new sample labels, "
+                    "add `skip_duplicate_samples=True` to the query parameters.",
                     "To replace existing sample labels, use the update endpoint for SampleAnnotationDoc instead.",
                     "Sample accession labels should be unique",
                 ]
@@ -128,24 +247,26 @@ def insert_or_update_one_sa_doc(
     #   Check which samples within the new SA input doc are new
     #   Update the sa doc with only the new samples, and not replace the existing samples
     SA_COLL = get_collection(SampleAnnotationDoc, db)
-    curr_doc_dict = SA_COLL.find_one({
-        "spe_id": sa_doc.spe_id,
-        "g_id": sa_doc.g_id,
-        "type": sa_doc.type,
-        "label": sa_doc.label
-    })
+    curr_doc_dict = SA_COLL.find_one(
+        {
+            "spe_id": sa_doc.spe_id,
+            "g_id": sa_doc.g_id,
+            "type": sa_doc.type,
+            "label": sa_doc.label
+        },
+        {"spe_id": 1, "samples.label": 1, "s_idx": 1}
+    )
     if curr_doc_dict is None:
         return __insert_one_sample_annotation(sa_doc, db)
 
-    curr_doc = SampleAnnotationDoc(**curr_doc_dict)
-    assert curr_doc.id is not None
-    new_labels = {sample.label for sample in sa_doc.samples}
-    curr_labels = {sample.label for sample in curr_doc.samples}
+    curr_labels = set(sample_labels_of(curr_doc_dict, db))
     samples_to_insert = [
         sample for sample in sa_doc.samples
-        if sample.label not in (new_labels & curr_labels)
+        if sample.label not in curr_labels
     ]
-    return __update_one_sample_annotation(curr_doc.id, samples_to_insert, db)
+    if PackedSamples.is_packed(curr_doc_dict):
+        return __update_one_packed_sample_annotation(curr_doc_dict["_id"], samples_to_insert, db)
+    return __update_one_sample_annotation(curr_doc_dict["_id"], samples_to_insert, db)
 
 
 def __insert_one_sample_annotation(
@@ -153,38 +274,115 @@ def __insert_one_sample_annotation(
     db: Database
 ) -> SampleAnnotationOut:
     SA_COLL = get_collection(SampleAnnotationDoc, db)
-    sa_doc.avg_tpm = round(
-        sum([sample.tpm for sample in sa_doc.samples]) / len(sa_doc.samples),
-        settings.N_DECIMALS
-    )
+    tpms = [sample.tpm for sample in sa_doc.samples]
+    sa_doc.tpm_sum = sum(tpms)
+    sa_doc.tpm_sq_sum = sum(tpm * tpm for tpm in tpms)
+    sa_doc.n_samples = len(tpms)
+    sa_doc.avg_tpm = round(sa_doc.tpm_sum / sa_doc.n_samples, settings.N_DECIMALS)
+    if settings.PACKED_SAMPLES:
+        sample_index = assign_sample_indices(
+            sa_doc.spe_id, [sample.label for sample in sa_doc.samples], db
+        )
+        to_insert = sa_doc.dict(exclude_none=True, exclude={"samples"})
+        to_insert.update(PackedSamples.pack(sa_doc.samples, sample_index))
+        _ = SA_COLL.insert_one(to_insert)
+        bump_sample_annotation_labels([(sa_doc.type, sa_doc.label)], db)
+        return SampleAnnotationOut(**sa_doc.dict(exclude_none=True), _id=to_insert["_id"])
     to_insert = sa_doc.dict(exclude_none=True)
     _ = SA_COLL.insert_one(to_insert)
+    bump_sample_annotation_labels([(sa_doc.type, sa_doc.label)], db)
     return SampleAnnotationOut(**to_insert)
 
 
+#
+# Appends samples and updates the running sums and avg_tpm in one atomic write
+#   Written as an update pipeline so that avg_tpm can be derived from the new sums
+#   in the same statement; docs stored before the running sums existed
+#   get them backfilled from their samples on their first append.
+#
 def __update_one_sample_annotation(
     id: ObjectId,
     new_samples: list[Sample],
     db: Database
 ) -> SampleAnnotationOut:
     SA_COLL = get_collection(SampleAnnotationDoc, db)
+    if len(new_samples) == 0:
+        return SampleAnnotationOut(**SA_COLL.find_one({"_id": id}))
     new_samples_dict = [new_sample.dict(exclude_none=True) for new_sample in new_samples]
+    tpms = [new_sample.tpm for new_sample in new_samples]
+    squares_of_samples = {"$map": {
+        "input": "$samples.tpm",
+        "as": "tpm",
+        "in": {"$multiply": ["$$tpm", "$$tpm"]}
+    }}
     result = SA_COLL.find_one_and_update(
         filter={"_id": id},
-        update={"$push": {"samples": {"$each": new_samples_dict}}}
-    )
-    new_avg_tpm = SA_COLL.aggregate([
-        {"$match": {"_id": id}},
-        {"$unwind": "$samples"},
-        {"$group": {"_id": "$_id", "avgTpm": {"$avg": "$samples.tpm"}}}
-    ]).next()["avgTpm"]
-    result = SA_COLL.find_one_and_update(
-        filter={"_id": id},
-        update={"$set": {"avg_tpm": new_avg_tpm}}
+        update=[
+            {"$set": {
+                "tpm_sum": {"$add": [
+                    {"$ifNull": ["$tpm_sum", {"$sum": "$samples.tpm"}]},
+                    sum(tpms)
+                ]},
+                "tpm_sq_sum": {"$add": [
+                    {"$ifNull": ["$tpm_sq_sum", {"$sum": squares_of_samples}]},
+                    sum(tpm * tpm for tpm in tpms)
+                ]},
+                "n_samples": {"$add": [
+                    {"$ifNull": ["$n_samples", {"$size": "$samples"}]},
+                    len(tpms)
+                ]},
+                "samples": {"$concatArrays": ["$samples", {"$literal": new_samples_dict}]},
+            }},
+            {"$set": {
+                "avg_tpm": {"$round": [{"$divide": ["$tpm_sum", "$n_samples"]}, settings.N_DECIMALS]}
+            }},
+        ],
+        return_document=ReturnDocument.AFTER
     )
     return SampleAnnotationOut(**result)
 
 
+#
+# Packed counterpart of the above: binary arrays cannot be appended server side,
+#   so the arrays are extended client side and written back guarded by n_samples,
+#   retrying if another append landed in between
+# Docs packed before the running sums existed get them derived from s_tpm
+#
+def __update_one_packed_sample_annotation(
+    id: ObjectId,
+    new_samples: list[Sample],
+    db: Database
+) -> SampleAnnotationOut:
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    while True:
+        curr_dict = SA_COLL.find_one({"_id": id})
+        if len(new_samples) == 0:
+            return SampleAnnotationOut(**unpack_sa_dict(curr_dict, db))
+        sample_index = assign_sample_indices(
+            curr_dict["spe_id"], [sample.label for sample in new_samples], db
+        )
+        tpms = [new_sample.tpm for new_sample in new_samples]
+        curr_tpms = PackedSamples.tpms(curr_dict)
+        tpm_sum = curr_dict.get("tpm_sum", float(curr_tpms.sum())) + sum(tpms)
+        tpm_sq_sum = curr_dict.get("tpm_sq_sum", float((curr_tpms * curr_tpms).sum())) \
+            + sum(tpm * tpm for tpm in tpms)
+        n_samples = curr_dict.get("n_samples", len(curr_tpms)) + len(tpms)
+        # `n_samples: None` also matches docs without n_samples
+        result = SA_COLL.find_one_and_update(
+            filter={"_id": id, "n_samples": curr_dict.get("n_samples")},
+            update={"$set": {
+                **PackedSamples.append(curr_dict, new_samples, sample_index),
+                "tpm_sum": tpm_sum,
+                "tpm_sq_sum": tpm_sq_sum,
+                "n_samples": n_samples,
+                "avg_tpm": round(tpm_sum / n_samples, settings.N_DECIMALS),
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if result is not None:
+            return SampleAnnotationOut(**unpack_sa_dict(result, db))
+
+
 def update_affected_spm(
     species_id: ObjectId,
     gene_id: ObjectId,
@@ -193,22 +391,350 @@ def update_affected_spm(
 ) -> None:
     # Only called when all the SA docs avg_tpm have been updated
     SA_COLL = get_collection(SampleAnnotationDoc, db)
-    sa_dicts = SA_COLL.find({
-        "spe_id": species_id,
-        "g_id": gene_id,
-        "type": annotation_type,
-    })
-    sa_docs = [SampleAnnotationDoc(**sa_dict) for sa_dict in sa_dicts]
-    total_avg_tpm = round(sum([sa_doc.avg_tpm for sa_doc in sa_docs]), settings.N_DECIMALS)
-    for sa_doc in sa_docs:
-        if total_avg_tpm == 0:
-            sa_doc.spm = 0
-        else:
-            sa_doc.spm = round(sa_doc.avg_tpm / total_avg_tpm, settings.N_DECIMALS)
-        _ = SA_COLL.update_one(
-            {"_id": sa_doc.id},
-            {"$set": {"spm": sa_doc.spm}}
+    sa_dicts = list(SA_COLL.find(
+        {
+            "spe_id": species_id,
+            "g_id": gene_id,
+            "type": annotation_type,
+        },
+        {"avg_tpm": 1}
+    ))
+    if len(sa_dicts) == 0:
+        return
+    spm = compute_spm(
+        np.array([[sa_dict.get("avg_tpm", 0) for sa_dict in sa_dicts]], dtype=np.float64),
+        settings.N_DECIMALS
+    )[0]
+    _ = SA_COLL.bulk_write(
+        [
+            UpdateOne({"_id": sa_dict["_id"]}, {"$set": {"spm": sa_spm}})
+            for sa_dict, sa_spm in zip(sa_dicts, spm.tolist())
+        ],
+        ordered=False
+    )
+    _ = bump_data_version(species_data_key(species_id), db)
+
+
+#
+# Duplicate samples of a whole batch, checked before it is queued as a job
+#   The job then skips existing samples, so that a retried job does not fail
+#   on the samples appended by an earlier attempt. Rows whose gene is not
+#   found are left for the job to report.
+#
+def enforce_no_existing_samples(sa_input_list: list[SampleAnnotationInput], db: Database) -> None:
+    labels_of_taxid: dict[int, list[str]] = defaultdict(list)
+    for sa_input in sa_input_list:
+        labels_of_taxid[sa_input.species_taxid].append(sa_input.gene_label)
+    species_ids = {taxid: find_species_id_from_taxid(taxid, db) for taxid in labels_of_taxid}
+    gene_ids: dict[tuple[int, str], ObjectId] = {}
+    for taxid, gene_labels in labels_of_taxid.items():
+        resolved, _ = resolve_gene_labels(species_ids[taxid], gene_labels, db)
+        gene_ids.update({(taxid, gene_label): gene_id for gene_label, gene_id in resolved.items()})
+    for sa_input in sa_input_list:
+        gene_id = gene_ids.get((sa_input.species_taxid, sa_input.gene_label))
+        if gene_id is not None:
+            enforce_no_existing_samples_for_gene(sa_input, species_ids[sa_input.species_taxid], gene_id, db)
+
+
+#
+# Rows of a batch upload, each one inserted then followed by the SPM update of its gene
+#   on_progress(done, total) is called after every row, eg to report job progress
+#   returns the ids of the SA docs written, see iter_sas_by_ids
+#
+def insert_many_sa_inputs(
+    sa_input_list: list[SampleAnnotationInput],
+    skip_duplicate_samples: bool,
+    db: Database,
+    on_progress: Callable[[int, int], None] | None = None
+) -> list[ObjectId]:
+    # Species and genes of every row are resolved before anything is written,
+    #   a 404 then lists all the gene labels not found
+    species_ids: dict[int, ObjectId] = {}
+    labels_of_taxid: dict[int, list[str]] = defaultdict(list)
+    for sa_input in sa_input_list:
+        if sa_input.species_taxid not in species_ids:
+            species_ids[sa_input.species_taxid] = find_species_id_from_taxid(sa_input.species_taxid, db)
+        labels_of_taxid[sa_input.species_taxid].append(sa_input.gene_label)
+    gene_ids: dict[tuple[int, str], ObjectId] = {}
+    missing = []
+    for taxid, gene_labels in labels_of_taxid.items():
+        resolved, unresolved = resolve_gene_labels(species_ids[taxid], gene_labels, db)
+        gene_ids.update({(taxid, gene_label): gene_id for gene_label, gene_id in resolved.items()})
+        missing.extend({"taxid": taxid, "gene_label": gene_label} for gene_label in unresolved)
+    if len(missing) > 0:
+        raise genes_not_found(missing)
+    sa_ids: dict[ObjectId, None] = {}
+    for i, sa_input in enumerate(sa_input_list):
+        species_id = species_ids[sa_input.species_taxid]
+        gene_id = gene_ids[(sa_input.species_taxid, sa_input.gene_label)]
+        if skip_duplicate_samples is False:
+            enforce_no_existing_samples_for_gene(sa_input, species_id, gene_id, db)
+        sa_docs = reshape_sa_input_to_sa_docs(sa_input, species_id, gene_id)
+        sa_outs = [insert_or_update_one_sa_doc(sa_doc, db) for sa_doc in sa_docs]
+        update_affected_spm(species_id, gene_id, sa_input.annotation_type, db)
+        sa_ids.update((sa_out.id, None) for sa_out in sa_outs)
+        if on_progress is not None:
+            on_progress(i + 1, len(sa_input_list))
+    return list(sa_ids)
+
+
+#
+# Re-derive avg_tpm and SPM of every SA doc of a species in one pass
+#   avg_tpm is averaged server side, then laid out as a genes x labels matrix
+#   per annotation type so that SPM is computed for all genes at once.
+# Results are written back in chunks of BULK_WRITE_CHUNK_SIZE updates.
+#
+def recompute_species_stats(
+    species_id: ObjectId,
+    db: Database,
+    annotation_type: str | None = None,
+) -> SpmRecomputeSummary:
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    query: dict = {"spe_id": species_id}
+    if annotation_type is not None:
+        query["type"] = annotation_type
+    cursor = SA_COLL.aggregate([
+        {"$match": query},
+        {"$project": {
+            "g_id": 1,
+            "type": 1,
+            "label": 1,
+            "tpm_sum": {"$sum": "$samples.tpm"},
+            "tpm_sq_sum": {"$sum": {"$map": {
+                "input": "$samples.tpm",
+                "as": "tpm",
+                "in": {"$multiply": ["$$tpm", "$$tpm"]}
+            }}},
+            "n_samples": {"$size": {"$ifNull": ["$samples", []]}},
+            "s_tpm": 1,
+        }},
+    ])
+    by_type: dict[str, list[tuple]] = defaultdict(list)
+    for sa_dict in cursor:
+        if "s_tpm" in sa_dict:
+            tpms = PackedSamples.tpms(sa_dict)
+            sa_dict["tpm_sum"] = tpms.sum().item()
+            sa_dict["tpm_sq_sum"] = (tpms * tpms).sum().item()
+            sa_dict["n_samples"] = len(tpms)
+        by_type[sa_dict["type"]].append((
+            sa_dict["_id"],
+            sa_dict["g_id"],
+            sa_dict["label"],
+            sa_dict["tpm_sum"],
+            sa_dict["tpm_sq_sum"],
+            sa_dict["n_samples"],
+        ))
+    summary = SpmRecomputeSummary(annotation_types=sorted(by_type))
+    for rows in by_type.values():
+        sa_ids, gene_ids, labels, tpm_sums, tpm_sq_sums, n_samples = zip(*rows)
+        gene_index: dict[ObjectId, int] = {}
+        label_index: dict[str, int] = {}
+        gene_rows = np.array([gene_index.setdefault(g, len(gene_index)) for g in gene_ids])
+        label_cols = np.array([label_index.setdefault(label, len(label_index)) for label in labels])
+        counts = np.array(n_samples, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            avg_tpm = np.where(counts == 0, 0.0, np.array(tpm_sums, dtype=np.float64) / counts)
+        avg_tpm = np.round(avg_tpm, settings.N_DECIMALS)
+        matrix = np.full((len(gene_index), len(label_index)), np.nan)
+        matrix[gene_rows, label_cols] = avg_tpm
+        spm = compute_spm(matrix, settings.N_DECIMALS)[gene_rows, label_cols]
+        operations = [
+            UpdateOne({"_id": sa_id}, {"$set": {
+                "avg_tpm": sa_avg_tpm,
+                "spm": sa_spm,
+                "tpm_sum": sa_tpm_sum,
+                "tpm_sq_sum": sa_tpm_sq_sum,
+                "n_samples": sa_n_samples,
+            }})
+            for sa_id, sa_avg_tpm, sa_spm, sa_tpm_sum, sa_tpm_sq_sum, sa_n_samples in zip(
+                sa_ids, avg_tpm.tolist(), spm.tolist(), tpm_sums, tpm_sq_sums, n_samples
+            )
+        ]
+        for start in range(0, len(operations), settings.BULK_WRITE_CHUNK_SIZE):
+            _ = SA_COLL.bulk_write(
+                operations[start:start + settings.BULK_WRITE_CHUNK_SIZE],
+                ordered=False
+            )
+        summary.n_genes += len(gene_index)
+        summary.n_docs_updated += len(operations)
+    _ = bump_data_version(species_data_key(species_id), db)
+    return summary
+
+
+#
+# Converts the embedded samples of a species' SA docs to packed storage
+#   The running sums are written from the samples too, as docs stored before
+#   they existed lack them and packed appends need them
+#   Returns the number of SA docs converted
+#
+def pack_species_samples(species_id: ObjectId, db: Database) -> int:
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    cursor = SA_COLL.find(
+        {"spe_id": species_id, "samples": {"$exists": True}},
+        {"samples": 1},
+        batch_size=settings.BULK_WRITE_CHUNK_SIZE
+    )
+    n_packed = 0
+    while True:
+        chunk = [sa_dict for _, sa_dict in zip(range(settings.BULK_WRITE_CHUNK_SIZE), cursor)]
+        if not chunk:
+            return n_packed
+        samples_per_doc = [
+            [Sample(**sample) for sample in sa_dict["samples"]] for sa_dict in chunk
+        ]
+        sample_index = assign_sample_indices(
+            species_id,
+            [sample.label for samples in samples_per_doc for sample in samples],
+            db
+        )
+        _ = SA_COLL.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": sa_dict["_id"]},
+                    {
+                        "$set": {
+                            **PackedSamples.pack(samples, sample_index),
+                            "tpm_sum": sum(sample.tpm for sample in samples),
+                            "tpm_sq_sum": sum(sample.tpm * sample.tpm for sample in samples),
+                            "n_samples": len(samples),
+                        },
+                        "$unset": {"samples": ""},
+                    }
+                )
+                for sa_dict, samples in zip(chunk, samples_per_doc)
+            ],
+            ordered=False
+        )
+        n_packed += len(chunk)
+
+
+#
+# Whole species ingestion from a TPM matrix (genes x samples)
+#   Every chunk of gene rows is aggregated per annotation label with numpy,
+#   avg_tpm and SPM are computed in the same pass,
+#   and the resulting SA docs are written with one bulk_write per chunk.
+# The matrix is authoritative for the annotation type:
+#   existing SA docs of the same gene, type and label are replaced.
+#
+def ingest_tpm_matrix(
+    species_id: ObjectId,
+    annotation_type: str,
+    matrix_rows: Iterator[list[str]],
+    sample_map: dict[str, str],
+    db: Database
+) -> TpmMatrixIngestSummary:
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    header = next(matrix_rows, None)
+    if header is None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={
+                "description": "TPM matrix is empty",
+                "recommendations": [
+                    "The first row should hold the sample labels, the first column the gene labels",
+                ]
+            }
         )
+    sample_labels = [label.strip().upper() for label in header[1:]]
+    summary = TpmMatrixIngestSummary(
+        annotation_type=annotation_type,
+        n_samples=len(sample_labels),
+        unmapped_samples=[label for label in sample_labels if label not in sample_map]
+    )
+    # Column indices of the annotated samples, grouped by annotation label
+    mapped_cols = np.array([
+        i for i, label in enumerate(sample_labels) if label in sample_map
+    ], dtype=np.intp)
+    if len(mapped_cols) == 0:
+        return summary
+    unique_labels, group_codes = np.unique(
+        [sample_map[sample_labels[i]] for i in mapped_cols],
+        return_inverse=True
+    )
+    annotation_labels: list[str] = unique_labels.tolist()
+    summary.n_annotation_labels = len(annotation_labels)
+    samples_per_label = [
+        [sample_labels[i] for i in mapped_cols[group_codes == j]]
+        for j in range(len(annotation_labels))
+    ]
+    n_samples_per_label = np.array([len(samples) for samples in samples_per_label])
+    sample_index = assign_sample_indices(
+        species_id, [sample_labels[i] for i in mapped_cols], db
+    ) if settings.PACKED_SAMPLES else {}
+    idx_per_label = [
+        np.array([sample_index[label] for label in samples], dtype=PackedSamples.IDX_DTYPE).tobytes()
+        for samples in samples_per_label
+    ] if settings.PACKED_SAMPLES else []
+    # Gene labels and aliases of the species resolved in memory instead of one query per row
+    gene_index = get_gene_index(species_id, db)
+    try:
+        for gene_labels, values in iter_tpm_matrix_chunks(
+            matrix_rows, len(sample_labels), settings.INGEST_CHUNK_GENES
+        ):
+            values = np.round(values[:, mapped_cols], settings.N_DECIMALS)
+            tpm_sum = group_column_sums(values, group_codes, len(annotation_labels))
+            tpm_sq_sum = group_column_sums(values * values, group_codes, len(annotation_labels))
+            avg_tpm = np.round(tpm_sum / n_samples_per_label, settings.N_DECIMALS)
+            spm = compute_spm(avg_tpm, settings.N_DECIMALS)
+            group_values = [values[:, group_codes == j] for j in range(len(annotation_labels))]
+            operations = []
+            for i, gene_label in enumerate(gene_labels):
+                gene_id = gene_index.gene_id_of(gene_label)
+                if gene_id is None:
+                    summary.missing_gene_labels.append(gene_label)
+                    continue
+                for j, annotation_label in enumerate(annotation_labels):
+                    to_write = {
+                        "spe_id": species_id,
+                        "g_id": gene_id,
+                        "type": annotation_type,
+                        "label": annotation_label,
+                        "spm": spm[i, j].item(),
+                        "avg_tpm": avg_tpm[i, j].item(),
+                        "tpm_sum": tpm_sum[i, j].item(),
+                        "tpm_sq_sum": tpm_sq_sum[i, j].item(),
+                        "n_samples": len(samples_per_label[j]),
+                    }
+                    if settings.PACKED_SAMPLES:
+                        to_write["s_idx"] = Binary(idx_per_label[j])
+                        to_write["s_tpm"] = Binary(
+                            group_values[j][i].astype(PackedSamples.TPM_DTYPE).tobytes()
+                        )
+                    else:
+                        to_write["samples"] = [
+                            {"label": sample_label, "tpm": tpm}
+                            for sample_label, tpm in zip(samples_per_label[j], group_values[j][i].tolist())
+                        ]
+                    operations.append(ReplaceOne(
+                        {
+                            "spe_id": species_id,
+                            "g_id": gene_id,
+                            "type": annotation_type,
+                            "label": annotation_label,
+                        },
+                        to_write,
+                        upsert=True
+                    ))
+                summary.n_genes += 1
+            if operations:
+                _ = SA_COLL.bulk_write(operations, ordered=False)
+                summary.n_docs_written += len(operations)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={
+                "description": f"TPM matrix could not be parsed: {e}",
+                "documents_written": summary.n_docs_written,
+                "recommendations": [
+                    "Every row should have one gene label followed by one numeric TPM value per sample",
+                    "Rows before the malformed one were stored, fix the matrix and upload it again",
+                ]
+            }
+        )
+    finally:
+        _ = bump_data_version(species_data_key(species_id), db)
+        bump_sample_annotation_labels(((annotation_type, label) for label in annotation_labels), db)
+    return summary
 
 
 # # DEPRECATED
@@ -228,7 +754,10 @@ def update_affected_spm(
 #         })
 #         return [SampleAnnotationOut(**doc) for doc in pointer]
 #     except BulkWriteError as e:
-#         print(f"Only {e.details['nInserted']} / {len(to_insert)} sample annotations are newly inserted into the sample annotations collection")
+#         print(
+#             f"Only {e.details['nInserted']} / {len(to_insert)} sample annotations "
+#             "are newly inserted into the sample annotations collection"
+#         )
 #         print(f"writeErrors: {e.details['writeErrors']}")
 #         # Return only newly inserted documents
 #         existing_ids = [doc['op']['_id'] for doc in e.details['writeErrors']]
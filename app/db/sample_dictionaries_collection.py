@@ -0,0 +1,107 @@
+from threading import Lock
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.database import Database
+
+from app.db.setup import get_async_collection, get_collection
+from app.models.sample_annotation import PackedSamples, SampleDictionaryDoc
+
+#
+# Sample dictionaries are append only, so a cached copy is always a prefix
+#   of the stored one and only needs refreshing when an unknown label or
+#   an out of range index is met
+#
+_labels_cache: dict[tuple[str, ObjectId], list[str]] = {}
+_labels_lock = Lock()
+
+
+def __cache_labels(
+    species_id: ObjectId,
+    labels: list[str],
+    db: Database | AsyncIOMotorDatabase
+) -> list[str]:
+    with _labels_lock:
+        _labels_cache[(db.name, species_id)] = labels
+    return labels
+
+
+def find_sample_labels(species_id: ObjectId, db: Database, min_length: int = 0) -> list[str]:
+    # min_length: refresh the cached copy if it is shorter than this
+    labels = _labels_cache.get((db.name, species_id))
+    if labels is not None and len(labels) >= min_length:
+        return labels
+    SD_COLL = get_collection(SampleDictionaryDoc, db)
+    sd_dict = SD_COLL.find_one({"spe_id": species_id}, {"labels": 1})
+    return __cache_labels(species_id, sd_dict["labels"] if sd_dict else [], db)
+
+
+async def find_sample_labels_async(
+    species_id: ObjectId,
+    db: AsyncIOMotorDatabase,
+    min_length: int = 0
+) -> list[str]:
+    labels = _labels_cache.get((db.name, species_id))
+    if labels is not None and len(labels) >= min_length:
+        return labels
+    SD_COLL = get_async_collection(SampleDictionaryDoc, db)
+    sd_dict = await SD_COLL.find_one({"spe_id": species_id}, {"labels": 1})
+    return __cache_labels(species_id, sd_dict["labels"] if sd_dict else [], db)
+
+
+def assign_sample_indices(species_id: ObjectId, labels: list[str], db: Database) -> dict[str, int]:
+    # Returns the index of every given label, appending unseen labels to the dictionary
+    known = find_sample_labels(species_id, db)
+    known_set = set(known)
+    new_labels = [label for label in dict.fromkeys(labels) if label not in known_set]
+    SD_COLL = get_collection(SampleDictionaryDoc, db)
+    while new_labels:
+        if known:
+            # Appends only if none of the labels got in meanwhile, so that positions
+            #   stay unique and stable for concurrent writers of the same species
+            sd_dict = SD_COLL.find_one_and_update(
+                {"spe_id": species_id, "labels": {"$nin": new_labels}},
+                {"$push": {"labels": {"$each": new_labels}}},
+                projection={"labels": 1},
+                return_document=ReturnDocument.AFTER
+            ) or SD_COLL.find_one({"spe_id": species_id}, {"labels": 1})
+        else:
+            sd_dict = SD_COLL.find_one_and_update(
+                {"spe_id": species_id},
+                {"$setOnInsert": {"labels": new_labels}},
+                projection={"labels": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        known = __cache_labels(species_id, sd_dict["labels"], db)
+        known_set = set(known)
+        new_labels = [label for label in new_labels if label not in known_set]
+    index = {label: i for i, label in enumerate(known)}
+    return {label: index[label] for label in labels}
+
+
+def unpack_sa_dict(sa_dict: dict, db: Database) -> dict:
+    # SA dict straight from the DB -> SA dict with embedded samples, whichever the storage
+    if not PackedSamples.is_packed(sa_dict):
+        return sa_dict
+    indices = PackedSamples.indices(sa_dict)
+    min_length = int(indices.max()) + 1 if len(indices) else 0
+    return PackedSamples.unpack(sa_dict, find_sample_labels(sa_dict["spe_id"], db, min_length))
+
+
+async def unpack_sa_dict_async(sa_dict: dict, db: AsyncIOMotorDatabase) -> dict:
+    if not PackedSamples.is_packed(sa_dict):
+        return sa_dict
+    indices = PackedSamples.indices(sa_dict)
+    min_length = int(indices.max()) + 1 if len(indices) else 0
+    return PackedSamples.unpack(sa_dict, await find_sample_labels_async(sa_dict["spe_id"], db, min_length))
+
+
+def sample_labels_of(sa_dict: dict, db: Database) -> list[str]:
+    # sa_dict needs `spe_id` and either `samples.label` or `s_idx`
+    if not PackedSamples.is_packed(sa_dict):
+        return [sample["label"] for sample in sa_dict.get("samples", [])]
+    indices = PackedSamples.indices(sa_dict).tolist()
+    min_length = max(indices) + 1 if indices else 0
+    labels = find_sample_labels(sa_dict["spe_id"], db, min_length)
+    return [labels[i] for i in indices]
@@ -1,16 +1,21 @@
+import asyncio
 from functools import lru_cache
 import uuid
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
 from pydantic.main import ModelMetaclass
-from pymongo import ASCENDING, MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient
 from pymongo.database import Database
 from pymongo.collection import Collection
-from passlib.context import CryptContext
 
+from app.models.coexpression_network import CoexpressionNeighboursDoc
+from app.models.data_version import DataVersionDoc
 from app.models.gene import GeneDoc
 from app.models.gene_annotation import GeneAnnotationDoc
-from app.models.sample_annotation import SampleAnnotationDoc
+from app.models.job import JobDoc, JobLockDoc
+from app.models.sample_annotation import SampleAnnotationDoc, SampleDictionaryDoc
 from app.models.species import SpeciesDoc
 from app.models.user import UserDoc
+from app.utils.passwords import hash_password
 from config import settings
 
 
@@ -43,6 +48,13 @@ def setup_indexes(db):
         name="unique_gene_annotations_type_and_label"
     )
     #
+    # To find the gene annotations of a gene, eg to remove a deleted gene from them
+    #
+    get_collection(GeneAnnotationDoc, db).create_index(
+        [("gene_ids", ASCENDING)],
+        name="gene_annotations_by_gene_ids"
+    )
+    #
     # To search sample annotations by species + gene (+ type + label)
     #
     get_collection(SampleAnnotationDoc, db).create_index(
@@ -56,11 +68,69 @@ def setup_indexes(db):
         name="unique_sample_annotation_doc"
     )
     #
-    # To search sample annotations by type + label
+    # To search sample annotations by type + label, paged in _id order
+    #   supersedes the former (type, label) index "sample_annotation_by_type_labels",
+    #   dropped from existing databases so that SA writes do not update both
     #
-    get_collection(SampleAnnotationDoc, db).create_index(
-        [("type", ASCENDING), ("label", ASCENDING)],
-        name="sample_annotation_by_type_labels"
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    SA_COLL.create_index(
+        [("type", ASCENDING), ("label", ASCENDING), ("_id", ASCENDING)],
+        name="sample_annotation_by_type_label_id"
+    )
+    if "sample_annotation_by_type_labels" in SA_COLL.index_information():
+        SA_COLL.drop_index("sample_annotation_by_type_labels")
+    #
+    # To rank the SA docs of an annotation label within each species, by SPM or average TPM
+    #   see find_top_sample_annotations
+    #
+    for rank_by in ("spm", "avg_tpm"):
+        get_collection(SampleAnnotationDoc, db).create_index(
+            [
+                ("type", ASCENDING),
+                ("label", ASCENDING),
+                ("spe_id", ASCENDING),
+                (rank_by, DESCENDING),
+                ("_id", ASCENDING),
+            ],
+            name=f"sample_annotation_by_type_label_species_{rank_by}"
+        )
+    #
+    # One sample dictionary per species, for packed samples storage
+    #
+    get_collection(SampleDictionaryDoc, db).create_index(
+        [("spe_id", ASCENDING)],
+        unique=True,
+        name="unique_sample_dictionary_species"
+    )
+    #
+    # One set of co-expression neighbours per gene, see coexpression_networks_collection
+    #
+    get_collection(CoexpressionNeighboursDoc, db).create_index(
+        [("spe_id", ASCENDING), ("g_id", ASCENDING)],
+        unique=True,
+        name="unique_coexpression_neighbours_gene"
+    )
+    #
+    # To look up data versions, eg of a species' expression data
+    #
+    get_collection(DataVersionDoc, db).create_index(
+        [("key", ASCENDING)],
+        unique=True,
+        name="unique_data_version_keys"
+    )
+    #
+    # To claim queued jobs in order
+    #
+    get_collection(JobDoc, db).create_index(
+        [("status", ASCENDING), ("created_at", ASCENDING)],
+        name="jobs_by_status"
+    )
+    #
+    # To renew and release the locks held by a job
+    #
+    get_collection(JobLockDoc, db).create_index(
+        [("job_id", ASCENDING)],
+        name="job_locks_by_job"
     )
     #
     # To search for users by email
@@ -82,13 +152,12 @@ def setup_indexes(db):
 
 def run_seeder(db: Database) -> None:
     USERS_COLL = get_collection(UserDoc, db)
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     user_dict = USERS_COLL.find_one({"email": settings.ADMIN_EMAIL})
     if user_dict is None:
         USERS_COLL.insert_one({
             "email": settings.ADMIN_EMAIL,
             "role": "admin",
-            "hashed_pw": pwd_context.hash(settings.ADMIN_PW.get_secret_value()),
+            "hashed_pw": hash_password(settings.ADMIN_PW.get_secret_value()),
             "api_key": uuid.uuid4().hex
         })
         print(f"Created admin user {settings.ADMIN_EMAIL}")
@@ -113,3 +182,38 @@ def get_db():
 def get_collection(model: ModelMetaclass, db: Database) -> Collection:
     assert hasattr(model, "Mongo"), f"{model.__name__} should inherit from DocumentBaseModel"
     return db[model.Mongo.collection_name]  # type: ignore
+
+
+#
+# Async access for read paths, through motor
+# A motor client is bound to the event loop it is created in,
+#   so one client is kept per running loop
+#
+_async_clients: dict[asyncio.AbstractEventLoop, AsyncIOMotorClient] = {}
+
+
+def get_async_client() -> AsyncIOMotorClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncIOMotorClient(settings.DATABASE_URL, io_loop=loop)
+        _async_clients[loop] = client
+    return client
+
+
+def close_async_client() -> None:
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        client.close()
+
+
+# Must be a coroutine, so that FastAPI resolves it in the event loop
+async def get_async_db() -> AsyncIOMotorDatabase:
+    if settings.DATABASE_NAME is None or settings.DATABASE_NAME == "":
+        raise ValueError("DATABASE_NAME env variable missing")
+    return get_async_client()[settings.DATABASE_NAME]
+
+
+def get_async_collection(model: ModelMetaclass, db: AsyncIOMotorDatabase) -> AsyncIOMotorCollection:
+    assert hasattr(model, "Mongo"), f"{model.__name__} should inherit from DocumentBaseModel"
+    return db[model.Mongo.collection_name]  # type: ignore
@@ -1,14 +1,33 @@
 import math
+from typing import Callable
 from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo import ReturnDocument
 # from pydantic import ValidationError
 from pymongo.database import Database
 from pymongo.errors import BulkWriteError
 
-from app.db.setup import get_collection
+from app.db.counts_collection import find_count
+from app.db.data_versions_collection import (
+    GENE_ANNOTATIONS_DATA_KEY,
+    SPECIES_DATA_KEY,
+    bump_data_version,
+    bump_sample_annotation_labels,
+    species_data_key,
+    species_genes_data_key,
+)
+from app.db.pagination import find_page, page_size_of
+from app.db.setup import get_async_collection, get_collection
+from app.db.species_exports import delete_species_exports
+from app.db.species_registry import find_registered_species, find_registered_species_async
+from app.models.coexpression_network import CoexpressionNeighboursDoc
+from app.models.gene import GeneDoc
+from app.models.gene_annotation import GeneAnnotationDoc
+from app.models.sample_annotation import SampleAnnotationDoc, SampleDictionaryDoc
 from app.models.shared import PyObjectId
 from app.models.species import (
     SpeciesBase,
+    SpeciesDataDeleteSummary,
     SpeciesDoc,
     SpeciesIn,
     SpeciesOut,
@@ -18,18 +37,21 @@ from app.models.species import (
 from config import settings
 
 
-def find_all_species(page_num: int, db: Database) -> SpeciesPage:
-    SPECIES_COLL = get_collection(SpeciesDoc, db)
-    species_docs = [
-        SpeciesOut(**species_dict)
-        for species_dict in SPECIES_COLL.find()
-        .skip((page_num - 1) * settings.PAGE_SIZE)
-        .limit(settings.PAGE_SIZE)
-    ]
+async def find_all_species(
+    page_num: int,
+    db: AsyncIOMotorDatabase,
+    cursor: str | None = None,
+    page_size: int | None = None
+) -> SpeciesPage:
+    SPECIES_COLL = get_async_collection(SpeciesDoc, db)
+    species_dicts, next_cursor = await find_page(SPECIES_COLL, {}, ["_id"], page_num, cursor, page_size)
     return SpeciesPage(
-        page_total=math.ceil(SPECIES_COLL.estimated_document_count() / settings.PAGE_SIZE),
+        page_total=math.ceil(
+            await find_count(SPECIES_COLL, {}, SPECIES_DATA_KEY, db) / page_size_of(page_size)
+        ),
         curr_page=page_num,
-        payload=species_docs
+        payload=[SpeciesOut(**species_dict) for species_dict in species_dicts],
+        next_cursor=next_cursor
     )
     # try:
     #     return SpeciesPage(
@@ -53,6 +75,7 @@ def insert_one_species(species_in: SpeciesIn, db: Database) -> SpeciesOut:
     species_doc = SpeciesBase(**species_in.dict_for_db())
     to_insert = species_doc.dict_for_db()
     _ = SPECIES_COLL.insert_one(to_insert)
+    _ = bump_data_version(SPECIES_DATA_KEY, db)
     return SpeciesOut(**to_insert)
 
 
@@ -82,6 +105,8 @@ def insert_many_species(species_in_list: list[SpeciesIn], db: Database) -> list[
             "_id": {"$in": new_ids}
         })
         return [SpeciesOut(**doc) for doc in pointer]
+    finally:
+        _ = bump_data_version(SPECIES_DATA_KEY, db)
 
 
 def insert_or_replace_many_species(species_in_list: list[SpeciesIn], db: Database) -> list[SpeciesOut]:
@@ -97,6 +122,7 @@ def insert_or_replace_many_species(species_in_list: list[SpeciesIn], db: Databas
         )
         final_docs.append(to_write)
         # BUG: _id is not updated in the dict
+    _ = bump_data_version(SPECIES_DATA_KEY, db)
     return final_docs
 
 
@@ -118,9 +144,80 @@ def delete_one_species(taxid: int, db: Database) -> SpeciesOut:
                 ],
             }
         )
+    _ = bump_data_version(SPECIES_DATA_KEY, db)
     return SpeciesOut(**deleted)
 
 
+def delete_species_doc(species_id: PyObjectId, db: Database) -> SpeciesOut | None:
+    # None if already deleted, eg by an earlier attempt of a job
+    SPECIES_COLL = get_collection(SpeciesDoc, db)
+    deleted = SPECIES_COLL.find_one_and_delete({"_id": species_id}, {"_id": 0})
+    if deleted is None:
+        return None
+    _ = bump_data_version(SPECIES_DATA_KEY, db)
+    return SpeciesOut(**deleted)
+
+
+#
+# Removes what belongs to a species, before its species doc is deleted:
+#   its genes, their references from gene annotations, its SA docs,
+#   its sample dictionary, its co-expression network and its export files
+# Genes are removed in chunks of DELETE_CHUNK_GENES, each with a few
+#   set operations along indexes, so that no single write holds the
+#   collections for long whatever the size of the species.
+# Idempotent, a job interrupted midway resumes where it stopped.
+#
+def delete_species_data(
+    species_id: PyObjectId,
+    db: Database,
+    progress: Callable[[int, int], None] | None = None
+) -> SpeciesDataDeleteSummary:
+    GENES_COLL = get_collection(GeneDoc, db)
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    summary = SpeciesDataDeleteSummary()
+    n_genes_total = GENES_COLL.count_documents({"spe_id": species_id})
+    # Annotation labels whose counts across species drop with the SA docs
+    sa_labels = [
+        (group["_id"]["type"], group["_id"]["label"])
+        for group in SA_COLL.aggregate([
+            {"$match": {"spe_id": species_id}},
+            {"$group": {"_id": {"type": "$type", "label": "$label"}}},
+        ])
+    ]
+    try:
+        while True:
+            gene_ids = [
+                gene_dict["_id"]
+                for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"_id": 1}).limit(settings.DELETE_CHUNK_GENES)
+            ]
+            if len(gene_ids) == 0:
+                break
+            result = GA_COLL.update_many(
+                {"gene_ids": {"$in": gene_ids}},
+                {"$pull": {"gene_ids": {"$in": gene_ids}}}
+            )
+            summary.n_gene_annotation_updates += result.modified_count
+            result = SA_COLL.delete_many({"spe_id": species_id, "g_id": {"$in": gene_ids}})
+            summary.n_sample_annotations += result.deleted_count
+            result = GENES_COLL.delete_many({"_id": {"$in": gene_ids}})
+            summary.n_genes += result.deleted_count
+            if progress is not None:
+                progress(summary.n_genes, n_genes_total)
+        # SA docs left behind by genes deleted before deletes cascaded
+        result = SA_COLL.delete_many({"spe_id": species_id})
+        summary.n_sample_annotations += result.deleted_count
+        _ = get_collection(SampleDictionaryDoc, db).delete_one({"spe_id": species_id})
+        _ = get_collection(CoexpressionNeighboursDoc, db).delete_many({"spe_id": species_id})
+        delete_species_exports(species_id, db)
+    finally:
+        _ = bump_data_version(species_data_key(species_id), db)
+        _ = bump_data_version(species_genes_data_key(species_id), db)
+        bump_sample_annotation_labels(sa_labels, db)
+        _ = bump_data_version(GENE_ANNOTATIONS_DATA_KEY, db)
+    return summary
+
+
 def update_one_species(species_id: PyObjectId, updates: SpeciesUpdate, db: Database) -> SpeciesOut:
     SPECIES_COLL = get_collection(SpeciesDoc, db)
     updated = SPECIES_COLL.find_one_and_update(
@@ -128,6 +225,7 @@ def update_one_species(species_id: PyObjectId, updates: SpeciesUpdate, db: Datab
         {"$set": updates.dict(exclude_unset=True)},
         return_document=ReturnDocument.AFTER
     )
+    _ = bump_data_version(SPECIES_DATA_KEY, db)
     return SpeciesOut(**updated)
 
 
@@ -143,7 +241,8 @@ def enforce_no_existing_species_in_list(species_in_list: list[SpeciesIn], db: Da
                 "description": "Some taxids already exist in the DB.",
                 "taxids": list(overlaps),
                 "recommendations": [
-                    "To ignore existing taxids and insert only new taxids, add `skip_duplicates=True` to the query parameters.",
+                    "To ignore existing taxids and insert only new taxids, "
+                    "add `skip_duplicates=True` to the query parameters.",
                     "To replace existing taxids, delete the current species document before inserting the new one.",
                     "Alternatively, to replace species docs in bulk, use the bulk PUT request at the same url path"
                 ]
@@ -169,43 +268,37 @@ def enforce_taxid_not_exist(taxid: int, db: Database) -> None:
     return None
 
 
-def find_species_id_from_taxid(taxid: int, db: Database) -> PyObjectId:
-    SPECIES_COLL = get_collection(SpeciesDoc, db)
-    species_dict = SPECIES_COLL.find_one(
-        {"tax": taxid},
-        {"_id": 1}
+def __species_not_found(taxid: int) -> HTTPException:
+    return HTTPException(
+        status_code=404,
+        detail={
+            "taxid": taxid,
+            "description": f"species of taxid {taxid} not found",
+            "recommendations": [
+                "Ensure taxid given in url is correct",
+                "Insert species into the DB via the species POST request endpoint"
+            ],
+        }
     )
-    if species_dict is None:
-        raise HTTPException(
-            status_code=404,
-            detail={
-                "taxid": taxid,
-                "description": f"species of taxid {taxid} not found",
-                "recommendations": [
-                    "Ensure taxid given in url is correct",
-                    "Insert species into the DB via the species POST request endpoint"
-                ],
-            }
-        )
-    return PyObjectId(species_dict["_id"])
 
 
-def find_one_species_by_taxid(taxid: int, db: Database) -> SpeciesOut:
-    SPECIES_COLL = get_collection(SpeciesDoc, db)
-    species_dict = SPECIES_COLL.find_one({
-        "tax": taxid
-    })
-    if species_dict is None:
-        raise HTTPException(
-            status_code=404,
-            detail={
-                "taxid": taxid,
-                "description": f"species of taxid {taxid} not found",
-                "recommendations": [
-                    "Ensure taxid given in url is correct",
-                    "Insert species into the DB via the species POST request endpoint"
-                ],
-            }
-        )
-    # TODO: Load into model for typecast checks
-    return species_dict
+# Taxid lookups are served by the in-process species registry
+def find_species_id_from_taxid(taxid: int, db: Database) -> PyObjectId:
+    species = find_registered_species(taxid, db)
+    if species is None:
+        raise __species_not_found(taxid)
+    return species.id
+
+
+async def find_species_id_from_taxid_async(taxid: int, db: AsyncIOMotorDatabase) -> PyObjectId:
+    species = await find_registered_species_async(taxid, db)
+    if species is None:
+        raise __species_not_found(taxid)
+    return species.id
+
+
+async def find_one_species_by_taxid(taxid: int, db: AsyncIOMotorDatabase) -> SpeciesOut:
+    species = await find_registered_species_async(taxid, db)
+    if species is None:
+        raise __species_not_found(taxid)
+    return species
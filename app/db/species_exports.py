@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+import time
+from collections import defaultdict
+from enum import Enum
+from threading import Lock
+from typing import Iterator
+import pyarrow as pa
+from bson import ObjectId
+from pymongo.database import Database
+
+from app.db.data_versions_collection import (
+    GENE_ANNOTATIONS_DATA_KEY,
+    find_data_version,
+    species_data_key,
+)
+from app.db.sample_dictionaries_collection import find_sample_labels
+from app.db.setup import get_collection
+from app.models.gene import GeneDoc
+from app.models.gene_annotation import GeneAnnotationDoc
+from app.models.sample_annotation import PackedSamples, SampleAnnotationDoc
+from app.utils.columnar import ColumnarFormat, iter_record_batches, write_columnar_file
+from config import settings
+
+#
+# Whole species datasets as Parquet or Arrow IPC files, for bulk downloads
+#   Files are keyed by the data versions they were read from, under
+#     EXPORT_CACHE_DIR/<db name>/<species id>/<dataset>.<version>.<format>
+#   so that repeat downloads are static files until the species data changes.
+#   Files of older versions may still be about to be sent by other requests,
+#   they are removed EXPORT_CACHE_GRACE seconds after a newer version is written.
+#   Documents are read with one cursor per dataset and written in record batches
+#   of EXPORT_BATCH_ROWS rows; only the gene labels and ids of the species are
+#   held whole in memory.
+#
+
+
+class ExportDataset(str, Enum):
+    GENES = "genes"
+    #   one row per gene, with its aliases and annotation ids
+    GENE_ANNOTATIONS = "gene_annotations"
+    #   one row per annotation with genes in the species, gene ids of the species only
+    EXPRESSION = "expression"
+    #   one row per (gene, annotation, sample) TPM value
+
+
+EXPORT_SCHEMAS = {
+    ExportDataset.GENES: pa.schema([
+        ("gene_id", pa.string()),
+        ("label", pa.string()),
+        ("alias", pa.list_(pa.string())),
+        ("annotation_ids", pa.list_(pa.string())),
+    ]),
+    ExportDataset.GENE_ANNOTATIONS: pa.schema([
+        ("annotation_id", pa.string()),
+        ("type", pa.string()),
+        ("label", pa.string()),
+        ("details", pa.string()),
+        #   JSON, as details have no fixed schema
+        ("gene_ids", pa.list_(pa.string())),
+    ]),
+    ExportDataset.EXPRESSION: pa.schema([
+        ("gene_id", pa.string()),
+        ("gene_label", pa.string()),
+        ("annotation_type", pa.string()),
+        ("annotation_label", pa.string()),
+        ("sample_label", pa.string()),
+        ("tpm", pa.float64()),
+    ]),
+}
+
+SUPERSEDED_SUFFIX = ".superseded"
+#   of the marker file of an export, dated when a newer version was first written
+
+_build_locks: dict[tuple[str, ObjectId, ExportDataset, ColumnarFormat], Lock] = defaultdict(Lock)
+
+
+def __iter_gene_chunks(species_id: ObjectId, db: Database) -> Iterator[dict[str, list]]:
+    GENES_COLL = get_collection(GeneDoc, db)
+    for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"label": 1, "alias": 1, "anots": 1}):
+        yield {
+            "gene_id": [str(gene_dict["_id"])],
+            "label": [gene_dict["label"]],
+            "alias": [gene_dict.get("alias", [])],
+            "annotation_ids": [[str(ga_id) for ga_id in gene_dict.get("anots", [])]],
+        }
+
+
+def __iter_ga_chunks(species_id: ObjectId, db: Database) -> Iterator[dict[str, list]]:
+    GENES_COLL = get_collection(GeneDoc, db)
+    GA_COLL = get_collection(GeneAnnotationDoc, db)
+    species_gene_ids = [gene_dict["_id"] for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"_id": 1})]
+    species_gene_set = set(species_gene_ids)
+    seen: set[ObjectId] = set()
+    # Only the GAs of the species are read, along the gene_ids index
+    for start in range(0, len(species_gene_ids), settings.BULK_WRITE_CHUNK_SIZE):
+        for ga_dict in GA_COLL.find(
+            {"gene_ids": {"$in": species_gene_ids[start:start + settings.BULK_WRITE_CHUNK_SIZE]}},
+            {"type": 1, "label": 1, "details": 1, "gene_ids": 1}
+        ):
+            if ga_dict["_id"] in seen:
+                continue  # read with an earlier chunk of genes already
+            seen.add(ga_dict["_id"])
+            yield {
+                "annotation_id": [str(ga_dict["_id"])],
+                "type": [ga_dict["type"]],
+                "label": [ga_dict["label"]],
+                "details": [json.dumps(ga_dict["details"]) if ga_dict.get("details") is not None else None],
+                "gene_ids": [[
+                    str(gene_id) for gene_id in dict.fromkeys(ga_dict.get("gene_ids", []))
+                    if gene_id in species_gene_set
+                ]],
+            }
+
+
+def __iter_expression_chunks(species_id: ObjectId, db: Database) -> Iterator[dict[str, list]]:
+    GENES_COLL = get_collection(GeneDoc, db)
+    SA_COLL = get_collection(SampleAnnotationDoc, db)
+    gene_labels = {
+        gene_dict["_id"]: gene_dict["label"]
+        for gene_dict in GENES_COLL.find({"spe_id": species_id}, {"label": 1})
+    }
+    dict_labels = find_sample_labels(species_id, db)
+    for sa_dict in SA_COLL.find(
+        {"spe_id": species_id},
+        {"spe_id": 1, "g_id": 1, "type": 1, "label": 1, "samples": 1, "s_idx": 1, "s_tpm": 1}
+    ):
+        if PackedSamples.is_packed(sa_dict):
+            indices = PackedSamples.indices(sa_dict).tolist()
+            if indices and max(indices) >= len(dict_labels):
+                dict_labels = find_sample_labels(species_id, db, max(indices) + 1)
+            sample_labels = [dict_labels[i] for i in indices]
+            tpms = PackedSamples.tpms(sa_dict).tolist()
+        else:
+            samples = sa_dict.get("samples", [])
+            sample_labels = [sample["label"] for sample in samples]
+            tpms = [sample["tpm"] for sample in samples]
+        n = len(tpms)
+        yield {
+            "gene_id": [str(sa_dict["g_id"])] * n,
+            "gene_label": [gene_labels.get(sa_dict["g_id"])] * n,
+            "annotation_type": [sa_dict["type"]] * n,
+            "annotation_label": [sa_dict["label"]] * n,
+            "sample_label": sample_labels,
+            "tpm": tpms,
+        }
+
+
+EXPORT_CHUNKS = {
+    ExportDataset.GENES: __iter_gene_chunks,
+    ExportDataset.GENE_ANNOTATIONS: __iter_ga_chunks,
+    ExportDataset.EXPRESSION: __iter_expression_chunks,
+}
+
+
+def __export_version(species_id: ObjectId, dataset: ExportDataset, db: Database) -> str:
+    version = find_data_version(species_data_key(species_id), db)
+    if dataset == ExportDataset.EXPRESSION:
+        return version
+    # Genes list the annotations linked to them, which GA writes change
+    return f"{version}-{find_data_version(GENE_ANNOTATIONS_DATA_KEY, db)}"
+
+
+def __species_dir(species_id: ObjectId, db: Database) -> str:
+    return os.path.join(settings.EXPORT_CACHE_DIR, db.name, str(species_id))
+
+
+def __remove_superseded(
+    species_id: ObjectId,
+    dataset: ExportDataset,
+    file_format: ColumnarFormat,
+    db: Database
+) -> None:
+    # The current version is read again, as the version a slow request wrote
+    #   its file for may already be older than the files of other requests
+    species_dir = __species_dir(species_id, db)
+    current = __export_version(species_id, dataset, db)
+    now = time.time()
+    head, tail = f"{dataset.value}.", f".{file_format.value}"
+    for entry in os.listdir(species_dir):
+        if not entry.startswith(head) or not entry.endswith(tail) or ".tmp-" in entry:
+            continue
+        if entry[len(head):-len(tail)] == current:
+            continue
+        path = os.path.join(species_dir, entry)
+        marker = f"{path}{SUPERSEDED_SUFFIX}"
+        try:
+            superseded_at = os.path.getmtime(marker)
+        except FileNotFoundError:
+            open(marker, "a").close()
+            continue
+        if now - superseded_at > settings.EXPORT_CACHE_GRACE:
+            for to_remove in (path, marker):
+                try:
+                    os.remove(to_remove)
+                except FileNotFoundError:
+                    pass  # removed by another worker meanwhile
+
+
+def get_species_export(
+    species_id: ObjectId,
+    dataset: ExportDataset,
+    file_format: ColumnarFormat,
+    db: Database
+) -> str:
+    # Path of the export file of the current data version, written on first request
+    species_dir = __species_dir(species_id, db)
+    # Versions are read first, so that a file is never newer than its version
+    version = __export_version(species_id, dataset, db)
+    path = os.path.join(species_dir, f"{dataset.value}.{version}.{file_format.value}")
+    if os.path.isfile(path):
+        return path
+    with _build_locks[(db.name, species_id, dataset, file_format)]:
+        if os.path.isfile(path):
+            return path
+        os.makedirs(species_dir, exist_ok=True)
+        schema = EXPORT_SCHEMAS[dataset]
+        _ = write_columnar_file(
+            path,
+            schema,
+            iter_record_batches(schema, EXPORT_CHUNKS[dataset](species_id, db), settings.EXPORT_BATCH_ROWS),
+            file_format
+        )
+        __remove_superseded(species_id, dataset, file_format, db)
+    return path
+
+
+def delete_species_exports(species_id: ObjectId, db: Database) -> None:
+    shutil.rmtree(__species_dir(species_id, db), ignore_errors=True)
+    for key in [key for key in _build_locks if key[:2] == (db.name, species_id)]:
+        _ = _build_locks.pop(key, None)
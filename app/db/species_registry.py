@@ -0,0 +1,106 @@
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+
+from app.db.data_versions_collection import (
+    SPECIES_DATA_KEY,
+    add_data_version_listener,
+    find_data_version,
+    find_data_version_async,
+)
+from app.db.setup import get_async_collection, get_collection
+from app.models.species import SpeciesDoc, SpeciesOut
+from config import settings
+
+#
+# In-process copy of the species collection, a small and rarely changing table
+#   Lookups by taxid or species id cost no DB round trip. The copy is dropped on
+#   species writes made by this process, and checked against the species data
+#   version at most every SPECIES_REGISTRY_TTL seconds for writes made by others.
+#
+
+
+@dataclass
+class SpeciesRegistry:
+    version: str
+    species: list[SpeciesOut]
+    checked_at: float = field(default_factory=time.monotonic)
+    by_taxid: dict[int, SpeciesOut] = field(init=False)
+    by_id: dict[ObjectId, SpeciesOut] = field(init=False)
+
+    def __post_init__(self):
+        self.by_taxid = {species.tax: species for species in self.species}
+        self.by_id = {species.id: species for species in self.species}
+
+
+_registries: dict[str, SpeciesRegistry] = {}
+_load_lock = Lock()
+
+
+def __drop_registry(db_name: str, key: str | None) -> None:
+    if key is None or key == SPECIES_DATA_KEY:
+        _ = _registries.pop(db_name, None)
+
+
+add_data_version_listener(__drop_registry)
+
+
+def __is_fresh(registry: SpeciesRegistry | None) -> bool:
+    return registry is not None and time.monotonic() - registry.checked_at < settings.SPECIES_REGISTRY_TTL
+
+
+def get_species_registry(db: Database, recheck: bool = False) -> SpeciesRegistry:
+    # recheck: skip the TTL, eg when a taxid is missing from the registry
+    registry = _registries.get(db.name)
+    if not recheck and __is_fresh(registry):
+        return registry
+    with _load_lock:
+        # The version is read first, so that a registry is never newer than its version
+        version = find_data_version(SPECIES_DATA_KEY, db)
+        registry = _registries.get(db.name)
+        if registry is not None and registry.version == version:
+            registry.checked_at = time.monotonic()
+            return registry
+        SPECIES_COLL = get_collection(SpeciesDoc, db)
+        registry = SpeciesRegistry(
+            version=version,
+            species=[SpeciesOut(**species_dict) for species_dict in SPECIES_COLL.find()]
+        )
+        _registries[db.name] = registry
+    return registry
+
+
+async def get_species_registry_async(db: AsyncIOMotorDatabase, recheck: bool = False) -> SpeciesRegistry:
+    registry = _registries.get(db.name)
+    if not recheck and __is_fresh(registry):
+        return registry
+    version = await find_data_version_async(SPECIES_DATA_KEY, db)
+    registry = _registries.get(db.name)
+    if registry is not None and registry.version == version:
+        registry.checked_at = time.monotonic()
+        return registry
+    SPECIES_COLL = get_async_collection(SpeciesDoc, db)
+    registry = SpeciesRegistry(
+        version=version,
+        species=[SpeciesOut(**species_dict) async for species_dict in SPECIES_COLL.find()]
+    )
+    _registries[db.name] = registry
+    return registry
+
+
+def find_registered_species(taxid: int, db: Database) -> SpeciesOut | None:
+    species = get_species_registry(db).by_taxid.get(taxid)
+    if species is None:
+        # May have been inserted by another process since the last check
+        species = get_species_registry(db, recheck=True).by_taxid.get(taxid)
+    return species
+
+
+async def find_registered_species_async(taxid: int, db: AsyncIOMotorDatabase) -> SpeciesOut | None:
+    species = (await get_species_registry_async(db)).by_taxid.get(taxid)
+    if species is None:
+        species = (await get_species_registry_async(db, recheck=True)).by_taxid.get(taxid)
+    return species
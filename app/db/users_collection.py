@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 from bson import ObjectId
 from fastapi import (
@@ -14,12 +15,15 @@ from fastapi.security import (
 )
 from h11 import Data
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import EmailStr, ValidationError
 from pymongo.database import Database
 
-from app.db.setup import get_collection, get_db
+from app.db.data_versions_collection import USERS_DATA_KEY, bump_data_version
+from app.db.principal_cache import get_principal, set_principal, token_key
+from app.db.setup import get_async_collection, get_collection, get_db
 from app.models.user import Token, TokenData, User, UserDoc, UserOut, UserProcessed
+from app.utils.passwords import hash_password, verify_password, verify_password_async
 from config import settings
 
 
@@ -37,6 +41,14 @@ def find_all_users(db: Database) -> list[UserOut]:
     return results
 
 
+async def find_all_users_async(db: AsyncIOMotorDatabase) -> list[UserOut]:
+    USERS_COLL = get_async_collection(UserDoc, db)
+    return [
+        UserOut(**user_dict)
+        async for user_dict in USERS_COLL.find({}, {"hashed_pw": 0})
+    ]
+
+
 def find_user_from_db(email: str, db: Database) -> UserOut:
     # Only call this function if authenticated
     USERS_COLL = get_collection(UserDoc, db)
@@ -49,9 +61,11 @@ def find_user_from_db(email: str, db: Database) -> UserOut:
 
 def create_user(user: User, db: Database) -> UserOut:
     USERS_COLL = get_collection(UserDoc, db)
-    user_proc = UserProcessed(**user.dict_for_db(), hashed_pw=settings.ADMIN_PW.get_secret_value())
+    # New users start with the admin password, hashed (it was stored in plain text before)
+    user_proc = UserProcessed(**user.dict_for_db(), hashed_pw=hash_password(settings.ADMIN_PW.get_secret_value()))
     user_dict = user_proc.dict_for_db()
     _ = USERS_COLL.insert_one(user_dict)
+    _ = bump_data_version(USERS_DATA_KEY, db)
     user_dict.pop("hashed_pw")
     return UserOut(**user_dict)
 
@@ -61,6 +75,7 @@ def delete_user(id: ObjectId, db: Database) -> UserOut | None:
     user_dict = USERS_COLL.find_one_and_delete({"_id": id})
     if user_dict is None:
         return None
+    _ = bump_data_version(USERS_DATA_KEY, db)
     user_dict.pop("hashed_pw")
     return UserOut(**user_dict)
 
@@ -69,8 +84,6 @@ def delete_user(id: ObjectId, db: Database) -> UserOut | None:
 # Auth related functions
 #
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="api/v1/token",
     scopes={
@@ -80,22 +93,41 @@ oauth2_scheme = OAuth2PasswordBearer(
 )
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def __incorrect_credentials() -> HTTPException:
+    return HTTPException(status_code=400, detail="Incorrect email or password")
 
 
 def authenticate_user(email: str, password: str, db: Database) -> UserOut:
     USERS_COLL = get_collection(UserDoc, db)
     user_dict = USERS_COLL.find_one({"email": email})
     if user_dict is None:
-        raise HTTPException(status_code=400, detail="Incorrect email or password")
+        raise __incorrect_credentials()
     user = UserDoc(**user_dict)
-    if not verify_password(password, user.hashed_pw):
-        raise HTTPException(status_code=400, detail="Incorrect email or password")
+    valid, new_hash = verify_password(password, user.hashed_pw)
+    if not valid:
+        raise __incorrect_credentials()
+    if new_hash is not None:
+        # Hashed at another cost than BCRYPT_ROUNDS
+        _ = USERS_COLL.update_one({"_id": user.id, "hashed_pw": user.hashed_pw}, {"$set": {"hashed_pw": new_hash}})
+    user_dict.pop("hashed_pw")
+    return UserOut(**user_dict)
+
+
+async def authenticate_user_async(email: str, password: str, db: AsyncIOMotorDatabase) -> UserOut:
+    # bcrypt runs on the password hashing pool, the event loop stays free meanwhile
+    USERS_COLL = get_async_collection(UserDoc, db)
+    user_dict = await USERS_COLL.find_one({"email": email})
+    if user_dict is None:
+        raise __incorrect_credentials()
+    user = UserDoc(**user_dict)
+    valid, new_hash = await verify_password_async(password, user.hashed_pw)
+    if not valid:
+        raise __incorrect_credentials()
+    if new_hash is not None:
+        _ = await USERS_COLL.update_one(
+            {"_id": user.id, "hashed_pw": user.hashed_pw},
+            {"$set": {"hashed_pw": new_hash}}
+        )
     user_dict.pop("hashed_pw")
     return UserOut(**user_dict)
 
@@ -108,6 +140,33 @@ def create_access_token(data: dict) -> str:
     return encoded_jwt
 
 
+def __find_token_principal(
+    token: str,
+    credentials_exception: HTTPException,
+    db: Database
+) -> tuple[UserOut, list[str]]:
+    # User and scopes of a JWT, from the principal cache when the token was seen before
+    key = token_key(token)
+    principal = get_principal(db.name, "token", key)
+    if principal is not None:
+        return principal
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None:
+            raise credentials_exception
+        token_data = TokenData(scopes=payload.get("scopes", []), username=EmailStr(email))
+    except (JWTError, ValidationError):
+        raise credentials_exception
+    user = find_user_from_db(email=str(token_data.username), db=db)
+    if user is None:
+        raise credentials_exception
+    principal = (user, token_data.scopes)
+    expires_in = payload["exp"] - time.time() if "exp" in payload else None
+    set_principal(db.name, "token", key, principal, expires_in)
+    return principal
+
+
 def get_user_by_scope(
     security_scopes: SecurityScopes,
     token: str = Depends(oauth2_scheme),
@@ -122,20 +181,9 @@ def get_user_by_scope(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": authenticate_value},
     )
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_scopes = payload.get("scopes", [])
-        token_data = TokenData(scopes=token_scopes, username=EmailStr(email))
-    except (JWTError, ValidationError):
-        raise credentials_exception
-    user = find_user_from_db(email=str(token_data.username), db=db)
-    if user is None:
-        raise credentials_exception
+    user, token_scopes = __find_token_principal(token, credentials_exception, db)
     for scope in security_scopes.scopes:
-        if scope not in token_data.scopes:
+        if scope not in token_scopes:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Not enough permissions",
@@ -167,22 +215,9 @@ def get_user_by_cookie(authorization: str | None = Cookie(None), db: Database =
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    if authorization is None:
-        raise credentials_exception
-    try:
-        payload = jwt.decode(
-            authorization.split()[1],
-            settings.SECRET_KEY,
-            algorithms=[settings.ALGORITHM]
-        )
-        email = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except (JWTError, ValidationError):
-        raise credentials_exception
-    user = find_user_from_db(email=email, db=db)
-    if user is None:
+    if authorization is None or len(authorization.split()) != 2:
         raise credentials_exception
+    user, _ = __find_token_principal(authorization.split()[1], credentials_exception, db)
     return user
 
 
@@ -201,6 +236,8 @@ def verify_api_key(api_key: str | None = None, db: Database = Depends(get_db)) -
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate api_key credentials"
         )
+    if get_principal(db.name, "api_key", api_key) is not None:
+        return True
     USERS_COLL = get_collection(UserDoc, db)
     user_dict = USERS_COLL.find_one({"api_key": api_key},  {"_id": 1})
     if user_dict is None:
@@ -208,4 +245,5 @@ def verify_api_key(api_key: str | None = None, db: Database = Depends(get_db)) -
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate api_key credentials"
         )
+    set_principal(db.name, "api_key", api_key, user_dict["_id"])
     return True
@@ -0,0 +1,244 @@
+#
+# Job handlers and the worker loop, run with:
+#   python -m app.cli worker
+# Routes queue a job (see app.db.jobs_collection.enqueue_job) under a handler kind,
+#   with JSON compatible params, and answer 202 with the queued job
+#
+import os
+import socket
+import threading
+import time
+import traceback
+from typing import Any, Callable
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from pymongo.database import Database
+
+from app.db.coexpression_networks_collection import build_coexpression_network
+from app.db.gene_annotations_collection import (
+    convert_many_ga_in_to_ga_procs,
+    insert_many_gas_in,
+    insert_or_append_many_gas,
+    insert_or_replace_many_gas,
+)
+from app.db.genes_collection import insert_many_genes_in, insert_or_replace_many_genes
+from app.db.jobs_collection import (
+    claim_next_job,
+    fail_job,
+    finish_job,
+    reap_expired_jobs,
+    renew_job_lease,
+    update_job_progress,
+)
+from app.db.sample_annotations_collection import insert_many_sa_inputs, recompute_species_stats
+from app.db.species_collection import delete_species_data, delete_species_doc
+from app.models.gene import GeneIn
+from app.models.gene_annotation import GeneAnnotationIn
+from app.models.job import JobDoc, JobOut
+from app.models.sample_annotation import CoexpressionMethod, SampleAnnotationInput
+from config import settings
+
+GENE_ANNOTATIONS_LOCK_KEY = "gene_annotations"
+#   gene annotations span species, their batch jobs are serialized together
+
+ProgressCallback = Callable[[int, int], None]
+JobHandler = Callable[[dict[str, Any], Database, ProgressCallback], Any]
+
+_handlers: dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    def register(handler: JobHandler) -> JobHandler:
+        _handlers[kind] = handler
+        return handler
+    return register
+
+
+def job_accepted(job: JobOut) -> Response:
+    return Response(
+        content=job.json(by_alias=True),
+        status_code=status.HTTP_202_ACCEPTED,
+        media_type="application/json",
+        headers={"Location": f"/api/v1/jobs/{job.id}"}
+    )
+
+
+#
+# Handlers
+#   Results are kept in the job doc, so they report counts rather than documents
+#   A job may run again after an attempt failed or lost its lease part way, so
+#   handlers are idempotent: documents are upserted or skipped by their natural
+#   keys (species + gene label, type + label, sample labels). Duplicates that
+#   should be rejected are checked by the routes before queuing.
+#
+
+
+@job_handler("sample_annotations.batch")
+def run_sa_batch(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    sa_ids = insert_many_sa_inputs(
+        parse_obj_as(list[SampleAnnotationInput], params["items"]),
+        True,
+        db,
+        progress
+    )
+    return {"n_docs_written": len(sa_ids)}
+
+
+@job_handler("sample_annotations.recompute_stats")
+def run_recompute_stats(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    return recompute_species_stats(params["species_id"], db, params["annotation_type"]).dict()
+
+
+@job_handler("genes.batch.post")
+def run_post_genes(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    gene_ids = insert_many_genes_in(
+        params["species_id"],
+        parse_obj_as(list[GeneIn], params["items"]),
+        True,
+        db
+    )
+    return {"n_docs_written": len(gene_ids)}
+
+
+@job_handler("genes.batch.put")
+def run_put_genes(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    genes_out = insert_or_replace_many_genes(
+        params["species_id"],
+        parse_obj_as(list[GeneIn], params["items"]),
+        db
+    )
+    return {"n_docs_written": len(genes_out)}
+
+
+@job_handler("coexpression.network")
+def run_build_network(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    return build_coexpression_network(
+        params["species_id"],
+        CoexpressionMethod(params["method"]),
+        params["k"],
+        db,
+        progress,
+        params["force"]
+    ).dict()
+
+
+@job_handler("species.delete")
+def run_delete_species(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    summary = delete_species_data(params["species_id"], db, progress)
+    # Only once its data is gone, so that a failed job can be retried by a new DELETE
+    _ = delete_species_doc(params["species_id"], db)
+    return summary.dict()
+
+
+@job_handler("gene_annotations.batch.post")
+def run_post_gas(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    ga_ids = insert_many_gas_in(
+        parse_obj_as(list[GeneAnnotationIn], params["items"]),
+        True,
+        db,
+        relink_existing=True
+    )
+    return {"n_docs_written": len(ga_ids)}
+
+
+@job_handler("gene_annotations.batch.put")
+def run_put_gas(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    ga_input = parse_obj_as(list[GeneAnnotationIn], params["items"])
+    ga_procs = convert_many_ga_in_to_ga_procs(ga_input, db)
+    return {"n_docs_written": len(insert_or_replace_many_gas(ga_procs, db))}
+
+
+@job_handler("gene_annotations.batch.patch")
+def run_patch_gas(params: dict[str, Any], db: Database, progress: ProgressCallback) -> dict:
+    ga_input = parse_obj_as(list[GeneAnnotationIn], params["items"])
+    ga_procs = convert_many_ga_in_to_ga_procs(ga_input, db)
+    gas_out = insert_or_append_many_gas(ga_procs, db)
+    progress(len(ga_procs), len(ga_procs))
+    return {"n_docs_written": len(gas_out)}
+
+
+#
+# Worker
+#
+
+
+class JobLeaseLost(Exception):
+    # Raised by the progress callback once the job was reaped from this worker,
+    #   so that the handler stops at its next progress report
+    pass
+
+
+class __Heartbeat(threading.Thread):
+    # Renews the lease of the running job, so that long jobs are not reaped
+    #   stops renewing once the job is owned by another attempt, see renew_job_lease
+    def __init__(self, job: JobDoc, db: Database):
+        super().__init__(daemon=True)
+        self.job = job
+        self.db = db
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(settings.JOB_LEASE_SECONDS / 3):
+            if not renew_job_lease(self.job, self.db):
+                self.lost.set()
+                return
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_next_job(db: Database, worker: str | None = None) -> JobDoc | None:
+    _ = reap_expired_jobs(db)
+    job = claim_next_job(worker or worker_name(), db)
+    if job is None:
+        return None
+    handler = _handlers.get(job.kind)
+    if handler is None:
+        fail_job(job, f"no handler for job kind {job.kind}", False, db)
+        return job
+    last_progress_at = 0.0
+    heartbeat = __Heartbeat(job, db)
+
+    def progress(done: int, total: int) -> None:
+        # At most one progress write per second
+        nonlocal last_progress_at
+        if heartbeat.lost.is_set():
+            raise JobLeaseLost()
+        if done == total or time.monotonic() - last_progress_at >= 1:
+            last_progress_at = time.monotonic()
+            if not update_job_progress(job, done, total, db):
+                heartbeat.lost.set()
+                raise JobLeaseLost()
+
+    heartbeat.start()
+    try:
+        result = handler(job.params, db, progress)
+    except JobLeaseLost:
+        # Another attempt owns the job now, it reports the outcome
+        pass
+    except HTTPException as e:
+        # Rejected input (eg unknown gene labels) fails the same way on every attempt
+        fail_job(job, e.detail, False, db)
+    except Exception:
+        fail_job(job, traceback.format_exc(limit=5), True, db)
+    else:
+        finish_job(job, jsonable_encoder(result), db)
+    finally:
+        heartbeat.stopped.set()
+    return job
+
+
+def run_worker(db: Database, once: bool = False) -> None:
+    worker = worker_name()
+    print(f"Worker {worker} polling for jobs")
+    while True:
+        job = run_next_job(db, worker)
+        if job is not None:
+            print(f"Ran job {job.id} ({job.kind}), attempt {job.attempts}")
+        elif once:
+            return
+        else:
+            time.sleep(settings.JOB_POLL_INTERVAL)
@@ -8,7 +8,14 @@ from .routes.api.v1 import (
     gene_annotations,
     sample_annotations,
     users,
+    jobs,
+    metrics,
+    coexpression,
+    exports,
 )
+from app.db.gene_index import warm_gene_indexes
+from app.db.setup import close_async_client, get_db
+from app.db.species_registry import get_species_registry
 from app.routes.users import router as user_router
 
 app = FastAPI(title=settings.TITLE)
@@ -18,11 +25,28 @@ app.include_router(genes.router)
 app.include_router(gene_annotations.router)
 app.include_router(sample_annotations.router)
 app.include_router(users.router)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
+app.include_router(coexpression.router)
+app.include_router(exports.router)
 # Templates
 app.include_router(user_router)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+@app.on_event("startup")
+def setup_db():
+    # Indexes are set up by the sync client, reads then go through motor
+    db = get_db()
+    _ = get_species_registry(db)
+    _ = warm_gene_indexes(db)
+
+
+@app.on_event("shutdown")
+async def close_db():
+    close_async_client()
+
+
 @app.get("/about")
 def get_about():
     return {"about": f"Welcome to {settings.TITLE}!"}
@@ -0,0 +1,57 @@
+from pydantic import Field
+
+from .sample_annotation import CoexpressionMethod
+from .shared import PyObjectId, CustomBaseModel, DocumentBaseModel
+
+#
+# Class naming conventions
+#   CoexpressionNeighboursDoc: top k co-expressed genes of one gene, as stored in DB
+#   CoexpressionNetworkNode, CoexpressionNetworkEdge, CoexpressionNetwork:
+#     subgraph of a species co-expression network, as returned as payload
+#
+
+
+class CoexpressionNeighboursDoc(CustomBaseModel, DocumentBaseModel):
+    id: PyObjectId | None = Field(alias="_id")
+    spe_id: PyObjectId = Field(alias="species_id")
+    g_id: PyObjectId = Field(alias="gene_id")
+    method: CoexpressionMethod
+    k: int
+    ver: str = Field(alias="data_version")
+    #   species data version the neighbours were computed from
+    n_s: int = Field(alias="n_samples")
+    nbr_ids: list[PyObjectId] = Field(alias="neighbour_ids")
+    nbr_scores: list[float] = Field(alias="neighbour_scores")
+    #   highest scores first
+
+    class Mongo:
+        collection_name: str = "coexpression_neighbours"
+
+
+class CoexpressionNetworkNode(CustomBaseModel):
+    gene_id: PyObjectId
+    gene_label: str | None
+    hops: int
+    #   distance from the gene the subgraph is centered on
+
+
+class CoexpressionNetworkEdge(CustomBaseModel):
+    source: PyObjectId
+    target: PyObjectId
+    score: float
+
+
+class CoexpressionNetwork(CustomBaseModel):
+    method: CoexpressionMethod
+    data_version: str
+    nodes: list[CoexpressionNetworkNode]
+    edges: list[CoexpressionNetworkEdge]
+
+
+class CoexpressionNetworkBuildSummary(CustomBaseModel):
+    method: CoexpressionMethod
+    k: int
+    data_version: str
+    n_genes: int = 0
+    skipped: bool = False
+    #   the network was already built from the current data version
@@ -0,0 +1,18 @@
+from pydantic import Field
+
+from .shared import CustomBaseModel, DocumentBaseModel
+
+#
+# Number of documents of a collection matching a filter,
+#   valid for one version of the data it counts (see DataVersionDoc)
+#
+
+
+class CountDoc(CustomBaseModel, DocumentBaseModel):
+    id: str = Field(alias="_id")
+    #   "<collection name>:<canonical JSON of the filter>"
+    ver: str
+    n: int = Field(ge=0)
+
+    class Mongo:
+        collection_name: str = "counts"
@@ -0,0 +1,22 @@
+from datetime import datetime
+from pydantic import Field
+
+from .shared import PyObjectId, CustomBaseModel, DocumentBaseModel
+
+#
+# A data version identifies the current state of some data (eg a species'
+#   expression data). It changes on every write to that data, so that derived
+#   artefacts (caches, exports) can be keyed by it.
+#
+
+
+class DataVersionDoc(CustomBaseModel, DocumentBaseModel):
+    id: PyObjectId | None = Field(alias="_id")
+    key: str
+    #   what the version is about, eg "species:<species ObjectId>"
+    ver: PyObjectId
+    #   a fresh ObjectId on every change
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+    class Mongo:
+        collection_name: str = "data_versions"
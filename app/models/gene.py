@@ -46,6 +46,14 @@ class GenePage(BasePageModel):
     payload: list[GeneOut]
 
 
+class GeneCompletion(CustomBaseModel):
+    taxid: int
+    gene_id: PyObjectId
+    gene_label: str
+    matched: str
+    #   upper cased label or alias starting with the searched prefix
+
+
 class GeneDoc(GeneBase, DocumentBaseModel):
     class Mongo:
         collection_name: str = "genes"
@@ -68,3 +68,56 @@ class GeneAnnotationDoc(GeneAnnotationProcessed, DocumentBaseModel):
 
     class Mongo:
         collection_name: str = "gene_annotations"
+
+
+class GeneAnnotationImportSummary(CustomBaseModel):
+    annotation_type: str
+    n_rows: int = 0
+    #   (gene, annotation) rows read from the file
+    n_annotations: int = 0
+    #   distinct annotation labels written
+    n_gene_links: int = 0
+    #   rows resolved to a gene of the species
+    n_unresolved_rows: int = 0
+    unresolved_gene_labels: list[str] = list()
+    #   first GA_IMPORT_MAX_REPORTED gene labels of the rows not resolved, not stored
+
+
+class GeneSetEnrichmentIn(CustomBaseModel):
+    annotation_type: str
+    gene_labels: list[str]
+    #   labels or aliases of genes of the species, eg co-expressed or organ specific ones
+    max_fdr: float = Field(0.05, ge=0, le=1)
+    limit: int = Field(100, ge=1)
+
+    @validator("annotation_type", pre=True)
+    def upcase_type(cls, v):
+        return v.upper()
+
+
+class EnrichedAnnotation(CustomBaseModel):
+    label: str
+    n_annotated: int
+    #   background genes with the annotation
+    n_overlap: int
+    #   genes of the set with the annotation
+    fold_enrichment: float
+    p_value: float
+    #   one sided hypergeometric (Fisher's exact) test for over-representation
+    fdr: float
+    #   Benjamini-Hochberg adjusted over all annotations of the type in the species
+    gene_labels: list[str]
+    #   genes of the set with the annotation
+
+
+class GeneSetEnrichment(CustomBaseModel):
+    annotation_type: str
+    n_genes: int
+    #   genes of the set with at least one annotation of the type
+    n_background: int
+    #   genes of the species with at least one annotation of the type
+    n_annotations: int
+    #   annotations of the type tested
+    unresolved_gene_labels: list[str] = list()
+    annotations: list[EnrichedAnnotation]
+    #   lowest p-values first, down to max_fdr
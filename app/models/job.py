@@ -0,0 +1,66 @@
+from datetime import datetime
+from enum import Enum
+from pydantic import Field
+from typing import Any
+
+from .shared import PyObjectId, CustomBaseModel, DocumentBaseModel
+
+#
+# Jobs are heavy operations (eg batch uploads) queued by the API
+#   and run by worker processes: python -m app.cli worker
+# Jobs sharing a lock key (eg "species:<species ObjectId>") run one at a time
+#
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class JobProgress(CustomBaseModel):
+    done: int = 0
+    total: int = 0
+
+
+class JobBase(CustomBaseModel):
+    id: PyObjectId | None = Field(alias="_id")
+    kind: str
+    #   name of the handler that runs the job, eg "sample_annotations.batch"
+    status: JobStatus = JobStatus.QUEUED
+    lock_keys: list[str] = list()
+    attempts: int = 0
+    max_attempts: int = Field(1, ge=1)
+    progress: JobProgress = Field(default_factory=JobProgress)
+    result: Any | None = None
+    error: Any | None = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+
+class JobOut(JobBase):
+    pass
+
+
+class JobDoc(JobBase, DocumentBaseModel):
+    params: dict[str, Any] = dict()
+    run_after: datetime = Field(default_factory=datetime.now)
+    #   not claimed before, pushed back on retries
+    worker: str | None = None
+    lease_until: datetime | None = None
+    #   a running job whose lease expired is considered abandoned by its worker
+
+    class Mongo:
+        collection_name: str = "jobs"
+
+
+class JobLockDoc(CustomBaseModel, DocumentBaseModel):
+    id: str = Field(alias="_id")
+    #   the lock key
+    job_id: PyObjectId
+    lease_until: datetime
+
+    class Mongo:
+        collection_name: str = "job_locks"
@@ -0,0 +1,24 @@
+from app.models.shared import CustomBaseModel
+
+
+class CacheMetrics(CustomBaseModel):
+    hits: int
+    misses: int
+    size: int
+    hit_rate: float | None = None
+    #   hits / lookups since the process started, None before the first lookup
+
+
+class PasswordHashingMetrics(CustomBaseModel):
+    workers: int
+    pending: int
+    #   calls waiting for or running on a worker
+    completed: int
+    rejected: int
+    #   calls turned away as too many were pending
+    avg_seconds: float | None = None
+
+
+class Metrics(CustomBaseModel):
+    principal_cache: CacheMetrics
+    password_hashing: PasswordHashingMetrics
@@ -1,6 +1,10 @@
+from enum import Enum
+import numpy as np
+from bson import Binary
 from pydantic import Field, validator
 
 from .shared import BasePageModel, PyObjectId, CustomBaseModel, DocumentBaseModel
+from config import settings
 
 #
 # Class naming conventions
@@ -8,6 +12,7 @@ from .shared import BasePageModel, PyObjectId, CustomBaseModel, DocumentBaseMode
 #   SampleAnnotationDoc: attributes matching document schema in DB
 #   SampleAnnotationInput: attributes for the body to be accepted in the post request
 #   SampleAnnotationOut: attributes for returning objects as payload
+#   SampleDictionaryDoc: per species sample accessions, for packed samples storage
 #
 
 
@@ -27,6 +32,11 @@ class SampleAnnotationBase(CustomBaseModel):
     label: str
     spm: float = 0
     avg_tpm: float = 0
+    tpm_sum: float = 0
+    tpm_sq_sum: float = 0
+    n_samples: int = 0
+    #   running sums over samples, maintained with every append
+    #   so that avg_tpm (and variance) never need a pass over all samples
     samples: list[Sample]
 
     @validator("type", pre=True)
@@ -59,10 +69,141 @@ class SampleAnnotationInput(CustomBaseModel):
         return v.upper()
 
 
+class SampleDictionaryDoc(CustomBaseModel, DocumentBaseModel):
+    id: PyObjectId | None = Field(alias="_id")
+    spe_id: PyObjectId = Field(alias="species_id")
+    labels: list[str] = list()
+    #   sample accessions of the species, append only:
+    #   the position of a label is its index in packed SA docs
+
+    class Mongo:
+        collection_name: str = "sample_dictionaries"
+
+
+#
+# Packed samples storage (settings.PACKED_SAMPLES)
+#   Instead of `samples`, an SA doc in the DB stores
+#   s_idx: little-endian int32 indices into the species SampleDictionaryDoc.labels
+#   s_tpm: little-endian float32 TPM values, in the same order
+# SA dicts read from the DB must go through `unpack` before loading into the models
+#
+class PackedSamples:
+    IDX_DTYPE = np.dtype("<i4")
+    TPM_DTYPE = np.dtype("<f4")
+
+    @classmethod
+    def pack(cls, samples: list[Sample], sample_index: dict[str, int]) -> dict:
+        return {
+            "s_idx": Binary(np.array(
+                [sample_index[sample.label] for sample in samples], dtype=cls.IDX_DTYPE
+            ).tobytes()),
+            "s_tpm": Binary(np.array(
+                [sample.tpm for sample in samples], dtype=cls.TPM_DTYPE
+            ).tobytes()),
+        }
+
+    @classmethod
+    def append(cls, sa_dict: dict, samples: list[Sample], sample_index: dict[str, int]) -> dict:
+        new = cls.pack(samples, sample_index)
+        return {
+            "s_idx": Binary(bytes(sa_dict["s_idx"]) + new["s_idx"]),
+            "s_tpm": Binary(bytes(sa_dict["s_tpm"]) + new["s_tpm"]),
+        }
+
+    @classmethod
+    def indices(cls, sa_dict: dict) -> np.ndarray:
+        return np.frombuffer(sa_dict["s_idx"], dtype=cls.IDX_DTYPE)
+
+    @classmethod
+    def tpms(cls, sa_dict: dict) -> np.ndarray:
+        # float32 is widened and rounded back to the stored precision
+        return np.frombuffer(sa_dict["s_tpm"], dtype=cls.TPM_DTYPE) \
+            .astype(np.float64) \
+            .round(settings.N_DECIMALS)
+
+    @staticmethod
+    def is_packed(sa_dict: dict) -> bool:
+        return "s_idx" in sa_dict
+
+    @classmethod
+    def unpack(cls, sa_dict: dict, sample_labels: list[str]) -> dict:
+        # Replaces the packed arrays by embedded samples, in place
+        if not cls.is_packed(sa_dict):
+            return sa_dict
+        indices = cls.indices(sa_dict).tolist()
+        tpms = cls.tpms(sa_dict).tolist()
+        del sa_dict["s_idx"], sa_dict["s_tpm"]
+        sa_dict["samples"] = [
+            {"label": sample_labels[i], "tpm": tpm}
+            for i, tpm in zip(indices, tpms)
+        ]
+        return sa_dict
+
+
+class GeneExpression(CustomBaseModel):
+    gene_id: PyObjectId
+    gene_label: str
+    samples: list[Sample]
+    annotations: dict[str, dict[str, float]] = dict()
+    #   annotation type -> annotation label -> avg_tpm
+
+
+class CoexpressionMethod(str, Enum):
+    PEARSON = "pearson"
+    SPEARMAN = "spearman"
+
+
+class CoexpressedGene(CustomBaseModel):
+    gene_id: PyObjectId
+    gene_label: str | None
+    score: float
+    #   correlation of the gene's expression profile with the searched gene's
+
+
+class GeneCoexpression(CustomBaseModel):
+    gene_id: PyObjectId
+    gene_label: str
+    method: CoexpressionMethod
+    n_samples: int
+    genes: list[CoexpressedGene]
+    #   highest scores first
+
+
 class SampleAnnotationOut(SampleAnnotationBase):
     id: PyObjectId | None = Field(alias="_id")
 
 
+class SampleAnnotationRank(str, Enum):
+    # SA doc fields the top SA docs of an annotation label can be ranked by
+    SPM = "spm"
+    AVG_TPM = "avg_tpm"
+
+
+class ExpressionHeatmapIn(CustomBaseModel):
+    annotation_type: str
+    gene_labels: list[str] = Field(..., min_items=1, max_items=settings.HEATMAP_MAX_GENES)
+    value: SampleAnnotationRank = SampleAnnotationRank.AVG_TPM
+    cluster: bool = False
+    #   rows in hierarchical clustering order instead of the requested order
+
+    @validator("annotation_type", pre=True)
+    def upcase_type(cls, v):
+        return v.upper()
+
+
+class ExpressionHeatmap(CustomBaseModel):
+    annotation_type: str
+    value: SampleAnnotationRank
+    gene_labels: list[str]
+    #   rows
+    annotation_labels: list[str]
+    #   columns
+    values: list[list[float | None]]
+    #   genes x annotation labels, None where a gene has no SA doc of the label
+    missing_gene_labels: list[str] = list()
+    #   requested genes without expression data, not in the rows
+
+
 class SampleAnnotationPage(BasePageModel):
     payload: list[SampleAnnotationOut]
 
@@ -72,3 +213,22 @@ class SampleAnnotationDoc(SampleAnnotationBase, DocumentBaseModel):
 
     class Mongo:
         collection_name: str = "sample_annotations"
+
+
+class TpmMatrixIngestSummary(CustomBaseModel):
+    annotation_type: str
+    n_genes: int = 0
+    n_samples: int = 0
+    n_annotation_labels: int = 0
+    n_docs_written: int = 0
+    unmapped_samples: list[str] = list()
+    #   samples in the matrix header without an annotation label, not stored
+    missing_gene_labels: list[str] = list()
+    #   genes in the matrix not found in the species, not stored
+
+
+class SpmRecomputeSummary(CustomBaseModel):
+    annotation_types: list[str] = list()
+    n_genes: int = 0
+    #   summed over annotation types
+    n_docs_updated: int = 0
@@ -1,6 +1,8 @@
 import warnings
+from functools import lru_cache
 from bson import ObjectId
 from pydantic import BaseModel, Extra, Field, validator
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
 
 
 class PyObjectId(ObjectId):
@@ -47,6 +49,61 @@ class CustomBaseModel(BaseModel):
         # To avoid overriding existing fields in the DB with default values on update
         return self.dict(exclude_unset=True, by_alias=True)
 
+    # For dict read from DB, as written by our own write paths
+    @classmethod
+    def construct_from_db(cls, doc: dict):
+        # Skips validation, which dominates the CPU time of reads of large documents
+        #   keys may be field names (db keys) or aliases, unknown keys are dropped
+        #   nested models are constructed too, missing fields get their defaults
+        values = {}
+        fields_set = set()
+        for name, alias, nested, is_list, field in _construct_plan(cls):
+            if name in doc:
+                value = doc[name]
+            elif alias in doc:
+                value = doc[alias]
+            else:
+                values[name] = field.get_default()
+                continue
+            if nested is not None and value is not None:
+                if is_list:
+                    value = [nested.construct_from_db(item) for item in value]
+                else:
+                    value = nested.construct_from_db(value)
+            values[name] = value
+            fields_set.add(name)
+        # As BaseModel.construct does, without its per call overhead
+        model = cls.__new__(cls)
+        object.__setattr__(model, "__dict__", values)
+        object.__setattr__(model, "__fields_set__", fields_set)
+        return model
+
+    # Client facing dict (keys are aliases), as `dict(by_alias=True)` without its per call overhead
+    def dict_for_client(self) -> dict:
+        values = self.__dict__
+        client_dict = {}
+        for name, alias, nested, is_list, _ in _construct_plan(type(self)):
+            value = values[name]
+            if nested is not None and value is not None:
+                if is_list:
+                    value = [item.dict_for_client() for item in value]
+                else:
+                    value = value.dict_for_client()
+            client_dict[alias] = value
+        return client_dict
+
+
+@lru_cache(maxsize=None)
+def _construct_plan(model: type[CustomBaseModel]) -> list[tuple]:
+    # (field name, alias, nested CustomBaseModel or None, is a list of it, field) per field of the model
+    plan = []
+    for name, field in model.__fields__.items():
+        nested = field.type_ if isinstance(field.type_, type) and issubclass(field.type_, CustomBaseModel) else None
+        if nested is not None and field.shape not in (SHAPE_LIST, SHAPE_SINGLETON):
+            nested = None
+        plan.append((name, field.alias, nested, field.shape == SHAPE_LIST, field))
+    return plan
+
 
 #
 # Only for models representing DB document schema
@@ -64,6 +121,8 @@ class BasePageModel(CustomBaseModel):
     page_total: int = Field(ge=0)
     curr_page: int = Field(ge=0)
     payload: list[CustomBaseModel]  # to be overriden in subclass
+    next_cursor: str | None = None
+    #   pass as `cursor` to get the next page, None on the last page
 
     # NOTE: Leaving validation out bcos
     #   we still want to tell client how many pages there are in total
@@ -58,6 +58,13 @@ class SpeciesPage(BasePageModel):
     payload: list[SpeciesOut]
 
 
+class SpeciesDataDeleteSummary(CustomBaseModel):
+    n_genes: int = 0
+    n_sample_annotations: int = 0
+    n_gene_annotation_updates: int = 0
+    #   GA docs stripped of gene ids, counted once per chunk of genes
+
+
 class SpeciesDoc(SpeciesBase, DocumentBaseModel):
     class Mongo:
         collection_name: str = "species"
@@ -0,0 +1,115 @@
+from fastapi import APIRouter, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.database import Database
+
+from app.db.coexpression_networks_collection import (
+    build_coexpression_network,
+    find_gene_neighbours,
+    find_network_subgraph,
+    is_network_current,
+)
+from app.db.data_versions_collection import find_data_version, species_data_key
+from app.db.genes_collection import find_gene_id_from_label_async
+from app.db.jobs_collection import enqueue_job
+from app.db.setup import get_async_db, get_db
+from app.db.species_collection import find_species_id_from_taxid, find_species_id_from_taxid_async
+from app.db.species_registry import get_species_registry
+from app.db.users_collection import verify_api_key
+from app.jobs import job_accepted
+from app.models.coexpression_network import CoexpressionNetwork, CoexpressionNetworkBuildSummary
+from app.models.job import JobOut
+from app.models.sample_annotation import CoexpressionMethod, GeneCoexpression
+from config import settings
+
+router = APIRouter(prefix="/api/v1", tags=["coexpression"])
+private_router = APIRouter(dependencies=[Depends(verify_api_key)])
+
+
+# Top co-expressed genes of a gene, from the co-expression network of its species
+@router.get(
+    "/species/{taxid}/genes/{gene_label}/coexpression/neighbours",
+    response_model=GeneCoexpression
+)
+async def get_gene_neighbours(
+    taxid: int,
+    gene_label: str,
+    top: int = Query(settings.COEXPRESSION_NETWORK_K, ge=1, le=settings.COEXPRESSION_MAX_TOP),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    species_id = await find_species_id_from_taxid_async(taxid, db)
+    gene_id = await find_gene_id_from_label_async(species_id, gene_label, db)
+    return await find_gene_neighbours(species_id, gene_id, gene_label, top, db)
+
+
+# Subgraph of the co-expression network around a gene, for network views
+@router.get(
+    "/species/{taxid}/genes/{gene_label}/coexpression/network",
+    response_model=CoexpressionNetwork
+)
+async def get_gene_network(
+    taxid: int,
+    gene_label: str,
+    hops: int = Query(1, ge=1, le=2),
+    top: int = Query(10, ge=1, le=settings.COEXPRESSION_SUBGRAPH_MAX_TOP),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    species_id = await find_species_id_from_taxid_async(taxid, db)
+    gene_id = await find_gene_id_from_label_async(species_id, gene_label, db)
+    return await find_network_subgraph(species_id, gene_id, gene_label, hops, top, db)
+
+
+#
+# (Re)build the co-expression network of a species
+#   skipped when built from the current data version already, unless `force`
+#
+@private_router.post(
+    "/species/{taxid}/coexpression/network",
+    status_code=200,
+    response_model=CoexpressionNetworkBuildSummary,
+    responses={202: {"model": JobOut}}
+)
+def post_species_network(
+    taxid: int,
+    method: CoexpressionMethod = CoexpressionMethod.PEARSON,
+    k: int = Query(settings.COEXPRESSION_NETWORK_K, ge=1, le=settings.COEXPRESSION_MAX_TOP),
+    force: bool = False,
+    run_as_job: bool = False,
+    db: Database = Depends(get_db)
+):
+    species_id = find_species_id_from_taxid(taxid, db)
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "coexpression.network",
+            {"species_id": species_id, "method": method.value, "k": k, "force": force},
+            [species_data_key(species_id)],
+            db
+        ))
+    return build_coexpression_network(species_id, method, k, db, force=force)
+
+
+# Queues a network build for every species whose network is missing or out of date
+@private_router.post(
+    "/coexpression/networks",
+    status_code=202,
+    response_model=list[JobOut]
+)
+def post_all_networks(
+    method: CoexpressionMethod = CoexpressionMethod.PEARSON,
+    k: int = Query(settings.COEXPRESSION_NETWORK_K, ge=1, le=settings.COEXPRESSION_MAX_TOP),
+    db: Database = Depends(get_db)
+):
+    return [
+        enqueue_job(
+            "coexpression.network",
+            {"species_id": species.id, "method": method.value, "k": k, "force": False},
+            [species_data_key(species.id)],
+            db
+        )
+        for species in get_species_registry(db).species
+        if not is_network_current(
+            species.id, method, k, find_data_version(species_data_key(species.id), db), db
+        )
+    ]
+
+
+router.include_router(private_router)
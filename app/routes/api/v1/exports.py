@@ -0,0 +1,34 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import FileResponse
+from pymongo.database import Database
+
+from app.db.setup import get_db
+from app.db.species_collection import find_species_id_from_taxid
+from app.db.species_exports import ExportDataset, get_species_export
+from app.utils.columnar import COLUMNAR_MEDIA_TYPES, ColumnarFormat
+
+router = APIRouter(prefix="/api/v1", tags=["exports"])
+
+
+#
+# Whole dataset of a species as one Parquet or Arrow IPC file
+#   written on the first request after the species data changed,
+#   then sent as a static file (with ETag and Last-Modified) until it changes again
+#
+@router.get(
+    "/species/{taxid}/exports/{dataset}",
+    response_class=FileResponse,
+    responses={200: {"content": {media_type: {} for media_type in COLUMNAR_MEDIA_TYPES.values()}}}
+)
+def get_species_export_file(
+    taxid: int,
+    dataset: ExportDataset,
+    format: ColumnarFormat = ColumnarFormat.PARQUET,
+    db: Database = Depends(get_db)
+):
+    species_id = find_species_id_from_taxid(taxid, db)
+    return FileResponse(
+        get_species_export(species_id, dataset, format, db),
+        media_type=COLUMNAR_MEDIA_TYPES[format],
+        filename=f"{taxid}.{dataset.value}.{format.value}"
+    )
@@ -1,34 +1,59 @@
-from collections import defaultdict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, File, Form, Query, Request, UploadFile
+from fastapi.encoders import jsonable_encoder
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.database import Database
 
+from app.db.annotation_incidence import find_gene_set_enrichment
 from app.db.gene_annotations_collection import (
-    check_if_ga_exists,
     convert_ga_in_to_ga_proc,
+    convert_many_ga_in_to_ga_procs,
     delete_one_ga,
     enforce_no_existing_ga,
     enforce_no_existing_gas,
     find_all_gas,
     find_one_ga,
+    import_gene_annotations,
+    insert_many_gas_in,
     insert_one_ga,
-    insert_one_new_ga_or_append_gene_ids,
+    insert_or_append_many_gas,
     insert_or_replace_many_gas,
+    iter_gas,
+    iter_gas_by_ids,
     update_one_ga,
 )
-from app.db.genes_collection import add_annotations_to_gene
-from app.db.setup import get_db
+from app.db.data_versions_collection import species_data_key
+from app.db.genes_collection import add_annotations_to_genes
+from app.db.jobs_collection import enqueue_job
+from app.db.setup import get_async_db, get_db
+from app.db.species_collection import find_species_id_from_taxid
 from app.db.users_collection import verify_api_key
+from app.jobs import GENE_ANNOTATIONS_LOCK_KEY, job_accepted
 from app.models.gene_annotation import (
+    GeneAnnotationImportSummary,
     GeneAnnotationIn,
     GeneAnnotationOut,
     GeneAnnotationPage,
     GeneAnnotationUpdate,
+    GeneSetEnrichment,
+    GeneSetEnrichmentIn,
 )
+from app.models.job import JobOut
+from app.utils.annotation_files import ANNOTATION_FILE_FORMATS, AnnotationFileFormat
+from app.utils.tpm_matrix import iter_text_lines
+from app.utils.responses import TrustedJSONResponse, stream_json, wants_ndjson
 
 router = APIRouter(prefix="/api/v1", tags=["gene_annotations"])
 private_router = APIRouter(dependencies=[Depends(verify_api_key)])
 
 
+# GA jobs also write the annotations of the genes, so they hold the keys of their species too
+def __ga_job_lock_keys(ga_input: list[GeneAnnotationIn], db: Database) -> list[str]:
+    taxids = {gene.taxid for ga_in in ga_input for gene in ga_in.genes}
+    return [GENE_ANNOTATIONS_LOCK_KEY] + [
+        species_data_key(find_species_id_from_taxid(taxid, db)) for taxid in taxids
+    ]
+
+
 # TODO: implement this as an PATCH request instead
 # @router.post(
 #     "species/{taxid}/gene_annotations",
@@ -49,22 +74,43 @@ private_router = APIRouter(dependencies=[Depends(verify_api_key)])
 #     # 2 way rs, also need to record ga id in gene doc
 
 
+# With `Accept: application/x-ndjson`, every matching GA is streamed instead of a page
 @router.get("/gene_annotations", response_model=GeneAnnotationPage)
-def get_all_gene_annotations(
+async def get_all_gene_annotations(
+    request: Request,
     type: str | None = None,
     label: str | None = None,
     page_num: int = 1,
-    db: Database = Depends(get_db)
+    cursor: str | None = None,
+    page_size: int | None = Query(None, ge=1),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
 ):
-    return find_all_gas(page_num, db, type, label)
+    if wants_ndjson(request):
+        return stream_json(request, iter_gas(db, type, label))
+    return TrustedJSONResponse(await find_all_gas(page_num, db, type, label, cursor, page_size))
 
 
 @router.get(
     "/gene_annotations/type/{type}/label/{label}",
     response_model=GeneAnnotationOut
 )
-def get_one_gene_annotation(type: str, label: str, db: Database = Depends(get_db)):
-    return find_one_ga(type, label, db)
+async def get_one_gene_annotation(type: str, label: str, db: AsyncIOMotorDatabase = Depends(get_async_db)):
+    return TrustedJSONResponse(await find_one_ga(type, label, db))
+
+
+# Annotations of a type over-represented among a set of genes of a species,
+#   eg the Mercator bins or GO terms of co-expressed or organ specific genes
+@router.post(
+    "/gene_annotations/species/{taxid}/enrichment",
+    response_model=GeneSetEnrichment
+)
+def post_gene_set_enrichment(
+    taxid: int,
+    enrichment_in: GeneSetEnrichmentIn,
+    db: Database = Depends(get_db)
+):
+    species_id = find_species_id_from_taxid(taxid, db)
+    return find_gene_set_enrichment(species_id, enrichment_in, db)
 
 
 @private_router.post(
@@ -77,75 +123,117 @@ def post_one_gene_annotation(ga_in: GeneAnnotationIn, db: Database = Depends(get
     enforce_no_existing_ga(ga_in, db)
     ga_proc = convert_ga_in_to_ga_proc(ga_in, db)
     ga_out = insert_one_ga(ga_proc, db)
-    for gene_id in ga_out.gene_ids:
-        _ = add_annotations_to_gene(gene_id, [ga_out.id], db)
+    add_annotations_to_genes({gene_id: [ga_out.id] for gene_id in ga_out.gene_ids}, db)
     return ga_out
 
 
 @private_router.post(
     "/gene_annotations/batch",
     status_code=201,
-    response_model=list[GeneAnnotationOut]
+    response_model=list[GeneAnnotationOut],
+    responses={202: {"model": JobOut}}
 )
 def post_many_gene_annotations(
+    request: Request,
     ga_input: list[GeneAnnotationIn],
     skip_duplicates: bool = False,
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
-    if skip_duplicates is False:
-        enforce_no_existing_gas(ga_input, db)
-    gas_out = []
-    gene_map_ga = defaultdict(list)
-    for ga_in in ga_input:
-        if check_if_ga_exists(ga_in.type, ga_in.label, db) is False:
-            ga_proc = convert_ga_in_to_ga_proc(ga_in, db)
-            ga_out = insert_one_ga(ga_proc, db)
-            gas_out.append(ga_out)
-            for gene_id in ga_proc.gene_ids:
-                gene_map_ga[gene_id] = list(set(gene_map_ga[gene_id] + [ga_out.id]))
-    for gene_id, ga_ids in gene_map_ga.items():
-        _ = add_annotations_to_gene(gene_id, ga_ids, db)
-    return gas_out
+    if run_as_job:
+        # Checked before queuing, the job skips existing GAs, see app.jobs
+        if skip_duplicates is False:
+            enforce_no_existing_gas(ga_input, db)
+        return job_accepted(enqueue_job(
+            "gene_annotations.batch.post",
+            {"items": jsonable_encoder(ga_input)},
+            __ga_job_lock_keys(ga_input, db),
+            db
+        ))
+    ga_ids = insert_many_gas_in(ga_input, skip_duplicates, db)
+    return stream_json(request, iter_gas_by_ids(ga_ids, db), status_code=201)
+
+
+#
+# Bulk load of the annotations of a whole species from one file
+#   format: mercator (Mercator4 mapping, type MERCATOR by default)
+#           or gaf (GO annotation file, type GO by default)
+# The file is parsed as a stream and written in chunks, gene labels are
+#   resolved against the genes of the species
+#
+@private_router.post(
+    "/gene_annotations/species/{taxid}/import",
+    status_code=201,
+    response_model=GeneAnnotationImportSummary
+)
+def post_annotation_file(
+    taxid: int,
+    format: AnnotationFileFormat = Form(...),
+    annotation_type: str | None = Form(None),
+    annotation_file: UploadFile = File(...),
+    db: Database = Depends(get_db)
+):
+    species_id = find_species_id_from_taxid(taxid, db)
+    parse, default_type = ANNOTATION_FILE_FORMATS[format]
+    return import_gene_annotations(
+        species_id,
+        (annotation_type or default_type).upper(),
+        parse(iter_text_lines(annotation_file.file)),
+        db
+    )
 
 
 @private_router.put(
     "/gene_annotations/batch",
     status_code=200,
-    response_model=list[GeneAnnotationOut]
+    response_model=list[GeneAnnotationOut],
+    responses={202: {"model": JobOut}}
 )
 def put_many_gene_annotations(
     ga_input: list[GeneAnnotationIn],
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
-    ga_procs = [convert_ga_in_to_ga_proc(ga_in, db) for ga_in in ga_input]
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "gene_annotations.batch.put",
+            {"items": jsonable_encoder(ga_input)},
+            __ga_job_lock_keys(ga_input, db),
+            db
+        ))
+    ga_procs = convert_many_ga_in_to_ga_procs(ga_input, db)
     return insert_or_replace_many_gas(ga_procs, db)
 
 
 #
-# Upsert-like operation
+# Upsert-like operation, applied to the whole array at once
 # For each GeneAnnotationIn in the array
-#   - If GeneAnnotationDoc not present yet,
-#       - Insert the doc to DB
-#       - Append the updated doc to the response model array
-#   - Otherwise, find the existing GeneAnnotationDoc
-#       - Take taxid + gene labels combi that are not already embedded in the doc
-#       - Append to the genes array in the doc
-#       - Append the updated doc to the response model array
+#   - If GeneAnnotationDoc not present yet, insert the doc to DB
+#   - Otherwise, append the taxid + gene labels combi that are not already
+#       embedded in the existing GeneAnnotationDoc to its genes array
+#   - The genes get the reverse links to the GeneAnnotationDoc
+# The response model array holds the updated docs, once per type + label
 #
 @private_router.patch(
     "/gene_annotations/batch",
     status_code=200,
-    response_model=list[GeneAnnotationOut]
+    response_model=list[GeneAnnotationOut],
+    responses={202: {"model": JobOut}}
 )
 def add_genes_to_gene_annotations(
     ga_input: list[GeneAnnotationIn],
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
-    ga_procs = [convert_ga_in_to_ga_proc(ga_in, db) for ga_in in ga_input]
-    return [
-        insert_one_new_ga_or_append_gene_ids(ga_proc, db)
-        for ga_proc in ga_procs
-    ]
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "gene_annotations.batch.patch",
+            {"items": jsonable_encoder(ga_input)},
+            __ga_job_lock_keys(ga_input, db),
+            db
+        ))
+    ga_procs = convert_many_ga_in_to_ga_procs(ga_input, db)
+    return insert_or_append_many_gas(ga_procs, db)
 
 
 @private_router.delete(
@@ -154,7 +242,6 @@ def add_genes_to_gene_annotations(
     response_model=GeneAnnotationOut
 )
 def delete_gene_annotation(ga_type: str, label: str, db: Database = Depends(get_db)):
-    # TODO remove association from assocaited gene docs
     return delete_one_ga(ga_type, label, db)
 
 
@@ -1,44 +1,114 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.encoders import jsonable_encoder
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.database import Database
 
-from app.db.setup import get_db
+from app.db.data_versions_collection import species_data_key
+from app.db.expression_cache import find_gene_coexpression
+from app.db.gene_index import complete_gene_labels
+from app.db.jobs_collection import enqueue_job
+from app.db.setup import get_async_db, get_db
 from app.db.genes_collection import (
     delete_one_gene,
     find_all_genes_by_species,
     enforce_no_existing_genes,
     find_one_gene_by_label,
-    insert_many_genes,
+    insert_many_genes_in,
     insert_one_gene,
     insert_or_replace_many_genes,
+    iter_genes_by_ids,
+    iter_genes_by_species,
     update_one_gene,
 )
 from app.db.species_collection import (
     find_species_id_from_taxid,
+    find_species_id_from_taxid_async,
 )
+from app.db.species_registry import get_species_registry
 from app.db.users_collection import verify_api_key
+from app.jobs import job_accepted
 from app.models.gene import (
+    GeneCompletion,
     GeneOut,
     GeneIn,
     GenePage,
     GeneProcessed,
 )
-
+from app.models.job import JobOut
+from app.models.sample_annotation import CoexpressionMethod, GeneCoexpression
 from app.models.shared import PyObjectId
+from app.utils.responses import TrustedJSONResponse, stream_json, wants_ndjson
+from config import settings
 
 router = APIRouter(prefix="/api/v1", tags=["genes"])
 private_router = APIRouter(dependencies=[Depends(verify_api_key)])
 
 
+# With `Accept: application/x-ndjson`, every gene of the species is streamed instead of a page
 @router.get("/species/{taxid}/genes", response_model=GenePage)
-def get_all_genes_of_a_species(taxid: int, page_num: int = 1, db: Database = Depends(get_db)):
+async def get_all_genes_of_a_species(
+    request: Request,
+    taxid: int,
+    page_num: int = 1,
+    cursor: str | None = None,
+    page_size: int | None = Query(None, ge=1),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    species_id: PyObjectId = await find_species_id_from_taxid_async(taxid, db)
+    if wants_ndjson(request):
+        return stream_json(request, iter_genes_by_species(species_id, db))
+    return TrustedJSONResponse(await find_all_genes_by_species(species_id, page_num, db, cursor, page_size))
+
+
+#
+# Autocomplete: genes whose label or one of whose aliases starts with `prefix`,
+#   in label / alias order, served from the in-memory gene indexes
+# Declared before the gene label routes, which would take "autocomplete" for a label
+#
+@router.get("/species/{taxid}/genes/autocomplete", response_model=list[GeneCompletion])
+def autocomplete_genes_of_a_species(
+    taxid: int,
+    prefix: str = Query(..., min_length=1),
+    limit: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+    db: Database = Depends(get_db)
+):
     species_id: PyObjectId = find_species_id_from_taxid(taxid, db)
-    return find_all_genes_by_species(species_id, page_num, db)
+    return TrustedJSONResponse(complete_gene_labels([species_id], prefix, limit, db))
+
+
+# Kingdom wide, or within the species given by taxid
+@router.get("/genes/autocomplete", response_model=list[GeneCompletion])
+def autocomplete_genes(
+    prefix: str = Query(..., min_length=1),
+    limit: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+    taxid: list[int] | None = Query(None),
+    db: Database = Depends(get_db)
+):
+    if taxid is None:
+        species_ids = [species.id for species in get_species_registry(db).species]
+    else:
+        species_ids = [find_species_id_from_taxid(species_taxid, db) for species_taxid in taxid]
+    return TrustedJSONResponse(complete_gene_labels(species_ids, prefix, limit, db))
 
 
 @router.get("/species/{taxid}/genes/{gene_label}", response_model=GeneOut)
-def get_one_gene(taxid: int, gene_label: str, db: Database = Depends(get_db)):
+async def get_one_gene(taxid: int, gene_label: str, db: AsyncIOMotorDatabase = Depends(get_async_db)):
+    species_id: PyObjectId = await find_species_id_from_taxid_async(taxid, db)
+    return TrustedJSONResponse(await find_one_gene_by_label(species_id, gene_label, db))
+
+
+# Genes of the species sharing the expression profile of a gene, most correlated first
+#   served from the co-expression matrices of the expression cache
+@router.get("/species/{taxid}/genes/{gene_label}/coexpression", response_model=GeneCoexpression)
+def get_gene_coexpression(
+    taxid: int,
+    gene_label: str,
+    top: int = Query(50, ge=1, le=settings.COEXPRESSION_MAX_TOP),
+    method: CoexpressionMethod = CoexpressionMethod.PEARSON,
+    db: Database = Depends(get_db)
+):
     species_id: PyObjectId = find_species_id_from_taxid(taxid, db)
-    return find_one_gene_by_label(species_id, gene_label, db)
+    return find_gene_coexpression(species_id, gene_label, method, top, db)
 
 
 @private_router.post(
@@ -60,36 +130,55 @@ def post_one_gene(
 @private_router.post(
     "/species/{taxid}/genes/batch",
     status_code=201,
-    response_model=list[GeneOut]
+    response_model=list[GeneOut],
+    responses={202: {"model": JobOut}}
 )
 def post_many_genes_by_species(
+    request: Request,
     taxid: int,
     genes_in: list[GeneIn],
     skip_duplicates: bool = False,
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
     species_id: PyObjectId = find_species_id_from_taxid(taxid, db)
-    if skip_duplicates is False:
-        enforce_no_existing_genes(species_id, genes_in, db)
-    genes_processed: list[GeneProcessed] = [
-        GeneProcessed(
-            **gene_in.dict(by_alias=True, exclude_none=True),
-            species_id=species_id
-        )
-        for gene_in in genes_in
-    ]
-    inserted_genes = insert_many_genes(genes_processed, db)
-    return inserted_genes
-
-
-@private_router.put("/species/{taxid}/genes/batch", status_code=200, response_model=list[GeneOut])
+    if run_as_job:
+        # Checked before queuing, the job skips existing genes, see app.jobs
+        if skip_duplicates is False:
+            enforce_no_existing_genes(species_id, genes_in, db)
+        return job_accepted(enqueue_job(
+            "genes.batch.post",
+            {"species_id": species_id, "items": jsonable_encoder(genes_in)},
+            [species_data_key(species_id)],
+            db
+        ))
+    gene_ids = insert_many_genes_in(species_id, genes_in, skip_duplicates, db)
+    return stream_json(request, iter_genes_by_ids(gene_ids, db), status_code=201)
+
+
+@private_router.put(
+    "/species/{taxid}/genes/batch",
+    status_code=200,
+    response_model=list[GeneOut],
+    responses={202: {"model": JobOut}}
+)
 def put_many_genes_by_species(
+    request: Request,
     taxid: int,
     genes_in_list: list[GeneIn],
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
     species_id = find_species_id_from_taxid(taxid, db)
-    return insert_or_replace_many_genes(species_id, genes_in_list, db)
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "genes.batch.put",
+            {"species_id": species_id, "items": jsonable_encoder(genes_in_list)},
+            [species_data_key(species_id)],
+            db
+        ))
+    gene_dicts = insert_or_replace_many_genes(species_id, genes_in_list, db)
+    return stream_json(request, map(GeneOut.construct_from_db, gene_dicts))
 
 
 @private_router.delete(
@@ -98,7 +187,6 @@ def put_many_genes_by_species(
     response_model=GeneOut
 )
 def delete_gene(taxid: int, gene_label: str, db: Database = Depends(get_db)):
-    # TODO delete associated resources
     return delete_one_gene(taxid, gene_label, db)
 
 
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends
+from pymongo.database import Database
+
+from app.db.jobs_collection import find_one_job
+from app.db.setup import get_db
+from app.db.users_collection import verify_api_key
+from app.models.job import JobOut
+
+router = APIRouter(prefix="/api/v1", tags=["jobs"])
+private_router = APIRouter(dependencies=[Depends(verify_api_key)])
+
+
+# Status, progress and result of a job queued with `run_as_job=true`
+@private_router.get("/jobs/{job_id}", response_model=JobOut)
+def get_job(job_id: str, db: Database = Depends(get_db)):
+    return find_one_job(job_id, db)
+
+
+router.include_router(private_router)
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Depends
+
+from app.db.principal_cache import principal_cache_metrics
+from app.db.users_collection import verify_api_key
+from app.models.metrics import Metrics
+from app.utils.passwords import password_hashing_metrics
+
+router = APIRouter(prefix="/api/v1", tags=["metrics"])
+private_router = APIRouter(dependencies=[Depends(verify_api_key)])
+
+
+# In-process cache metrics of the worker serving the request
+@private_router.get("/metrics", response_model=Metrics)
+def get_metrics():
+    return Metrics(
+        principal_cache=principal_cache_metrics(),
+        password_hashing=password_hashing_metrics()
+    )
+
+
+router.include_router(private_router)
@@ -1,58 +1,165 @@
 from bson import ObjectId
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, File, Form, Query, Request, UploadFile
+from fastapi.encoders import jsonable_encoder
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.database import Database
 
-from app.db.setup import get_db
+from app.db.data_versions_collection import species_data_key
+from app.db.expression_cache import find_expression_heatmap, find_gene_expression
+from app.db.jobs_collection import enqueue_job
+from app.db.setup import get_async_db, get_db
 from app.db.users_collection import verify_api_key
+from app.jobs import job_accepted
+from app.models.job import JobOut
 from app.models.sample_annotation import (
+    ExpressionHeatmap,
+    ExpressionHeatmapIn,
+    GeneExpression,
     SampleAnnotationInput,
     SampleAnnotationOut,
     SampleAnnotationPage,
+    SampleAnnotationRank,
+    SpmRecomputeSummary,
+    TpmMatrixIngestSummary,
 )
-from app.db.genes_collection import find_gene_id_from_label
-from app.db.species_collection import find_species_id_from_taxid
+from app.db.genes_collection import find_gene_id_from_label, find_gene_id_from_label_async
+from app.db.species_collection import find_species_id_from_taxid, find_species_id_from_taxid_async
 from app.db.sample_annotations_collection import (
+    enforce_no_existing_samples,
     enforce_no_existing_samples_for_gene,
     find_sample_annotations_by_gene,
     find_sample_annotations_by_label,
+    find_top_sample_annotations,
+    ingest_tpm_matrix,
+    insert_many_sa_inputs,
     insert_or_update_one_sa_doc,
+    iter_sample_annotations_by_gene,
+    iter_sample_annotations_by_label,
+    iter_sas_by_ids,
+    recompute_species_stats,
     reshape_sa_input_to_sa_docs,
     update_affected_spm,
 )
+from app.utils.responses import (
+    TrustedJSONResponse,
+    binary_matrix_response,
+    stream_json,
+    wants_binary,
+    wants_ndjson,
+)
+from app.utils.tpm_matrix import (
+    iter_delimited_rows,
+    iter_text_lines,
+    read_sample_annotation_map,
+)
+from config import settings
 
 router = APIRouter(prefix="/api/v1", tags=["sample_annotations"])
 private_router = APIRouter(dependencies=[Depends(verify_api_key)])
 
 
+# With `Accept: application/x-ndjson`, every SA doc of the gene is streamed instead of a page
 @router.get(
     "/sample_annotations/species/{taxid}/genes/{gene_label}",
     response_model=SampleAnnotationPage
 )
-def get_sample_annotations_by_gene(
+async def get_sample_annotations_by_gene(
+    request: Request,
     taxid: int,
     gene_label: str,
     page_num: int = 1,
+    cursor: str | None = None,
+    page_size: int | None = Query(None, ge=1),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    species_id: ObjectId = await find_species_id_from_taxid_async(taxid, db)
+    gene_id: ObjectId = await find_gene_id_from_label_async(species_id, gene_label, db)
+    if wants_ndjson(request):
+        return stream_json(request, iter_sample_annotations_by_gene(species_id, gene_id, db))
+    return TrustedJSONResponse(
+        await find_sample_annotations_by_gene(species_id, gene_id, page_num, db, cursor, page_size)
+    )
+
+
+# Expression profile of one gene across all samples of its species,
+#   served from the memory mapped species matrices of the expression cache
+@router.get(
+    "/sample_annotations/species/{taxid}/genes/{gene_label}/expression",
+    response_model=GeneExpression
+)
+def get_gene_expression(
+    taxid: int,
+    gene_label: str,
+    db: Database = Depends(get_db)
+):
+    species_id: ObjectId = find_species_id_from_taxid(taxid, db)
+    return find_gene_expression(species_id, gene_label, db)
+
+
+# Genes x annotation labels avg_tpm or SPM matrix of a list of genes, for heatmaps
+# With `Accept: application/octet-stream`, the matrix is sent as float32 after
+#   a JSON header line, see binary_matrix_response
+@router.post(
+    "/sample_annotations/species/{taxid}/heatmap",
+    response_model=ExpressionHeatmap
+)
+def post_expression_heatmap(
+    request: Request,
+    taxid: int,
+    heatmap_in: ExpressionHeatmapIn,
     db: Database = Depends(get_db)
 ):
     species_id: ObjectId = find_species_id_from_taxid(taxid, db)
-    gene_id: ObjectId = find_gene_id_from_label(species_id, gene_label, db)
-    return find_sample_annotations_by_gene(species_id, gene_id, page_num, db)
+    heatmap = find_expression_heatmap(species_id, heatmap_in, db)
+    if wants_binary(request):
+        return binary_matrix_response(heatmap, "values")
+    return TrustedJSONResponse(heatmap)
 
 
 # Find all sample annotations belonging to a specific label (organ)
 #   TODO: future work, specify which clade of interest,
 #   return only for species within that clade
+# With `Accept: application/x-ndjson`, every matching SA doc is streamed instead of a page
 @router.get(
     "/sample_annotations/types/{type}/labels/{label}",
     response_model=SampleAnnotationPage
 )
-def get_sample_annotations_by_label(
+async def get_sample_annotations_by_label(
+    request: Request,
     type: str,
     label: str,
     page_num: int = 1,
-    db: Database = Depends(get_db)
+    cursor: str | None = None,
+    page_size: int | None = Query(None, ge=1),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
 ):
-    return find_sample_annotations_by_label(type, label, page_num, db)
+    if wants_ndjson(request):
+        return stream_json(request, iter_sample_annotations_by_label(type, label, db))
+    return TrustedJSONResponse(
+        await find_sample_annotations_by_label(type, label, page_num, db, cursor, page_size)
+    )
+
+
+# Top n SA docs of a label (organ) across species, ranked by SPM or avg TPM
+#   eg the genes most specific to ROOT, optionally within some species only
+@router.get(
+    "/sample_annotations/types/{type}/labels/{label}/top",
+    response_model=list[SampleAnnotationOut]
+)
+async def get_top_sample_annotations_by_label(
+    type: str,
+    label: str,
+    rank_by: SampleAnnotationRank = SampleAnnotationRank.SPM,
+    n: int = Query(settings.PAGE_SIZE, ge=1, le=settings.MAX_PAGE_SIZE),
+    taxid: list[int] | None = Query(None),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    species_ids = None
+    if taxid is not None:
+        species_ids = [await find_species_id_from_taxid_async(species_taxid, db) for species_taxid in taxid]
+    return TrustedJSONResponse(
+        await find_top_sample_annotations(type, label, rank_by, n, db, species_ids)
+    )
 
 
 @private_router.post(
@@ -79,25 +186,89 @@ def post_one_row_sample_annotations(
 @private_router.post(
     "/sample_annotations/batch",
     status_code=201,
-    response_model=list[SampleAnnotationOut]
+    response_model=list[SampleAnnotationOut],
+    responses={202: {"model": JobOut}}
 )
 def post_many_rows_sample_annotations(
+    request: Request,
     sa_input_list: list[SampleAnnotationInput],
     skip_duplicate_samples: bool = False,
+    run_as_job: bool = False,
     db: Database = Depends(get_db)
 ):
-    output = []
-    for sa_input in sa_input_list:
-        species_id: ObjectId = find_species_id_from_taxid(sa_input.species_taxid, db)
-        gene_id: ObjectId = find_gene_id_from_label(species_id, sa_input.gene_label, db)
+    if run_as_job:
+        species_ids = {
+            find_species_id_from_taxid(taxid, db)
+            for taxid in {sa_input.species_taxid for sa_input in sa_input_list}
+        }
+        # Checked before queuing, the job skips existing samples, see app.jobs
         if skip_duplicate_samples is False:
-            enforce_no_existing_samples_for_gene(sa_input, species_id, gene_id, db)
-        sa_docs = reshape_sa_input_to_sa_docs(sa_input, species_id, gene_id)
-        sa_outs = [insert_or_update_one_sa_doc(sa_doc, db) for sa_doc in sa_docs]
-        update_affected_spm(species_id, gene_id, sa_input.annotation_type, db)
-        # TODO return newly queried docs with updated SPM instead
-        output += sa_outs
-    return output
+            enforce_no_existing_samples(sa_input_list, db)
+        return job_accepted(enqueue_job(
+            "sample_annotations.batch",
+            {"items": jsonable_encoder(sa_input_list)},
+            [species_data_key(species_id) for species_id in species_ids],
+            db
+        ))
+    sa_ids = insert_many_sa_inputs(sa_input_list, skip_duplicate_samples, db)
+    return stream_json(request, iter_sas_by_ids(sa_ids, db), status_code=201)
+
+
+#
+# Bulk load of a whole species for one annotation type
+#   tpm_matrix: TSV/CSV, header row of sample labels, one row per gene label
+#   sample_annotations: TSV/CSV of sample_label -> annotation_label, with header row
+# Both files are parsed as streams and written in chunks
+#
+@private_router.post(
+    "/sample_annotations/species/{taxid}/matrix",
+    status_code=201,
+    response_model=TpmMatrixIngestSummary
+)
+def post_tpm_matrix(
+    taxid: int,
+    annotation_type: str = Form(...),
+    tpm_matrix: UploadFile = File(...),
+    sample_annotations: UploadFile = File(...),
+    db: Database = Depends(get_db)
+):
+    species_id: ObjectId = find_species_id_from_taxid(taxid, db)
+    sample_map = read_sample_annotation_map(
+        iter_delimited_rows(iter_text_lines(sample_annotations.file))
+    )
+    return ingest_tpm_matrix(
+        species_id,
+        annotation_type.upper(),
+        iter_delimited_rows(iter_text_lines(tpm_matrix.file)),
+        sample_map,
+        db
+    )
+
+
+# Re-derive avg_tpm and SPM of all SA docs of a species, eg after a data fix
+@private_router.post(
+    "/sample_annotations/species/{taxid}/recompute_stats",
+    status_code=200,
+    response_model=SpmRecomputeSummary,
+    responses={202: {"model": JobOut}}
+)
+def post_recompute_stats(
+    taxid: int,
+    annotation_type: str | None = None,
+    run_as_job: bool = False,
+    db: Database = Depends(get_db)
+):
+    species_id: ObjectId = find_species_id_from_taxid(taxid, db)
+    if annotation_type is not None:
+        annotation_type = annotation_type.upper()
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "sample_annotations.recompute_stats",
+            {"species_id": species_id, "annotation_type": annotation_type},
+            [species_data_key(species_id)],
+            db
+        ))
+    return recompute_species_stats(species_id, db, annotation_type)
 
 
 router.include_router(private_router)
@@ -1,9 +1,13 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.database import Database
 
-from app.db.setup import get_db
+from app.db.data_versions_collection import species_data_key
+from app.db.jobs_collection import enqueue_job
+from app.db.setup import get_async_db, get_db
 from app.db.species_collection import (
     delete_one_species,
+    delete_species_data,
     enforce_no_existing_species_in_list,
     enforce_taxid_not_exist,
     find_all_species,
@@ -15,6 +19,8 @@ from app.db.species_collection import (
     update_one_species,
 )
 from app.db.users_collection import verify_api_key
+from app.jobs import GENE_ANNOTATIONS_LOCK_KEY, job_accepted
+from app.models.job import JobOut
 from app.models.species import (
     SpeciesIn,
     SpeciesOut,
@@ -28,13 +34,18 @@ private_router = APIRouter(dependencies=[Depends(verify_api_key)])
 
 
 @router.get("/species", response_model=SpeciesPage)
-def get_all_species(page_num: int = 1, db: Database = Depends(get_db)):
-    return find_all_species(page_num=page_num, db=db)
+async def get_all_species(
+    page_num: int = 1,
+    cursor: str | None = None,
+    page_size: int | None = Query(None, ge=1),
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
+):
+    return await find_all_species(page_num=page_num, db=db, cursor=cursor, page_size=page_size)
 
 
 @router.get("/species/{taxid}", response_model=SpeciesOut)
-def get_one_species_by_taxid(taxid: int, db: Database = Depends(get_db)):
-    return find_one_species_by_taxid(taxid, db)
+async def get_one_species_by_taxid(taxid: int, db: AsyncIOMotorDatabase = Depends(get_async_db)):
+    return await find_one_species_by_taxid(taxid, db)
 
 
 @private_router.post(
@@ -71,9 +82,28 @@ def put_many_species(species_in_list: list[SpeciesIn], db: Database = Depends(ge
     return insert_or_replace_many_species(species_in_list, db)
 
 
-@private_router.delete("/species/{taxid}", status_code=200, response_model=SpeciesOut)
-def delete_species(taxid: int, db: Database = Depends(get_db)):
-    # TODO delete associated resources
+#
+# The genes, SA docs and gene annotation references of the species are
+#   deleted first, see delete_species_data, then the species doc itself:
+#   a delete that failed midway is retried by the same request
+# With `run_as_job`, both are deleted by a job
+#
+@private_router.delete(
+    "/species/{taxid}",
+    status_code=200,
+    response_model=SpeciesOut,
+    responses={202: {"model": JobOut}}
+)
+def delete_species(taxid: int, run_as_job: bool = False, db: Database = Depends(get_db)):
+    species_id = find_species_id_from_taxid(taxid, db)
+    if run_as_job:
+        return job_accepted(enqueue_job(
+            "species.delete",
+            {"species_id": species_id},
+            [species_data_key(species_id), GENE_ANNOTATIONS_LOCK_KEY],
+            db
+        ))
+    _ = delete_species_data(species_id, db)
     return delete_one_species(taxid, db)
 
 
@@ -3,13 +3,13 @@ from fastapi import (
     Depends,
 )
 from fastapi.security import OAuth2PasswordRequestForm
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorDatabase
 
-from app.db.setup import get_db
+from app.db.setup import get_async_db
 from app.db.users_collection import (
-    authenticate_user,
+    authenticate_user_async,
     create_access_token,
-    find_all_users,
+    find_all_users_async,
     get_admin_user,
     get_current_user_no_scope,
 )
@@ -21,9 +21,9 @@ router = APIRouter(prefix="/api/v1", tags=["oauth2"])
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Database = Depends(get_db)
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
 ):
-    user: UserOut = authenticate_user(
+    user: UserOut = await authenticate_user_async(
         email=form_data.username,
         password=form_data.password,
         db=db
@@ -48,6 +48,6 @@ async def get_user_me(
 @router.get("/users", response_model=list[UserOut])
 async def get_users(
     current_user: User = Depends(get_admin_user),
-    db: Database = Depends(get_db)
+    db: AsyncIOMotorDatabase = Depends(get_async_db)
 ):
-    return find_all_users(db)
+    return await find_all_users_async(db)
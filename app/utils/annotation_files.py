@@ -0,0 +1,91 @@
+import csv
+from enum import Enum
+from typing import Iterable, Iterator, NamedTuple
+
+#
+# Parsers of gene annotation files, as streams of rows
+#   Each yields one AnnotationRow per (gene, annotation) pair, so that files of
+#   a whole species are never read whole into memory. Labels are upper cased
+#   as GeneAnnotationBase does; gene labels are resolved by the caller.
+#
+
+
+class AnnotationRow(NamedTuple):
+    label: str
+    #   annotation identifier, eg Mercator bin code or GO id
+    gene_labels: tuple[str, ...]
+    #   candidate labels of the gene, to be tried in order
+    details: dict
+
+
+def __unquote(value: str) -> str:
+    # Mercator exports quote every field with single quotes
+    return value.strip().strip("'").strip()
+
+
+def iter_mercator_rows(lines: Iterable[str]) -> Iterator[AnnotationRow]:
+    #
+    # Mercator4 mapping, tab separated with a header row
+    #   BINCODE    NAME                        IDENTIFIER     DESCRIPTION    TYPE
+    #   '1.1.1'    'Photosynthesis.photo...'   'at1g01010.1'  'component'    T
+    # Rows without an identifier only define their bin and are skipped.
+    # Identifiers are transcripts: the gene label without its isoform suffix
+    #   is tried after the identifier itself.
+    #
+    rows = csv.reader(lines, delimiter="\t", quoting=csv.QUOTE_NONE)
+    _ = next(rows, None)
+    for row in rows:
+        if len(row) < 3:
+            continue
+        label, name, identifier = (__unquote(value) for value in row[:3])
+        if not label or not identifier:
+            continue
+        identifier = identifier.upper()
+        gene_labels = (identifier,)
+        stem, dot, suffix = identifier.rpartition(".")
+        if dot and suffix.isdigit():
+            gene_labels += (stem,)
+        yield AnnotationRow(label.upper(), gene_labels, {"binname": name})
+
+
+GAF_ASPECTS = {"P": "biological_process", "F": "molecular_function", "C": "cellular_component"}
+
+
+def iter_gaf_rows(lines: Iterable[str]) -> Iterator[AnnotationRow]:
+    #
+    # GO annotation file (GAF 2.x), tab separated, `!` comment lines
+    #   col 1 DB Object ID, col 2 DB Object Symbol, col 3 Qualifier, col 4 GO ID,
+    #   col 6 Evidence Code, col 8 Aspect, col 10 DB Object Synonyms (`|` separated)
+    # Negated annotations (qualifier NOT) are skipped.
+    # Gene labels tried: the symbol, the object id, then every synonym.
+    #
+    for row in csv.reader(lines, delimiter="\t", quoting=csv.QUOTE_NONE):
+        if not row or row[0].startswith("!") or len(row) < 9:
+            continue
+        if "NOT" in row[3].upper().split("|"):
+            continue
+        synonyms = row[10].split("|") if len(row) > 10 else []
+        gene_labels = tuple(
+            label.strip().upper()
+            for label in [row[2], row[1], *synonyms]
+            if label.strip()
+        )
+        if not row[4].strip() or not gene_labels:
+            continue
+        yield AnnotationRow(
+            row[4].strip().upper(),
+            gene_labels,
+            {"aspect": GAF_ASPECTS.get(row[8].strip(), row[8].strip())}
+        )
+
+
+class AnnotationFileFormat(str, Enum):
+    mercator = "mercator"
+    gaf = "gaf"
+
+
+# Parser and default annotation type of every format
+ANNOTATION_FILE_FORMATS = {
+    AnnotationFileFormat.mercator: (iter_mercator_rows, "MERCATOR"),
+    AnnotationFileFormat.gaf: (iter_gaf_rows, "GO"),
+}
@@ -0,0 +1,50 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+import numpy as np
+
+#
+# Top k co-expressed genes of every gene of a species, for co-expression networks
+#   The standardized co-expression matrix (see expression_cache.get_coexpression_matrix)
+#   is multiplied with itself by blocks of rows, so that a block of scores is
+#   block_rows x genes whatever the size of the species. Blocks are computed by a
+#   pool of processes, each memory mapping the matrix file: the matrix is shared
+#   through the page cache and only the top k of each row is sent back.
+# Kept free of app imports, as pool processes are spawned and import this module only.
+#
+
+
+def top_k_block(matrix_path: str, start: int, stop: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+    # Rows (best first) and scores of the top k genes of the genes start:stop
+    matrix = np.load(matrix_path, mmap_mode="r")
+    scores = np.clip(np.asarray(matrix[start:stop]) @ np.asarray(matrix).T, -1, 1)
+    block = np.arange(stop - start)
+    scores[block, block + start] = -np.inf
+    k = min(k, matrix.shape[0] - 1)
+    if k <= 0:
+        return np.empty((stop - start, 0), dtype=np.intp), np.empty((stop - start, 0), dtype=np.float32)
+    # Partial selection of the top scores of each row, only these are sorted
+    rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, rows, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def iter_top_k(
+    matrix_path: str,
+    n_rows: int,
+    k: int,
+    block_rows: int,
+    workers: int
+) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    # (first row, rows, scores) of every block, in row order
+    blocks = [(start, min(start + block_rows, n_rows)) for start in range(0, n_rows, block_rows)]
+    if workers <= 1 or len(blocks) <= 1:
+        for start, stop in blocks:
+            yield (start, *top_k_block(matrix_path, start, stop, k))
+        return
+    # Spawned rather than forked, as the calling process may run other threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(top_k_block, matrix_path, start, stop, k) for start, stop in blocks]
+        for (start, _), future in zip(blocks, futures):
+            yield (start, *future.result())
@@ -0,0 +1,80 @@
+import os
+import uuid
+from enum import Enum
+from typing import Iterable, Iterator
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+#
+# Columnar files (Parquet, Arrow IPC) written from streams of small column chunks
+#   Chunks (eg the rows of one DB document) are buffered into record batches of
+#   batch_rows rows, each written out before the next is buffered: memory is
+#   bounded by one batch whatever the size of the file. Every Parquet row group
+#   is one batch.
+#
+
+
+class ColumnarFormat(str, Enum):
+    PARQUET = "parquet"
+    ARROW = "arrow"
+    #   Arrow IPC file format, memory mappable by pyarrow.ipc.open_file
+
+
+COLUMNAR_MEDIA_TYPES = {
+    ColumnarFormat.PARQUET: "application/vnd.apache.parquet",
+    ColumnarFormat.ARROW: "application/vnd.apache.arrow.file",
+}
+
+
+def iter_record_batches(
+    schema: pa.Schema,
+    chunks: Iterable[dict[str, list]],
+    batch_rows: int
+) -> Iterator[pa.RecordBatch]:
+    # chunks: one list of values per column of the schema, all of the same length
+    buffers: dict[str, list] = {name: [] for name in schema.names}
+    n_rows = 0
+    for chunk in chunks:
+        for name in schema.names:
+            buffers[name].extend(chunk[name])
+        n_rows += len(chunk[schema.names[0]])
+        if n_rows >= batch_rows:
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(buffers[field.name], type=field.type) for field in schema],
+                schema=schema
+            )
+            buffers = {name: [] for name in schema.names}
+            n_rows = 0
+    if n_rows > 0:
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(buffers[field.name], type=field.type) for field in schema],
+            schema=schema
+        )
+
+
+def write_columnar_file(
+    path: str,
+    schema: pa.Schema,
+    batches: Iterable[pa.RecordBatch],
+    file_format: ColumnarFormat
+) -> int:
+    # Written next to path then renamed, so that readers never see a partial file
+    #   returns the number of rows written
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    n_rows = 0
+    try:
+        if file_format == ColumnarFormat.PARQUET:
+            with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+                for batch in batches:
+                    writer.write_table(pa.Table.from_batches([batch], schema=schema))
+                    n_rows += batch.num_rows
+        else:
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+                    n_rows += batch.num_rows
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return n_rows
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, TypeVar
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app.models.metrics import PasswordHashingMetrics
+from config import settings
+
+#
+# Password hashing and verification, off the event loop
+#   bcrypt is slow on purpose (~250 ms at cost 12), so it runs on a small
+#   dedicated pool of PASSWORD_HASH_WORKERS threads rather than on the event
+#   loop or the shared threadpool of sync routes. At most
+#   PASSWORD_HASH_MAX_PENDING calls may wait or run at once, any more are
+#   turned away with a 503 instead of queueing up behind a login burst.
+# Hashes of another cost than BCRYPT_ROUNDS are flagged by verify_password,
+#   so that callers can store the rehashed password on successful login.
+#
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+T = TypeVar("T")
+
+_executor: ThreadPoolExecutor | None = None
+_lock = Lock()
+_pending = 0
+_completed = 0
+_rejected = 0
+_total_seconds = 0.0
+
+
+def __get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.PASSWORD_HASH_WORKERS,
+                thread_name_prefix="password-hashing"
+            )
+        return _executor
+
+
+def __admit() -> None:
+    global _pending, _rejected
+    with _lock:
+        if _pending >= settings.PASSWORD_HASH_MAX_PENDING:
+            _rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail={
+                    "description": "Too many logins in progress",
+                    "recommendations": ["Retry in a few seconds"]
+                },
+                headers={"Retry-After": "1"}
+            )
+        _pending += 1
+
+
+def __timed(fn: Callable[[], T]) -> Callable[[], T]:
+    def run() -> T:
+        global _pending, _completed, _total_seconds
+        start = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            with _lock:
+                _pending -= 1
+                _completed += 1
+                _total_seconds += time.perf_counter() - start
+    return run
+
+
+def run_password_task(fn: Callable[[], T]) -> T:
+    # From sync code, eg routes already running on the threadpool
+    __admit()
+    return __get_executor().submit(__timed(fn)).result()
+
+
+async def run_password_task_async(fn: Callable[[], T]) -> T:
+    __admit()
+    return await asyncio.get_running_loop().run_in_executor(__get_executor(), __timed(fn))
+
+
+def hash_password(password: str) -> str:
+    return run_password_task(lambda: pwd_context.hash(password))
+
+
+def verify_password(password: str, hashed_pw: str) -> tuple[bool, str | None]:
+    # (valid, new hash to store or None), see CryptContext.verify_and_update
+    return run_password_task(lambda: pwd_context.verify_and_update(password, hashed_pw))
+
+
+async def verify_password_async(password: str, hashed_pw: str) -> tuple[bool, str | None]:
+    return await run_password_task_async(lambda: pwd_context.verify_and_update(password, hashed_pw))
+
+
+def password_hashing_metrics() -> PasswordHashingMetrics:
+    with _lock:
+        return PasswordHashingMetrics(
+            workers=settings.PASSWORD_HASH_WORKERS,
+            pending=_pending,
+            completed=_completed,
+            rejected=_rejected,
+            avg_seconds=round(_total_seconds / _completed, settings.N_DECIMALS) if _completed > 0 else None
+        )
@@ -0,0 +1,139 @@
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+import numpy as np
+import orjson
+from bson import ObjectId
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+
+from app.models.shared import CustomBaseModel
+from config import settings
+
+#
+# Fast path for reads of data from our own DB
+#   A route returning a Response is not validated against its response_model,
+#   so reads built with `construct_from_db` are returned as a TrustedJSONResponse
+#   and encoded by orjson instead of jsonable_encoder. Client facing keys are
+#   the aliases, as with response_model.
+#
+
+
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, np.ndarray):
+        # NaN are encoded as null by orjson
+        return obj.tolist()
+    if isinstance(obj, CustomBaseModel):
+        return obj.dict_for_client()
+    if isinstance(obj, BaseModel):
+        return obj.dict(by_alias=True)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class TrustedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if isinstance(content, CustomBaseModel):
+            content = content.dict_for_client()
+        elif isinstance(content, BaseModel):
+            content = content.dict(by_alias=True)
+        return orjson.dumps(content, default=_orjson_default)
+
+
+#
+# Streamed lists, for results too large to hold as one body
+#   Items are encoded one at a time as they come out of a DB cursor and sent
+#   in chunks of STREAM_CHUNK_ITEMS, so memory stays flat whatever the size.
+#   Sent as one JSON array, or as NDJSON (one item per line) when the client
+#   accepts application/x-ndjson. Sync iterables (pymongo cursors) are run on
+#   the threadpool by starlette, async ones (motor cursors) on the event loop.
+#
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _encode_item(item) -> bytes:
+    if isinstance(item, CustomBaseModel):
+        item = item.dict_for_client()
+    return orjson.dumps(item, default=_orjson_default)
+
+
+def _join_chunk(encoded: list[bytes], ndjson: bool, first: bool) -> bytes:
+    if ndjson:
+        return b"".join(line + b"\n" for line in encoded)
+    return (b"" if first else b",") + b",".join(encoded)
+
+
+def _iter_chunks(items: Iterable, ndjson: bool) -> Iterator[bytes]:
+    if not ndjson:
+        yield b"["
+    encoded, first = [], True
+    for item in items:
+        encoded.append(_encode_item(item))
+        if len(encoded) == settings.STREAM_CHUNK_ITEMS:
+            yield _join_chunk(encoded, ndjson, first)
+            encoded, first = [], False
+    if encoded:
+        yield _join_chunk(encoded, ndjson, first)
+    if not ndjson:
+        yield b"]"
+
+
+async def _aiter_chunks(items: AsyncIterable, ndjson: bool) -> AsyncIterator[bytes]:
+    if not ndjson:
+        yield b"["
+    encoded, first = [], True
+    async for item in items:
+        encoded.append(_encode_item(item))
+        if len(encoded) == settings.STREAM_CHUNK_ITEMS:
+            yield _join_chunk(encoded, ndjson, first)
+            encoded, first = [], False
+    if encoded:
+        yield _join_chunk(encoded, ndjson, first)
+    if not ndjson:
+        yield b"]"
+
+
+def stream_json(
+    request: Request,
+    items: Iterable | AsyncIterable,
+    status_code: int = 200
+) -> StreamingResponse:
+    ndjson = wants_ndjson(request)
+    if isinstance(items, AsyncIterable):
+        content = _aiter_chunks(items, ndjson)
+    else:
+        content = _iter_chunks(items, ndjson)
+    return StreamingResponse(
+        content,
+        status_code=status_code,
+        media_type=NDJSON_MEDIA_TYPE if ndjson else "application/json"
+    )
+
+
+#
+# Binary matrices, for dense numeric payloads too costly to encode as JSON
+#   Sent when the client accepts application/octet-stream: one line of JSON
+#   header (the other fields of the model, and the shape of the matrix), then
+#   the matrix as row major little-endian float32, NaN where a value is missing
+#     header, _, data = body.partition(b"\n")
+#     np.frombuffer(data, "<f4").reshape(json.loads(header)["shape"])
+#
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def wants_binary(request: Request) -> bool:
+    return BINARY_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def binary_matrix_response(content: CustomBaseModel, matrix_field: str) -> Response:
+    header = content.dict_for_client()
+    matrix = np.ascontiguousarray(header.pop(matrix_field), dtype="<f4")
+    header["shape"] = list(matrix.shape)
+    return Response(
+        orjson.dumps(header, default=_orjson_default) + b"\n" + matrix.tobytes(),
+        media_type=BINARY_MEDIA_TYPE
+    )
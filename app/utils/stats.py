@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.cluster import hierarchy
+
+
+def group_column_sums(values: np.ndarray, group_codes: np.ndarray, n_groups: int) -> np.ndarray:
+    # Sum of the columns sharing each group code, for every row at once
+    #   values: rows x columns, group_codes: one code in [0, n_groups) per column
+    indicator = np.zeros((len(group_codes), n_groups), dtype=values.dtype)
+    indicator[np.arange(len(group_codes)), group_codes] = 1
+    return values @ indicator
+
+
+def compute_spm(avg_tpm: np.ndarray, n_decimals: int) -> np.ndarray:
+    #
+    # Specificity measure (SPM) of every annotation label of every gene
+    #   avg_tpm: genes x annotation labels, NaN where a gene lacks the label
+    # Rounding mirrors the per-document computation: the rounded row total
+    #   is the denominator, and genes with zero total expression get SPM 0
+    #
+    totals = np.round(np.nansum(avg_tpm, axis=1, keepdims=True), n_decimals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spm = np.where(totals == 0, 0.0, avg_tpm / totals)
+    return np.round(spm, n_decimals)
+
+
+def rank_rows(values: np.ndarray) -> np.ndarray:
+    # Ranks of the values within each row, from 1, ties sharing their average rank
+    #   as for Spearman correlations
+    ranks = np.empty(values.shape, dtype=np.float64)
+    for i, row in enumerate(values):
+        sorted_row = np.sort(row)
+        ranks[i] = (
+            np.searchsorted(sorted_row, row, side="left")
+            + np.searchsorted(sorted_row, row, side="right")
+            + 1
+        ) / 2
+    return ranks
+
+
+def standardize_rows(values: np.ndarray) -> np.ndarray:
+    #
+    # Rows centered and scaled to unit norm, so that the dot product of two
+    #   standardized rows is the Pearson correlation of the original rows
+    # Constant rows, which correlate with nothing, are all zeros
+    #
+    centered = values - values.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms == 0, 0.0, centered / norms)
+
+
+def benjamini_hochberg(p_values: np.ndarray) -> np.ndarray:
+    # False discovery rate adjusted p-values (q-values), in the order of p_values
+    n = len(p_values)
+    if n == 0:
+        return np.empty(0)
+    order = np.argsort(p_values, kind="stable")
+    ranked = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.empty(n)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+def cluster_order(values: np.ndarray) -> np.ndarray:
+    #
+    # Order of the rows as the leaves of their average linkage hierarchical
+    #   clustering (euclidean), with similar rows next to each other
+    # Missing values count as 0
+    #
+    if len(values) < 3:
+        return np.arange(len(values))
+    linkage = hierarchy.linkage(np.nan_to_num(values, nan=0.0), method="average", optimal_ordering=True)
+    return hierarchy.leaves_list(linkage)
@@ -0,0 +1,67 @@
+import codecs
+import csv
+from itertools import chain, islice
+from typing import BinaryIO, Iterable, Iterator
+
+import numpy as np
+
+
+def iter_text_lines(stream: BinaryIO, encoding: str = "utf-8-sig") -> Iterator[str]:
+    # Decodes line by line so that uploaded files are never read whole into memory
+    #   `utf-8-sig` drops the BOM that spreadsheet exports like to prepend
+    return codecs.iterdecode(stream, encoding)
+
+
+def iter_delimited_rows(lines: Iterable[str]) -> Iterator[list[str]]:
+    # Delimiter is inferred from the header line: tab for TSV, comma otherwise
+    lines = iter(lines)
+    header = next(lines, None)
+    if header is None:
+        return iter([])
+    delimiter = "\t" if "\t" in header else ","
+    return (
+        row for row in csv.reader(chain([header], lines), delimiter=delimiter)
+        if row  # skip blank lines
+    )
+
+
+def read_sample_annotation_map(rows: Iterable[list[str]]) -> dict[str, str]:
+    #
+    # Mapping file layout, header row is skipped
+    #   sample_label    annotation_label
+    #   SRR0000001      ROOT
+    #
+    rows = iter(rows)
+    _ = next(rows, None)
+    return {
+        row[0].strip().upper(): row[1].strip().upper()
+        for row in rows
+        if len(row) >= 2 and row[0].strip() and row[1].strip()
+    }
+
+
+def iter_tpm_matrix_chunks(
+    rows: Iterator[list[str]],
+    n_samples: int,
+    chunk_size: int
+) -> Iterator[tuple[list[str], np.ndarray]]:
+    #
+    # Yields (gene_labels, tpm values of shape genes x samples) for every
+    #   `chunk_size` rows of the matrix body, so memory is bounded by the chunk
+    # The header row must have been consumed by the caller
+    # Raises ValueError on ragged or non-numeric rows
+    #
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        gene_labels = []
+        values = np.empty((len(chunk), n_samples), dtype=np.float64)
+        for i, row in enumerate(chunk):
+            if len(row) != n_samples + 1:
+                raise ValueError(
+                    f"Row for gene {row[0]} has {len(row) - 1} TPM values, expected {n_samples}"
+                )
+            gene_labels.append(row[0].strip().upper())
+            values[i] = row[1:]
+        yield gene_labels, values
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import time
+from typing import Callable
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.models.gene import GeneOut, GenePage
+from app.models.sample_annotation import SampleAnnotationOut, SampleAnnotationPage
+from app.utils.responses import TrustedJSONResponse
+from config import settings
+
+#
+# CPU time per read request, validated path vs trusted fast path
+#   validated: Out(**doc) per document, then FastAPI's response_model validation
+#              and jsonable_encoder, as the routes did before TrustedJSONResponse
+#   trusted:   Out.construct_from_db(doc) per document, encoded by orjson
+# No DB involved, documents are generated as read from the DB
+#
+#   python -m benchmarks.trusted_reads --samples 2000
+#
+
+
+def gene_docs(n: int) -> list[dict]:
+    species_id = ObjectId()
+    return [
+        {
+            "_id": ObjectId(),
+            "spe_id": species_id,
+            "label": f"AT1G{i:05d}",
+            "alias": [f"ALIAS {i}"],
+            "anots": [ObjectId() for _ in range(5)],
+        }
+        for i in range(n)
+    ]
+
+
+def sa_docs(n: int, n_samples: int) -> list[dict]:
+    species_id = ObjectId()
+    return [
+        {
+            "_id": ObjectId(),
+            "spe_id": species_id,
+            "g_id": ObjectId(),
+            "type": "ANOT TYPE",
+            "label": f"ANOT LABEL {i}",
+            "spm": 0.1,
+            "avg_tpm": 12.5,
+            "tpm_sum": 12.5 * n_samples,
+            "tpm_sq_sum": 200.0 * n_samples,
+            "n_samples": n_samples,
+            "samples": [{"label": f"SAMPLE {j}", "tpm": j * 0.125} for j in range(n_samples)],
+        }
+        for i in range(n)
+    ]
+
+
+def validated_body(page_model, out_model, docs: list[dict]) -> bytes:
+    page = page_model(page_total=1, curr_page=1, payload=[out_model(**doc) for doc in docs])
+    field = create_response_field(name=f"Response_{page_model.__name__}", type_=page_model)
+    content = asyncio.run(serialize_response(field=field, response_content=page))
+    return JSONResponse(content).body
+
+
+def trusted_body(page_model, out_model, docs: list[dict]) -> bytes:
+    page = page_model.construct(
+        page_total=1, curr_page=1, payload=[out_model.construct_from_db(doc) for doc in docs]
+    )
+    return TrustedJSONResponse(page).body
+
+
+def cpu_ms(fn: Callable[[], bytes], repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        _ = fn()
+    return (time.process_time() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--page-size", type=int, default=settings.PAGE_SIZE)
+    parser.add_argument("--samples", type=int, default=1000, help="samples per SA doc")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    cases = [
+        ("genes", GenePage, GeneOut, gene_docs(args.page_size)),
+        ("sample_annotations", SampleAnnotationPage, SampleAnnotationOut, sa_docs(args.page_size, args.samples)),
+    ]
+    print(f"{'endpoint':<20}{'validated ms':>14}{'trusted ms':>12}{'speedup':>9}")
+    for name, page_model, out_model, docs in cases:
+        # Both paths must send the same body
+        assert validated_body(page_model, out_model, docs) == trusted_body(page_model, out_model, docs)
+        validated = cpu_ms(lambda: validated_body(page_model, out_model, docs), args.repeat)
+        trusted = cpu_ms(lambda: trusted_body(page_model, out_model, docs), args.repeat)
+        print(f"{name:<20}{validated:>14.2f}{trusted:>12.2f}{validated / trusted:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
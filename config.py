@@ -28,6 +28,79 @@ class Settings(BaseSettings):
     # Constants
     N_DECIMALS: int = 3
     PAGE_SIZE: int = 10
+    MAX_PAGE_SIZE: int = 100
+    #   cap of the page size a client may ask for
+    INGEST_CHUNK_GENES: int = 500
+    #   gene rows of a TPM matrix aggregated and written per bulk_write
+    BULK_WRITE_CHUNK_SIZE: int = 5000
+    #   max operations sent per bulk_write
+    DELETE_CHUNK_GENES: int = 1000
+    #   genes removed per chunk of a species delete, with their SA docs and GA references
+    GA_IMPORT_CHUNK_ROWS: int = 5000
+    #   annotation file rows grouped and written per bulk_write
+    GA_IMPORT_MAX_REPORTED: int = 100
+    #   unresolved gene labels listed in an import summary
+    STREAM_CHUNK_ITEMS: int = 100
+    #   items encoded per chunk of a streamed list response
+    PACKED_SAMPLES: bool = False
+    #   store new SA doc samples as packed arrays indexed by a per species sample dictionary
+
+    # Jobs
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETRY_DELAY: int = 30
+    #   seconds, multiplied by the number of attempts made
+    JOB_LEASE_SECONDS: int = 300
+    #   a running job not heard from for this long is handed to another worker
+    JOB_POLL_INTERVAL: float = 2
+    JOB_CLAIM_SCAN: int = 50
+    #   queued jobs looked at per claim, when the oldest ones wait for a lock
+
+    # Passwords
+    BCRYPT_ROUNDS: int = 12
+    #   cost factor of new hashes, hashes of another cost are rehashed on login
+    PASSWORD_HASH_WORKERS: int = 2
+    #   threads dedicated to bcrypt, per process
+    PASSWORD_HASH_MAX_PENDING: int = 32
+    #   password checks waiting or running at once before logins get a 503
+
+    # Caches
+    EXPRESSION_CACHE_DIR: str = ".cache/expression"
+    EXPRESSION_CACHE_TTL: int = 30
+    #   seconds before a cached species matrix is checked against its data version again
+    EXPRESSION_CACHE_GRACE: int = 3600
+    #   seconds the matrices of an older data version are kept for workers still using them
+    COEXPRESSION_MAX_TOP: int = 1000
+    #   cap of the neighbours a co-expression search returns
+    COEXPRESSION_NETWORK_K: int = 50
+    #   neighbours stored per gene by a co-expression network build, by default
+    COEXPRESSION_SUBGRAPH_MAX_TOP: int = 50
+    #   cap of the neighbours per gene of a co-expression subgraph
+    COEXPRESSION_BLOCK_ROWS: int = 256
+    #   genes scored against all genes at once by a co-expression network build
+    COEXPRESSION_WORKERS: int = 2
+    #   processes scoring blocks of genes during a co-expression network build
+    HEATMAP_MAX_GENES: int = 2000
+    #   cap of the genes of one heatmap
+    EXPORT_CACHE_DIR: str = ".cache/exports"
+    EXPORT_BATCH_ROWS: int = 65536
+    #   rows per record batch (Parquet row group) of species exports, bounds their memory
+    EXPORT_CACHE_GRACE: int = 600
+    #   seconds the export files of an older data version are kept for requests about to send them
+    COUNTS_CACHE_TTL: int = 30
+    #   seconds before a cached page_total count is checked against its data version again
+    SPECIES_REGISTRY_TTL: int = 60
+    #   seconds before the in-process species registry is checked against its data version again
+    GENE_INDEX_TTL: int = 30
+    #   seconds before a species gene label index is checked against its data version again
+    GENE_INDEX_MAX_SPECIES: int = 16
+    #   species gene label indexes kept in memory, least recently used dropped first
+    ANNOTATION_INCIDENCE_TTL: int = 30
+    #   seconds before a gene x annotation matrix is checked against its data versions again
+    ANNOTATION_INCIDENCE_MAX_ENTRIES: int = 16
+    #   (species, annotation type) matrices kept in memory, least recently used dropped first
+    PRINCIPAL_CACHE_TTL: int = 60
+    #   seconds an authenticated api_key or token is trusted without looking up its user again
+    PRINCIPAL_CACHE_MAX_ENTRIES: int = 10000
 
     class Config:
         env_file = ".env"
@@ -53,7 +126,10 @@ class Settings(BaseSettings):
             return v
         connection_string = "mongodb+srv" if values["SRV"] else "mongodb"
         if values["MONGO_USER"] and values["MONGO_PASSWORD"]:
-            return f"{connection_string}://{values['MONGO_USER']}:{values['MONGO_PASSWORD']}@{values['MONGO_SERVER_AND_PORT']}/?{values['DB_OPTIONS']}"
+            return (
+                f"{connection_string}://{values['MONGO_USER']}:{values['MONGO_PASSWORD']}"
+                f"@{values['MONGO_SERVER_AND_PORT']}/?{values['DB_OPTIONS']}"
+            )
         return f"{connection_string}://{values['MONGO_SERVER_AND_PORT']}"
 
     @validator("ALGORITHM", pre=True, always=True)
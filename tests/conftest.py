@@ -1,3 +1,5 @@
+import os
+import shutil
 from fastapi.testclient import TestClient
 from pymongo import MongoClient
 from pymongo.database import Database
@@ -5,7 +7,8 @@ import pytest
 from passlib.context import CryptContext
 
 from app.main import app
-from app.db.setup import get_collection, get_db, setup_indexes
+from app.db.data_versions_collection import forget_data_versions
+from app.db.setup import get_async_client, get_async_db, get_collection, get_db, setup_indexes
 from app.models.user import UserDoc
 from config import settings
 
@@ -37,6 +40,9 @@ def get_db_for_test():
     run_test_seeder(db)
     yield lambda: db  # FastAPI dependencies must be a callable
     client.drop_database(settings.TEST_DATABASE_NAME)
+    forget_data_versions(settings.TEST_DATABASE_NAME)
+    shutil.rmtree(os.path.join(settings.EXPRESSION_CACHE_DIR, settings.TEST_DATABASE_NAME), ignore_errors=True)
+    shutil.rmtree(os.path.join(settings.EXPORT_CACHE_DIR, settings.TEST_DATABASE_NAME), ignore_errors=True)
 
 
 #
@@ -45,8 +51,18 @@ def get_db_for_test():
 #   they will still be calling on the same test database
 #   because the t_client fixture will only tear down the db at the end of the test
 #
+async def get_async_db_for_test():
+    return get_async_client()[settings.TEST_DATABASE_NAME]
+
+
 @pytest.fixture
-def t_client(get_db_for_test):
+def t_client(get_db_for_test, monkeypatch):
     app.dependency_overrides[get_db] = get_db_for_test
-    client = TestClient(app)
-    return client
+    app.dependency_overrides[get_async_db] = get_async_db_for_test
+    # The startup hook calls get_db itself, it gets the test db through the settings
+    monkeypatch.setattr(settings, "DATABASE_NAME", settings.TEST_DATABASE_NAME)
+    get_db.cache_clear()
+    # As a context manager, all requests share one event loop, hence one motor client
+    with TestClient(app) as client:
+        yield client
+    get_db.cache_clear()
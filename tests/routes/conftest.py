@@ -15,3 +15,6 @@ from test_genes import (
     many_genes_inserted,
     twenty_one_genes_inserted,
 )
+from test_sample_annotations import (
+    many_sa_dics,
+)
@@ -1,3 +1,4 @@
+import base64
 import json
 import math
 import pytest
@@ -38,7 +39,8 @@ def ga_dict_1(genes_1):
         "label": "1.1.1.2.2.1",
         "details": {
             "desc": "component PsbO/OEC33 of PS-II oxygen-evolving center",
-            "binname": "Photosynthesis.photophosphorylation.photosystem II.PS-II complex.oxygen-evolving center (OEC) extrinsic proteins.component OEC33/PsbO"
+            "binname": "Photosynthesis.photophosphorylation.photosystem II.PS-II complex."
+                       "oxygen-evolving center (OEC) extrinsic proteins.component OEC33/PsbO"
         },
         "genes": genes
     }
@@ -59,7 +61,8 @@ def ga_dict_2(genes_2):
         "label": "1.1.1.2.1.1",
         "details": {
             "desc": "component PsbA/D1 of PS-II reaction center complex",
-            "binname": "Photosynthesis.photophosphorylation.photosystem II.PS-II complex.reaction center complex.component D1/PsbA"
+            "binname": "Photosynthesis.photophosphorylation.photosystem II.PS-II complex."
+                       "reaction center complex.component D1/PsbA"
         },
         "genes": genes
     }
@@ -148,7 +151,8 @@ def test_get_many_gas_empty(t_client):
     assert response.json() == {
         "page_total": 0,
         "curr_page": 1,
-        "payload": []
+        "payload": [],
+        "next_cursor": None
     }
 
 
@@ -185,6 +189,30 @@ def test_get_many_gas_w_pages(twenty_one_gas_inserted, t_client):
     assert len(response.json()["payload"]) == 0
 
 
+def test_get_many_gas_w_cursor(twenty_one_gas_inserted, t_client):
+    labels = []
+    response = t_client.get("/api/v1/gene_annotations?page_size=8")
+    while True:
+        assert response.status_code == status.HTTP_200_OK
+        labels += [ga["label"] for ga in response.json()["payload"]]
+        next_cursor = response.json()["next_cursor"]
+        if next_cursor is None:
+            break
+        assert len(response.json()["payload"]) == 8
+        response = t_client.get(f"/api/v1/gene_annotations?page_size=8&cursor={next_cursor}")
+    assert sorted(labels) == sorted(ga["label"] for ga in twenty_one_gas_inserted)
+    assert len(set(labels)) == len(labels)
+
+
+def test_get_many_gas_invalid_cursor(t_client):
+    response = t_client.get("/api/v1/gene_annotations?cursor=nonsense")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    # Operators smuggled into the sort key values
+    cursor = base64.urlsafe_b64encode(b'[{"$gt": ""}, {"$gt": ""}]').decode()
+    response = t_client.get(f"/api/v1/gene_annotations?cursor={cursor}")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
 # TODO get many gas filter by type and/or labels
 
 
@@ -196,6 +224,22 @@ def test_delete_one_ga(ga_dict_1_inserted, t_client):
     assert response.status_code == status.HTTP_404_NOT_FOUND
 
 
+def test_deletes_remove_references(ga_dict_1_inserted, ga_dict_1, t_client):
+    taxid = ga_dict_1["genes"][0]["taxid"]
+    gene_label = ga_dict_1["genes"][0]["gene_label"]
+    response = t_client.delete(f"/api/v1/species/{taxid}/genes/{gene_label}?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_200_OK
+    gene_id = response.json()["_id"]
+    ga_type, label = ga_dict_1_inserted["type"], ga_dict_1_inserted["label"]
+    ga = t_client.get(f"/api/v1/gene_annotations/type/{ga_type}/label/{label}").json()
+    assert gene_id not in ga["gene_ids"]
+    assert len(ga["gene_ids"]) == len(ga_dict_1["genes"]) - 1
+    response = t_client.delete(f"/api/v1/gene_annotations/type/{ga_type}/label/{label}?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_200_OK
+    gene = t_client.get(f"/api/v1/species/{taxid}/genes/{ga_dict_1['genes'][1]['gene_label']}").json()
+    assert gene["annotations"] == []
+
+
 def test_patch_one_ga(ga_dict_1_inserted, t_client):
     ga_type = ga_dict_1_inserted["type"]
     label = ga_dict_1_inserted["label"]
@@ -266,6 +310,75 @@ def test_duplicate_gas_ignored(
     assert len(response.json()) == 1
 
 
+def test_post_many_gas_reports_all_missing_genes(many_genes_inserted, ga_dict_1, ga_dict_2, t_client):
+    genes, taxid = many_genes_inserted
+    ga_dict_1["genes"].append({"taxid": taxid, "gene_label": "NOT A GENE 1"})
+    ga_dict_2["genes"].append({"taxid": taxid, "gene_label": "NOT A GENE 2"})
+    # Genes are also resolved from their aliases
+    ga_dict_2["genes"].append({"taxid": taxid, "gene_label": genes[1]["alias"][0]})
+    response = t_client.post(
+        f"/api/v1/gene_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=[ga_dict_1, ga_dict_2]
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()["detail"]["missing_genes"] == [
+        {"taxid": taxid, "gene_label": "NOT A GENE 1"},
+        {"taxid": taxid, "gene_label": "NOT A GENE 2"},
+    ]
+    ga_dict_1["genes"].pop()
+    ga_dict_2["genes"].pop(-2)
+    response = t_client.post(
+        f"/api/v1/gene_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=[ga_dict_1, ga_dict_2]
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert str(genes[1]["_id"]) in response.json()[1]["gene_ids"]
+
+
+def test_import_mercator_file(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    mercator = "BINCODE\tNAME\tIDENTIFIER\tDESCRIPTION\tTYPE\n" \
+        "'1'\t'Photosynthesis'\t''\t''\tB\n" \
+        f"'1.1'\t'Photosynthesis.photophosphorylation'\t'{genes[0]['label'].lower()}.1'\t'desc'\tT\n" \
+        f"'1.1'\t'Photosynthesis.photophosphorylation'\t'{genes[1]['label'].lower()}'\t'desc'\tT\n" \
+        f"'35.2'\t'not assigned.not annotated'\t'{genes[1]['label'].lower()}.2'\t''\tT\n" \
+        "'35.2'\t'not assigned.not annotated'\t'not_a_gene.1'\t''\tT\n"
+    response = t_client.post(
+        f"/api/v1/gene_annotations/species/{taxid}/import?api_key={settings.TEST_API_KEY}",
+        data={"format": "mercator"},
+        files={"annotation_file": ("mercator.txt", mercator)}
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    summary = response.json()
+    assert summary["n_rows"] == 4
+    assert summary["n_annotations"] == 2
+    assert summary["n_gene_links"] == 3
+    assert summary["unresolved_gene_labels"] == ["NOT_A_GENE.1"]
+    ga = t_client.get("/api/v1/gene_annotations/type/MERCATOR/label/1.1").json()
+    assert set(ga["gene_ids"]) == {genes[0]["_id"], genes[1]["_id"]}
+    assert ga["details"] == {"binname": "Photosynthesis.photophosphorylation"}
+    gene = t_client.get(f"/api/v1/species/{taxid}/genes/{genes[1]['label']}").json()
+    assert len(gene["annotations"]) == 2
+
+
+def test_import_gaf_file(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    gaf = "!gaf-version: 2.2\n" + "".join(
+        f"TAIR\tlocus:{i}\t{gene['label']}\t{qualifier}\tGO:0009507\tref\tIDA\t\tC\tname"
+        f"\t\tprotein\ttaxon:{taxid}\t20220101\tTAIR\n"
+        for i, (gene, qualifier) in enumerate(zip(genes[:3], ["located_in", "located_in", "NOT|located_in"]))
+    )
+    response = t_client.post(
+        f"/api/v1/gene_annotations/species/{taxid}/import?api_key={settings.TEST_API_KEY}",
+        data={"format": "gaf"},
+        files={"annotation_file": ("ath.gaf", gaf)}
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    ga = t_client.get("/api/v1/gene_annotations/type/GO/label/GO:0009507").json()
+    assert set(ga["gene_ids"]) == {genes[0]["_id"], genes[1]["_id"]}
+    assert ga["details"] == {"aspect": "cellular_component"}
+
+
 def test_put_replace_gas(twenty_one_gas_inserted, ga_dict_1, t_client):
     # Replaces existing document -> for fields not defined in update,
     #   even if old doc has the field, will be replaced by default values set
@@ -319,3 +432,70 @@ def test_patch_gas_batch(
     assert response.status_code == status.HTTP_200_OK
     assert len(response.json()["gene_ids"]) > len(ga_1_original["genes"])
     assert response.json()["details"] == ga_1_original["details"]
+
+
+def test_batch_gas_link_genes(many_genes_inserted, ga_dict_1, ga_dict_2, t_client):
+    genes, taxid = many_genes_inserted
+    response = t_client.put(
+        f"/api/v1/gene_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=[ga_dict_1]
+    )
+    assert response.status_code == status.HTTP_200_OK
+    ga_1_id = response.json()[0]["_id"]
+    assert ga_1_id is not None
+    # Same type + label as ga_dict_1, so its gene ids are appended
+    ga_dict_2["label"] = ga_dict_1["label"]
+    response = t_client.patch(
+        f"/api/v1/gene_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=[ga_dict_2, ga_dict_1]
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert [ga["_id"] for ga in response.json()] == [ga_1_id]
+    for gene_dict in ga_dict_1["genes"] + ga_dict_2["genes"]:
+        gene = t_client.get(f"/api/v1/species/{taxid}/genes/{gene_dict['gene_label']}").json()
+        assert gene["annotations"] == [ga_1_id]
+
+
+def test_put_batch_repeating_a_key(many_genes_inserted, ga_dict_1, ga_dict_2, t_client):
+    genes, taxid = many_genes_inserted
+    # The last GA of a key replaces the earlier ones, whose genes are not linked
+    ga_dict_2["label"] = ga_dict_1["label"]
+    response = t_client.put(
+        f"/api/v1/gene_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=[ga_dict_2, ga_dict_1]
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()) == 1
+    ga_id = response.json()[0]["_id"]
+    labels_1 = {gene_dict["gene_label"] for gene_dict in ga_dict_1["genes"]}
+    for gene_dict in ga_dict_1["genes"] + ga_dict_2["genes"]:
+        gene = t_client.get(f"/api/v1/species/{taxid}/genes/{gene_dict['gene_label']}").json()
+        assert gene["annotations"] == ([ga_id] if gene_dict["gene_label"] in labels_1 else [])
+
+
+def test_gene_set_enrichment(ga_dict_1, ga_dict_2, t_client):
+    for ga_dict in (ga_dict_1, ga_dict_2):
+        response = t_client.post(f"/api/v1/gene_annotations?api_key={settings.TEST_API_KEY}", json=ga_dict)
+        assert response.status_code == status.HTTP_201_CREATED
+    taxid = ga_dict_1["genes"][0]["taxid"]
+    gene_labels = [gene["gene_label"] for gene in ga_dict_1["genes"]]
+    response = t_client.post(
+        f"/api/v1/gene_annotations/species/{taxid}/enrichment",
+        json={
+            "annotation_type": ga_dict_1["type"].lower(),
+            "gene_labels": gene_labels + ["NOT_A_GENE"],
+            "max_fdr": 1,
+        }
+    )
+    assert response.status_code == status.HTTP_200_OK
+    enrichment = response.json()
+    assert enrichment["annotation_type"] == ga_dict_1["type"]
+    assert enrichment["n_genes"] == len(gene_labels)
+    assert enrichment["n_annotations"] == 2
+    assert enrichment["unresolved_gene_labels"] == ["NOT_A_GENE"]
+    annotations = enrichment["annotations"]
+    assert annotations[0]["label"] == ga_dict_1["label"]
+    assert annotations[0]["n_overlap"] == len(gene_labels)
+    assert sorted(annotations[0]["gene_labels"]) == sorted(label.upper() for label in gene_labels)
+    assert [ga["p_value"] for ga in annotations] == sorted(ga["p_value"] for ga in annotations)
+    assert all(ga["fdr"] >= ga["p_value"] for ga in annotations)
@@ -1,7 +1,15 @@
+import json
 import math
 import pytest
+from bson import ObjectId
 from fastapi import status
 
+from app.db.data_versions_collection import species_genes_data_key
+from app.db.gene_index import get_gene_prefixes, resolve_gene_labels
+from app.db.setup import get_collection
+from app.db.species_collection import find_species_id_from_taxid
+from app.models.data_version import DataVersionDoc
+from app.models.gene import GeneDoc
 from config import settings
 
 #
@@ -127,7 +135,8 @@ def test_get_many_genes_empty(one_species_inserted, t_client):
     assert response.json() == {
         "page_total": 0,
         "curr_page": 1,
-        "payload": []
+        "payload": [],
+        "next_cursor": None
     }
 
 
@@ -164,6 +173,30 @@ def test_get_many_genes_w_pages(twenty_one_genes_inserted, t_client):
     assert len(response.json()["payload"]) == 0
 
 
+def test_get_many_genes_as_ndjson(twenty_one_genes_inserted, t_client):
+    genes, taxid = twenty_one_genes_inserted
+    response = t_client.get(
+        f"/api/v1/species/{taxid}/genes",
+        headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    # Every gene, not a page of them
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [gene["label"] for gene in lines] == sorted(gene["label"] for gene in genes)
+
+
+def test_post_many_genes_as_ndjson(genes_in_valid, t_client):
+    genes, taxid = genes_in_valid
+    response = t_client.post(
+        f"/api/v1/species/{taxid}/genes/batch?api_key={settings.TEST_API_KEY}",
+        json=genes,
+        headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert [json.loads(line)["label"] for line in response.text.splitlines()] == [gene["label"] for gene in genes]
+
+
 def test_delete_one_gene(one_gene_inserted, t_client):
     gene, taxid = one_gene_inserted
     response = t_client.delete(f"/api/v1/species/{taxid}/genes/{gene['label']}?api_key={settings.TEST_API_KEY}")
@@ -257,3 +290,62 @@ def test_put_replace_genes(twenty_one_genes_inserted, one_gene, t_client):
     response = t_client.get(f"/api/v1/species/{taxid}/genes/{to_replace['label']}")
     assert response.status_code == status.HTTP_200_OK
     assert "MODIFIED" in response.json()["label"]
+
+
+def test_autocomplete_genes(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    url = f"/api/v1/species/{taxid}/genes/autocomplete"
+    response = t_client.get(url, params={"prefix": "g001"})
+    assert response.status_code == status.HTTP_200_OK
+    assert [gene["gene_label"] for gene in response.json()] == ["G001", "G0010"]
+    # Aliases are searched too, each gene is listed once
+    completions = t_client.get(url, params={"prefix": "alias for gene 1"}).json()
+    assert [(gene["gene_label"], gene["matched"]) for gene in completions] == [
+        ("G001", "ALIAS FOR GENE 1"),
+        ("G0010", "ALIAS FOR GENE 10"),
+    ]
+    completions = t_client.get("/api/v1/genes/autocomplete", params={"prefix": "G00", "limit": 3}).json()
+    assert completions[2] == {"taxid": taxid, "gene_id": genes[1]["_id"], "gene_label": "G002", "matched": "G002"}
+    # Gene writes are reflected right away
+    response = t_client.post(
+        f"/api/v1/species/{taxid}/genes?api_key={settings.TEST_API_KEY}",
+        json={"label": "G0011", "alias": []}
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    response = t_client.delete(f"/api/v1/species/{taxid}/genes/G0010?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_200_OK
+    assert [gene["gene_label"] for gene in t_client.get(url, params={"prefix": "g001"}).json()] == ["G001", "G0011"]
+
+
+def test_autocomplete_kept_out_of_gene_index_lru(many_genes_inserted, get_db_for_test, t_client, monkeypatch):
+    genes, taxid = many_genes_inserted
+    db = get_db_for_test()
+    species_id = find_species_id_from_taxid(taxid, db)
+    # Even with no gene index kept, prefix arrays are not rebuilt at each keystroke
+    monkeypatch.setattr(settings, "GENE_INDEX_MAX_SPECIES", 0)
+    prefixes = get_gene_prefixes([species_id], db)[species_id]
+    for prefix in ("G", "G0", "G00"):
+        response = t_client.get("/api/v1/genes/autocomplete", params={"prefix": prefix})
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.json()) == len(genes)
+    assert get_gene_prefixes([species_id], db)[species_id] is prefixes
+
+
+def test_gene_labels_resolved_after_other_writers(many_genes_inserted, get_db_for_test, t_client):
+    genes, taxid = many_genes_inserted
+    db = get_db_for_test()
+    species_id = find_species_id_from_taxid(taxid, db)
+    assert resolve_gene_labels(species_id, ["G001"], db)[1] == []
+    # Written by another process: the cached index is not dropped, only its version bumped
+    _ = get_collection(GeneDoc, db).insert_one({"spe_id": species_id, "label": "G0099", "alias": [], "anots": []})
+    _ = get_collection(DataVersionDoc, db).update_one(
+        {"key": species_genes_data_key(species_id)},
+        {"$set": {"ver": ObjectId()}},
+        upsert=True
+    )
+    resolved, unresolved = resolve_gene_labels(species_id, ["G0099", "NO SUCH GENE"], db)
+    assert list(resolved) == ["G0099"]
+    assert unresolved == ["NO SUCH GENE"]
+    # Async lookups match aliases as the sync ones do
+    url = f"/api/v1/sample_annotations/species/{taxid}/genes/{genes[0]['alias'][0]}"
+    assert t_client.get(url).status_code == status.HTTP_200_OK
@@ -0,0 +1,150 @@
+import math
+from datetime import datetime, timedelta
+import pytest
+from bson import ObjectId
+from fastapi import status
+
+from app.db.jobs_collection import claim_next_job, finish_job, reap_expired_jobs, renew_job_lease
+from app.db.setup import get_collection
+from app.jobs import run_next_job
+from app.models.job import JobDoc, JobLockDoc
+from config import settings
+
+#
+# FIXTURES
+#
+
+
+@pytest.fixture
+def sa_batch_job(many_sa_dics, t_client):
+    response = t_client.post(
+        f"/api/v1/sample_annotations/batch?run_as_job=true&api_key={settings.TEST_API_KEY}",
+        json=many_sa_dics
+    )
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    return response.json()
+
+
+#
+# TESTS
+#
+
+
+def test_run_batch_as_job(sa_batch_job, many_sa_dics, get_db_for_test, t_client):
+    assert sa_batch_job["status"] == "queued"
+    job = run_next_job(get_db_for_test())
+    assert str(job.id) == sa_batch_job["_id"]
+    response = t_client.get(f"/api/v1/jobs/{sa_batch_job['_id']}?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_200_OK
+    job_out = response.json()
+    assert job_out["status"] == "succeeded"
+    assert job_out["progress"] == {"done": len(many_sa_dics), "total": len(many_sa_dics)}
+    assert job_out["result"] == {"n_docs_written": len(many_sa_dics) * 2}
+    response = t_client.get(
+        f"/api/v1/sample_annotations/species/{many_sa_dics[0]['species_taxid']}/genes/{many_sa_dics[0]['gene_label']}"
+    )
+    assert len(response.json()["payload"]) == 2
+
+
+def test_jobs_of_one_species_run_one_at_a_time(sa_batch_job, many_sa_dics, get_db_for_test, t_client):
+    taxid = many_sa_dics[0]["species_taxid"]
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/recompute_stats?run_as_job=true&api_key={settings.TEST_API_KEY}"
+    )
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    db = get_db_for_test()
+    first = claim_next_job("worker-1", db)
+    assert str(first.id) == sa_batch_job["_id"]
+    # The second job waits for the species lock held by the first one
+    assert claim_next_job("worker-2", db) is None
+
+
+def test_reaped_worker_loses_its_job(sa_batch_job, get_db_for_test):
+    db = get_db_for_test()
+    stale = claim_next_job("worker-1", db)
+    _ = get_collection(JobDoc, db).update_one(
+        {"_id": stale.id},
+        {"$set": {"lease_until": datetime.now() - timedelta(seconds=1)}}
+    )
+    assert reap_expired_jobs(db) == 1
+    _ = get_collection(JobDoc, db).update_one({"_id": stale.id}, {"$set": {"run_after": datetime.now()}})
+    current = claim_next_job("worker-2", db)
+    assert current.id == stale.id
+    # The former owner can neither keep the job alive nor report its outcome
+    assert renew_job_lease(stale, db) is False
+    assert finish_job(stale, {}, db) is False
+    assert get_collection(JobLockDoc, db).count_documents({"job_id": current.id}) > 0
+    assert finish_job(current, {}, db) is True
+
+
+def test_retried_batch_job_is_idempotent(sa_batch_job, many_sa_dics, get_db_for_test, t_client):
+    db = get_db_for_test()
+    _ = run_next_job(db)
+    # Run again, as after an attempt that failed once all its rows were written
+    _ = get_collection(JobDoc, db).update_one(
+        {"_id": ObjectId(sa_batch_job["_id"])},
+        {"$set": {"status": "queued", "run_after": datetime.now()}}
+    )
+    _ = run_next_job(db)
+    job_out = t_client.get(f"/api/v1/jobs/{sa_batch_job['_id']}?api_key={settings.TEST_API_KEY}").json()
+    assert job_out["status"] == "succeeded"
+    assert job_out["attempts"] == 2
+    sa = t_client.get(
+        f"/api/v1/sample_annotations/species/{many_sa_dics[0]['species_taxid']}/genes/{many_sa_dics[0]['gene_label']}"
+    ).json()["payload"][0]
+    assert sa["n_samples"] == 2
+    # Duplicates are still rejected, when the batch is queued
+    response = t_client.post(
+        f"/api/v1/sample_annotations/batch?run_as_job=true&api_key={settings.TEST_API_KEY}",
+        json=many_sa_dics
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+
+def test_job_failure_not_retried_on_rejected_input(many_sa_dics, get_db_for_test, t_client):
+    many_sa_dics[-1]["gene_label"] = "NOT A GENE"
+    response = t_client.post(
+        f"/api/v1/sample_annotations/batch?run_as_job=true&api_key={settings.TEST_API_KEY}",
+        json=many_sa_dics
+    )
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    _ = run_next_job(get_db_for_test())
+    response = t_client.get(f"/api/v1/jobs/{response.json()['_id']}?api_key={settings.TEST_API_KEY}")
+    assert response.json()["status"] == "failed"
+    assert response.json()["attempts"] == 1
+
+
+def test_delete_species_as_job(sa_batch_job, many_sa_dics, get_db_for_test, t_client, monkeypatch):
+    db = get_db_for_test()
+    _ = run_next_job(db)
+    taxid = many_sa_dics[0]["species_taxid"]
+    ga_dict = {
+        "type": "TEST_MERCATOR",
+        "label": "1.1",
+        "genes": [{"taxid": taxid, "gene_label": sa_dict["gene_label"]} for sa_dict in many_sa_dics],
+    }
+    response = t_client.post(f"/api/v1/gene_annotations?api_key={settings.TEST_API_KEY}", json=ga_dict)
+    assert response.status_code == status.HTTP_201_CREATED
+    response = t_client.delete(f"/api/v1/species/{taxid}?run_as_job=true&api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    # The species is kept until the job has deleted its data
+    assert t_client.get(f"/api/v1/species/{taxid}").status_code == status.HTTP_200_OK
+    monkeypatch.setattr(settings, "DELETE_CHUNK_GENES", 3)
+    _ = run_next_job(db)
+    assert t_client.get(f"/api/v1/species/{taxid}").status_code == status.HTTP_404_NOT_FOUND
+    job_out = t_client.get(f"/api/v1/jobs/{response.json()['_id']}?api_key={settings.TEST_API_KEY}").json()
+    assert job_out["status"] == "succeeded"
+    assert job_out["progress"] == {"done": len(many_sa_dics), "total": len(many_sa_dics)}
+    assert job_out["result"] == {
+        "n_genes": len(many_sa_dics),
+        "n_sample_annotations": len(many_sa_dics) * 2,
+        "n_gene_annotation_updates": math.ceil(len(many_sa_dics) / 3),
+    }
+    assert db["genes"].count_documents({}) == 0
+    assert db["sample_annotations"].count_documents({}) == 0
+    assert t_client.get("/api/v1/gene_annotations/type/TEST_MERCATOR/label/1.1").json()["gene_ids"] == []
+
+
+def test_get_job_not_found(t_client):
+    response = t_client.get(f"/api/v1/jobs/123456789012345678901234?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
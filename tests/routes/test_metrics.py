@@ -0,0 +1,45 @@
+from fastapi import status
+from passlib.context import CryptContext
+
+from app.db.users_collection import create_user, delete_user
+from app.models.user import User
+from config import settings
+
+#
+# TESTS
+#
+
+
+def test_api_key_auth_is_cached(t_client):
+    url = f"/api/v1/metrics?api_key={settings.TEST_API_KEY}"
+    response = t_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    before = response.json()["principal_cache"]
+    after = t_client.get(url).json()["principal_cache"]
+    assert after["hits"] == before["hits"] + 1
+    assert after["misses"] == before["misses"]
+
+
+def test_deleted_user_api_key_rejected(get_db_for_test, t_client):
+    db = get_db_for_test()
+    user = create_user(User(email="staff@example.com"), db)
+    url = f"/api/v1/metrics?api_key={user.api_key}"
+    assert t_client.get(url).status_code == status.HTTP_200_OK
+    _ = delete_user(user.id, db)
+    assert t_client.get(url).status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_login_rehashes_to_configured_cost(get_db_for_test, t_client):
+    db = get_db_for_test()
+    USERS_COLL = db["users"]
+    cheap_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash(settings.ADMIN_PW.get_secret_value())
+    _ = USERS_COLL.update_one({"email": settings.ADMIN_EMAIL}, {"$set": {"hashed_pw": cheap_hash}})
+    response = t_client.post(
+        "/api/v1/token",
+        data={"username": settings.ADMIN_EMAIL, "password": settings.ADMIN_PW.get_secret_value()}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    hashed_pw = USERS_COLL.find_one({"email": settings.ADMIN_EMAIL})["hashed_pw"]
+    assert hashed_pw.startswith(f"$2b${settings.BCRYPT_ROUNDS:02d}$")
+    metrics = t_client.get(f"/api/v1/metrics?api_key={settings.TEST_API_KEY}").json()
+    assert metrics["password_hashing"]["completed"] >= 1
@@ -1,8 +1,18 @@
 import json
 import math
+import os
+import numpy as np
 import pytest
+from bson import ObjectId
 from fastapi import status
 
+from app.db.data_versions_collection import NO_VERSION, find_data_version, sample_annotation_label_data_key
+from app.db.expression_cache import get_coexpression_matrix, get_species_expression
+from app.db.sample_annotations_collection import pack_species_samples
+from app.db.setup import get_collection
+from app.db.species_collection import find_species_id_from_taxid
+from app.jobs import run_next_job
+from app.models.sample_annotation import CoexpressionMethod, SampleAnnotationDoc
 from config import settings
 
 #
@@ -109,6 +119,28 @@ def test_post_many_rows_sa_valid(many_sa_dics_inserted, many_sa_dics):
     assert len(result) == len(many_sa_dics) * 2
 
 
+def test_post_many_rows_sa_in_row_order(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    url = f"/api/v1/sample_annotations/batch?api_key={settings.TEST_API_KEY}"
+
+    def row(gene: dict, sample_label: str) -> dict:
+        return {
+            "species_taxid": taxid,
+            "gene_label": gene["label"],
+            "annotation_type": "ANOT TYPE SAME",
+            "samples": [{"annotation_label": "ANOT LABEL A", "sample_label": sample_label, "tpm": 1}],
+        }
+
+    response = t_client.post(url, json=[row(genes[1], "SAMPLE 1")])
+    assert response.status_code == status.HTTP_201_CREATED
+    existing_id = response.json()[0]["_id"]
+    # The SA doc appended to is older than the one inserted, yet listed after it
+    response = t_client.post(url, json=[row(genes[0], "SAMPLE 2"), row(genes[1], "SAMPLE 2")])
+    assert response.status_code == status.HTTP_201_CREATED
+    assert [sa["gene_id"] for sa in response.json()] == [genes[0]["_id"], genes[1]["_id"]]
+    assert response.json()[1]["_id"] == existing_id
+
+
 def test_get_ga_by_gene(many_sa_dics_inserted, many_sa_dics, t_client):
     taxid = many_sa_dics[0]["species_taxid"]
     gene_label = many_sa_dics[0]["gene_label"]
@@ -118,6 +150,43 @@ def test_get_ga_by_gene(many_sa_dics_inserted, many_sa_dics, t_client):
     assert response.status_code == status.HTTP_200_OK
 
 
+def test_page_total_counts_docs_of_gene_only(many_sa_dics_inserted, many_sa_dics, t_client):
+    taxid = many_sa_dics[0]["species_taxid"]
+    gene_label = many_sa_dics[0]["gene_label"]
+    url = f"/api/v1/sample_annotations/species/{taxid}/genes/{gene_label}"
+    assert t_client.get(url).json()["page_total"] == 1
+    # Adding a sample annotation label to the gene changes its count right away
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json=dict(many_sa_dics[0], samples=[
+            {"annotation_label": f"NEW LABEL {i}", "sample_label": f"NEW SAMPLE {i}", "tpm": 1}
+            for i in range(settings.PAGE_SIZE)
+        ])
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert t_client.get(url).json()["page_total"] == 2
+
+
+def test_label_counts_kept_across_other_labels(many_sa_dics_inserted, many_sa_dics, get_db_for_test, t_client):
+    annotation_type = many_sa_dics[0]["annotation_type"]
+    db = get_db_for_test()
+    label_a_key = sample_annotation_label_data_key(annotation_type, "ANOT LABEL A")
+    version = find_data_version(label_a_key, db)
+    # Appending samples or adding docs of other labels leaves the count of a label cached
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json=dict(many_sa_dics[0], samples=[
+            {"annotation_label": "ANOT LABEL A", "sample_label": "SAMPLE 9", "tpm": 1},
+            {"annotation_label": "OTHER LABEL", "sample_label": "SAMPLE 10", "tpm": 1},
+        ])
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert find_data_version(label_a_key, db) == version
+    assert find_data_version(sample_annotation_label_data_key(annotation_type, "OTHER LABEL"), db) != NO_VERSION
+    url = f"/api/v1/sample_annotations/types/{annotation_type}/labels/OTHER LABEL"
+    assert t_client.get(url).json()["page_total"] == 1
+
+
 def test_get_ga_by_annotation(many_sa_dics_inserted, many_sa_dics, t_client):
     annotation_type = many_sa_dics[0]["annotation_type"]
     annotation_label = many_sa_dics[0]["samples"][0]["annotation_label"]
@@ -125,3 +194,310 @@ def test_get_ga_by_annotation(many_sa_dics_inserted, many_sa_dics, t_client):
         f"/api/v1/sample_annotations/types/{annotation_type}/labels/{annotation_label}?api_key={settings.TEST_API_KEY}"
     )
     assert response.status_code == status.HTTP_200_OK
+
+
+def test_get_top_sas_by_label(many_sa_dics, t_client):
+    # The higher the index of the gene, the higher its TPM in ANOT LABEL A
+    for i, sa_dict in enumerate(many_sa_dics):
+        sa_dict["samples"][0]["tpm"] = 10 + i
+    response = t_client.post(
+        f"/api/v1/sample_annotations/batch?api_key={settings.TEST_API_KEY}",
+        json=many_sa_dics
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    taxid = many_sa_dics[0]["species_taxid"]
+    url = f"/api/v1/sample_annotations/types/{many_sa_dics[0]['annotation_type']}/labels/ANOT LABEL A/top"
+    response = t_client.get(url, params={"n": 3, "rank_by": "avg_tpm"})
+    assert response.status_code == status.HTTP_200_OK
+    top = response.json()
+    assert [sa["avg_tpm"] for sa in top] == [(10 + i + 5) / 2 for i in range(len(many_sa_dics) - 1, len(many_sa_dics) - 4, -1)]
+    assert len(top[0]["samples"]) == 2
+    by_spm = t_client.get(url, params={"n": 3, "taxid": taxid}).json()
+    assert [sa["spm"] for sa in by_spm] == sorted((sa["spm"] for sa in by_spm), reverse=True)
+    response = t_client.get(url, params={"taxid": 1})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_post_tpm_matrix(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    tpm_matrix = "gene\tSAMPLE 1\tSAMPLE 2\tSAMPLE 3\n" + "".join(
+        f"{gene['label']}\t10\t5\t15\n" for gene in genes
+    ) + "NOT A GENE\t1\t1\t1\n"
+    sample_annotations = "sample_label\tannotation_label\nSAMPLE 1\tROOT\nSAMPLE 2\tROOT\nSAMPLE 3\tLEAF\n"
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/matrix?api_key={settings.TEST_API_KEY}",
+        data={"annotation_type": "matrix anot type"},
+        files={
+            "tpm_matrix": ("tpm.tsv", tpm_matrix),
+            "sample_annotations": ("annotations.tsv", sample_annotations),
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    summary = response.json()
+    assert summary["n_genes"] == len(genes)
+    assert summary["n_docs_written"] == len(genes) * 2
+    assert summary["missing_gene_labels"] == ["NOT A GENE"]
+    response = t_client.get(f"/api/v1/sample_annotations/species/{taxid}/genes/{genes[0]['label']}")
+    sas = {sa["label"]: sa for sa in response.json()["payload"]}
+    assert sas["ROOT"]["avg_tpm"] == 7.5
+    assert sas["ROOT"]["spm"] == round(7.5 / 22.5, settings.N_DECIMALS)
+    assert len(sas["LEAF"]["samples"]) == 1
+
+
+def test_recompute_stats(many_sa_dics_inserted, many_sa_dics, t_client):
+    taxid = many_sa_dics[0]["species_taxid"]
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/recompute_stats?api_key={settings.TEST_API_KEY}"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    summary = response.json()
+    assert summary["annotation_types"] == [many_sa_dics[0]["annotation_type"]]
+    assert summary["n_genes"] == len(many_sa_dics)
+    assert summary["n_docs_updated"] == len(many_sa_dics_inserted)
+    response = t_client.get(
+        f"/api/v1/sample_annotations/species/{taxid}/genes/{many_sa_dics[0]['gene_label']}"
+    )
+    sas = {sa["label"]: sa for sa in response.json()["payload"]}
+    assert sas["ANOT LABEL A"]["avg_tpm"] == 7.5
+    assert sas["ANOT LABEL A"]["spm"] == round(7.5 / 22.5, settings.N_DECIMALS)
+
+
+def test_append_samples_updates_running_stats(sa_dict_1_inserted, sa_dict_1, t_client):
+    sa_dict = dict(sa_dict_1, samples=[
+        {
+            "annotation_label": "ANOT LABEL A",
+            "sample_label": "SAMPLE 4",
+            "tpm": 30
+        },
+    ])
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json=sa_dict
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    sa = response.json()[0]
+    assert sa["n_samples"] == 3
+    assert sa["tpm_sum"] == 45
+    assert sa["tpm_sq_sum"] == 10 ** 2 + 5 ** 2 + 30 ** 2
+    assert sa["avg_tpm"] == 15
+    assert len(sa["samples"]) == 3
+
+
+def test_packed_samples_round_trip(sa_dict_1, t_client, monkeypatch):
+    monkeypatch.setattr(settings, "PACKED_SAMPLES", True)
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json=sa_dict_1
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    response = t_client.get(
+        f"/api/v1/sample_annotations/species/{sa_dict_1['species_taxid']}/genes/{sa_dict_1['gene_label']}"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    samples = {
+        sample["sample_label"]: sample["tpm_value"]
+        for sa in response.json()["payload"]
+        for sample in sa["samples"]
+    }
+    assert samples == {row["sample_label"]: row["tpm"] for row in sa_dict_1["samples"]}
+
+
+def test_append_to_packed_legacy_doc(one_gene_inserted, get_db_for_test, t_client):
+    gene_doc, taxid = one_gene_inserted
+    db = get_db_for_test()
+    species_id = find_species_id_from_taxid(taxid, db)
+    # Stored before the running sums existed
+    _ = get_collection(SampleAnnotationDoc, db).insert_one({
+        "spe_id": species_id,
+        "g_id": ObjectId(gene_doc["_id"]),
+        "type": "LEGACY TYPE",
+        "label": "ANOT LABEL A",
+        "spm": 1,
+        "avg_tpm": 7.5,
+        "samples": [{"label": "SAMPLE 1", "tpm": 10}, {"label": "SAMPLE 2", "tpm": 5}],
+    })
+    assert pack_species_samples(species_id, db) == 1
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json={
+            "species_taxid": taxid,
+            "gene_label": gene_doc["label"],
+            "annotation_type": "LEGACY TYPE",
+            "samples": [{"annotation_label": "ANOT LABEL A", "sample_label": "SAMPLE 3", "tpm": 30}],
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    sa = response.json()[0]
+    assert sa["n_samples"] == 3
+    assert sa["tpm_sum"] == 45
+    assert sa["tpm_sq_sum"] == 10 ** 2 + 5 ** 2 + 30 ** 2
+    assert sa["avg_tpm"] == 15
+    assert len(sa["samples"]) == 3
+
+
+def test_get_gene_expression(sa_dict_1_inserted, sa_dict_1, t_client):
+    url = f"/api/v1/sample_annotations/species/{sa_dict_1['species_taxid']}/genes/{sa_dict_1['gene_label']}/expression"
+    response = t_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    expression = response.json()
+    assert {sample["sample_label"]: sample["tpm_value"] for sample in expression["samples"]} == {
+        row["sample_label"]: row["tpm"] for row in sa_dict_1["samples"]
+    }
+    assert expression["annotations"] == {
+        sa_dict_1["annotation_type"]: {"ANOT LABEL A": 7.5, "ANOT LABEL B": 15}
+    }
+    # Appending samples bumps the species data version, so the cache is rebuilt
+    response = t_client.post(
+        f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+        json=dict(sa_dict_1, samples=[
+            {"annotation_label": "ANOT LABEL B", "sample_label": "SAMPLE 4", "tpm": 5}
+        ])
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    expression = t_client.get(url).json()
+    assert len(expression["samples"]) == 4
+    assert expression["annotations"][sa_dict_1["annotation_type"]]["ANOT LABEL B"] == 10
+
+
+def test_superseded_expression_kept_for_stale_workers(sa_dict_1_inserted, sa_dict_1, get_db_for_test, t_client, monkeypatch):
+    db = get_db_for_test()
+    species_id = find_species_id_from_taxid(sa_dict_1["species_taxid"], db)
+    stale = get_species_expression(species_id, db)
+
+    def append_sample(sample_label: str):
+        response = t_client.post(
+            f"/api/v1/sample_annotations?api_key={settings.TEST_API_KEY}",
+            json=dict(sa_dict_1, samples=[{"annotation_label": "ANOT LABEL B", "sample_label": sample_label, "tpm": 5}])
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+    append_sample("SAMPLE 4")
+    assert get_species_expression(species_id, db).path != stale.path
+    # Workers still holding the older version keep using its directory
+    assert get_coexpression_matrix(stale, CoexpressionMethod.PEARSON).shape == stale.tpm.shape
+    monkeypatch.setattr(settings, "EXPRESSION_CACHE_GRACE", -1)
+    append_sample("SAMPLE 5")
+    _ = get_species_expression(species_id, db)
+    assert not os.path.exists(stale.path)
+
+
+def test_get_gene_coexpression(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    labels = [gene["label"] for gene in genes]
+    profiles = {
+        labels[0]: [1, 2, 3, 4],
+        labels[1]: [2, 4, 6, 8],
+        labels[2]: [4, 3, 2, 1],
+        labels[3]: [1, 4, 9, 30],
+        **{label: [5, 1, 5, i] for i, label in enumerate(labels[4:])},
+    }
+    tpm_matrix = "gene\tS1\tS2\tS3\tS4\n" + "".join(
+        f"{label}\t" + "\t".join(map(str, tpms)) + "\n" for label, tpms in profiles.items()
+    )
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/matrix?api_key={settings.TEST_API_KEY}",
+        data={"annotation_type": "matrix anot type"},
+        files={
+            "tpm_matrix": ("tpm.tsv", tpm_matrix),
+            "sample_annotations": ("annotations.tsv", "sample_label\tannotation_label\nS1\tA\nS2\tA\nS3\tB\nS4\tB\n"),
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    url = f"/api/v1/species/{taxid}/genes/{labels[0]}/coexpression"
+    response = t_client.get(url, params={"top": 3})
+    assert response.status_code == status.HTTP_200_OK
+    coexpression = response.json()
+    assert coexpression["n_samples"] == 4
+    assert coexpression["genes"][0] == {"gene_id": genes[1]["_id"], "gene_label": labels[1], "score": 1.0}
+    assert coexpression["genes"][1]["gene_label"] == labels[3]
+    assert coexpression["genes"][1]["score"] < 1
+    assert len(coexpression["genes"]) == 3
+    # Ranks of labels[3] grow with those of labels[0]
+    by_rank = t_client.get(url, params={"top": 50, "method": "spearman"}).json()["genes"]
+    assert [gene["score"] for gene in by_rank[:2]] == [1.0, 1.0]
+    assert by_rank[-1] == {"gene_id": genes[2]["_id"], "gene_label": labels[2], "score": -1.0}
+    assert len(by_rank) == len(labels) - 1
+
+
+def test_post_expression_heatmap(many_genes_inserted, t_client):
+    genes, taxid = many_genes_inserted
+    labels = [gene["label"] for gene in genes]
+    tpm_matrix = "gene\tS1\tS2\tS3\tS4\n" \
+        f"{labels[0]}\t1\t2\t3\t4\n" \
+        f"{labels[1]}\t2\t4\t6\t8\n" \
+        f"{labels[2]}\t4\t3\t2\t1\n"
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/matrix?api_key={settings.TEST_API_KEY}",
+        data={"annotation_type": "matrix anot type"},
+        files={
+            "tpm_matrix": ("tpm.tsv", tpm_matrix),
+            "sample_annotations": ("annotations.tsv", "sample_label\tannotation_label\nS1\tA\nS2\tA\nS3\tB\nS4\tB\n"),
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    url = f"/api/v1/sample_annotations/species/{taxid}/heatmap"
+    heatmap_in = {"annotation_type": "matrix anot type", "gene_labels": [labels[2], labels[0], "NOPE", labels[1]]}
+    response = t_client.post(url, json=heatmap_in)
+    assert response.status_code == status.HTTP_200_OK
+    heatmap = response.json()
+    assert heatmap["gene_labels"] == [labels[2], labels[0], labels[1]]
+    assert heatmap["annotation_labels"] == ["A", "B"]
+    assert heatmap["values"] == [[3.5, 1.5], [1.5, 3.5], [3, 7]]
+    assert heatmap["missing_gene_labels"] == ["NOPE"]
+    heatmap = t_client.post(url, json={**heatmap_in, "value": "spm", "cluster": True}).json()
+    # labels[0] and labels[1] share their profile, labels[2] is left out at an end
+    assert heatmap["gene_labels"].index(labels[2]) in (0, 2)
+    assert heatmap["values"][heatmap["gene_labels"].index(labels[0])] == [0.3, 0.7]
+    # Same matrix as float32, after a JSON header line
+    response = t_client.post(url, json=heatmap_in, headers={"accept": "application/octet-stream"})
+    assert response.status_code == status.HTTP_200_OK
+    header, _, data = response.content.partition(b"\n")
+    header = json.loads(header)
+    assert header["shape"] == [3, 2]
+    assert header["gene_labels"] == [labels[2], labels[0], labels[1]]
+    assert np.frombuffer(data, "<f4").reshape(header["shape"]).tolist() == [[3.5, 1.5], [1.5, 3.5], [3, 7]]
+    response = t_client.post(url, json={**heatmap_in, "annotation_type": "unknown"})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_coexpression_network(many_genes_inserted, get_db_for_test, t_client, monkeypatch):
+    genes, taxid = many_genes_inserted
+    labels = [gene["label"] for gene in genes]
+    tpm_matrix = "gene\tS1\tS2\tS3\tS4\n" + "".join(
+        f"{label}\t{i}\t{2 * i}\t{i * i}\t{10 - i}\n" for i, label in enumerate(labels)
+    )
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/matrix?api_key={settings.TEST_API_KEY}",
+        data={"annotation_type": "matrix anot type"},
+        files={
+            "tpm_matrix": ("tpm.tsv", tpm_matrix),
+            "sample_annotations": ("annotations.tsv", "sample_label\tannotation_label\nS1\tA\nS2\tA\nS3\tB\nS4\tB\n"),
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    # Several blocks of genes, scored by a pool of processes
+    monkeypatch.setattr(settings, "COEXPRESSION_BLOCK_ROWS", 4)
+    url = f"/api/v1/species/{taxid}/coexpression/network?k=3&api_key={settings.TEST_API_KEY}"
+    summary = t_client.post(url).json()
+    assert summary["n_genes"] == len(labels)
+    assert summary["skipped"] is False
+    # Nothing changed since the build
+    assert t_client.post(url).json()["skipped"] is True
+    response = t_client.post(f"/api/v1/coexpression/networks?k=3&api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.json() == []
+    response = t_client.post(f"{url}&force=true&run_as_job=true")
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    _ = run_next_job(get_db_for_test())
+    job_out = t_client.get(f"/api/v1/jobs/{response.json()['_id']}?api_key={settings.TEST_API_KEY}").json()
+    assert job_out["status"] == "succeeded"
+    assert job_out["progress"] == {"done": len(labels), "total": len(labels)}
+    on_demand = t_client.get(f"/api/v1/species/{taxid}/genes/{labels[5]}/coexpression", params={"top": 3}).json()
+    stored = t_client.get(f"/api/v1/species/{taxid}/genes/{labels[5]}/coexpression/neighbours").json()
+    assert stored["genes"] == on_demand["genes"]
+    network = t_client.get(
+        f"/api/v1/species/{taxid}/genes/{labels[5]}/coexpression/network", params={"hops": 2, "top": 2}
+    ).json()
+    assert network["nodes"][0] == {"gene_id": genes[5]["_id"], "gene_label": labels[5], "hops": 0}
+    assert {node["hops"] for node in network["nodes"]} == {0, 1, 2}
+    assert len(network["edges"]) == 2 + 2 * 2
@@ -1,7 +1,12 @@
 import math
+import os
 from fastapi import status
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 
+from app.db.species_collection import find_species_id_from_taxid
+from app.routes.api.v1 import species as species_routes
 from config import settings
 
 #
@@ -141,7 +146,8 @@ def test_get_many_species_empty(t_client):
     assert response.json() == {
         "page_total": 0,
         "curr_page": 1,
-        "payload": []
+        "payload": [],
+        "next_cursor": None
     }
 
 
@@ -181,6 +187,23 @@ def test_delete_one_species(one_species_inserted, t_client):
     assert response.status_code == status.HTTP_404_NOT_FOUND
 
 
+def test_failed_species_delete_retried(one_species_inserted, t_client, monkeypatch):
+    taxid = one_species_inserted["taxid"]
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("cascade interrupted")
+
+    # The species doc is kept until its data is gone, so that the same DELETE can be retried
+    with monkeypatch.context() as patched:
+        patched.setattr(species_routes, "delete_species_data", fail)
+        with pytest.raises(RuntimeError):
+            _ = t_client.delete(f"/api/v1/species/{taxid}?api_key={settings.TEST_API_KEY}")
+    assert t_client.get(f"/api/v1/species/{taxid}").status_code == status.HTTP_200_OK
+    response = t_client.delete(f"/api/v1/species/{taxid}?api_key={settings.TEST_API_KEY}")
+    assert response.status_code == status.HTTP_200_OK
+    assert t_client.get(f"/api/v1/species/{taxid}").status_code == status.HTTP_404_NOT_FOUND
+
+
 def test_patch_one_species(one_species_inserted, t_client):
     taxid: int = one_species_inserted["taxid"]
     to_update = {
@@ -197,6 +220,9 @@ def test_patch_one_species(one_species_inserted, t_client):
     )
     assert response.status_code == status.HTTP_200_OK
     assert response.json()["name"] == to_update["name"]
+    # Served from the species registry, which the update invalidated
+    response = t_client.get(f"/api/v1/species/{taxid}")
+    assert response.json()["name"] == to_update["name"]
 
 
 def test_patch_one_species_unauthorized_field(one_species_inserted, t_client):
@@ -291,3 +317,73 @@ def test_put_replace_species(twenty_one_species_inserted, one_species_list, t_cl
     assert response.status_code == status.HTTP_200_OK
     assert "MODIFIED" in response.json()["name"]
     assert response.json()["qc_stat"] == {"log_processed": 0, "p_pseudoaligned": 0}
+
+
+def test_species_exports(many_genes_inserted, get_db_for_test, t_client, monkeypatch):
+    genes, taxid = many_genes_inserted
+    labels = [gene["label"] for gene in genes]
+    response = t_client.post(
+        f"/api/v1/gene_annotations?api_key={settings.TEST_API_KEY}",
+        json={
+            "type": "TEST_MERCATOR",
+            "label": "1.1",
+            "details": {"desc": "photosynthesis"},
+            "genes": [{"taxid": taxid, "gene_label": label} for label in labels[:3]]
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    ga_id = response.json()["_id"]
+    response = t_client.post(
+        f"/api/v1/sample_annotations/species/{taxid}/matrix?api_key={settings.TEST_API_KEY}",
+        data={"annotation_type": "matrix anot type"},
+        files={
+            "tpm_matrix": ("tpm.tsv", f"gene\tS1\tS2\n{labels[0]}\t1\t2\n{labels[1]}\t3\t4\n"),
+            "sample_annotations": ("annotations.tsv", "sample_label\tannotation_label\nS1\tA\nS2\tB\n"),
+        }
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    url = f"/api/v1/species/{taxid}/exports"
+    response = t_client.get(f"{url}/genes")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+    exported_genes = pq.read_table(pa.BufferReader(response.content)).to_pylist()
+    assert len(exported_genes) == len(genes)
+    assert {gene["label"]: gene["annotation_ids"] for gene in exported_genes}[labels[0]] == [ga_id]
+    response = t_client.get(f"{url}/gene_annotations", params={"format": "arrow"})
+    assert response.status_code == status.HTTP_200_OK
+    gas = pa.ipc.open_file(pa.BufferReader(response.content)).read_all().to_pylist()
+    assert [(ga["annotation_id"], len(ga["gene_ids"]), ga["details"]) for ga in gas] == [
+        (ga_id, 3, '{"desc": "photosynthesis"}')
+    ]
+    response = t_client.get(f"{url}/expression")
+    rows = pq.read_table(pa.BufferReader(response.content)).to_pylist()
+    assert sorted((row["gene_label"], row["annotation_label"], row["sample_label"], row["tpm"]) for row in rows) == [
+        (labels[0], "A", "S1", 1), (labels[0], "B", "S2", 2), (labels[1], "A", "S1", 3), (labels[1], "B", "S2", 4),
+    ]
+    # Served from the same file until the species data changes
+    etag = response.headers["etag"]
+    assert t_client.get(f"{url}/expression").headers["etag"] == etag
+    response = t_client.post(
+        f"/api/v1/species/{taxid}/genes/batch?api_key={settings.TEST_API_KEY}",
+        json=[{"label": "NEW_GENE"}]
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert t_client.get(f"{url}/expression").headers["etag"] != etag
+    assert t_client.get(f"{url}/unknown").status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    # Files of the older version are kept a while, for requests about to send them
+    species_id = find_species_id_from_taxid(taxid, get_db_for_test())
+    species_dir = os.path.join(settings.EXPORT_CACHE_DIR, settings.TEST_DATABASE_NAME, str(species_id))
+    superseded = [entry for entry in os.listdir(species_dir) if entry.endswith(".superseded")]
+    assert len([entry for entry in os.listdir(species_dir) if entry.endswith(".parquet")]) == 3
+    assert [entry for entry in superseded if entry.startswith("expression.")] != []
+    monkeypatch.setattr(settings, "EXPORT_CACHE_GRACE", -1)
+    response = t_client.post(
+        f"/api/v1/species/{taxid}/genes/batch?api_key={settings.TEST_API_KEY}",
+        json=[{"label": "NEWER_GENE"}]
+    )
+    assert response.status_code == status.HTTP_201_CREATED
+    assert t_client.get(f"{url}/expression").status_code == status.HTTP_200_OK
+    for marker in superseded:
+        assert not os.path.exists(os.path.join(species_dir, marker.removesuffix(".superseded")))
+    assert t_client.delete(f"/api/v1/species/{taxid}?api_key={settings.TEST_API_KEY}").status_code == status.HTTP_200_OK
+    assert not os.path.exists(species_dir)